@@ -0,0 +1,321 @@
+"""
+  Scale benchmark: run the service against synthetic fleets of dummy scripts and measure how it behaves
+  as the fleet grows
+
+  For each fleet size a worker interpreter generates N dummy scripts and a matching config in a temporary
+  directory, points the service at it (PROCM_CONFIG, PROCM_SOCKET, PROCM_RUN_DIR, PROCM_LOG_DIR), runs it
+  and measures:
+    init_s             : Service() construction, i.e. the first config load and reload
+    boot_s             : from listen until every process is running
+    poll_s             : one supervision poll over the whole fleet
+    scan_s             : one scan of the process table
+    reload_s           : a "reload" request after one process changed in the config, over the socket
+    reload_unchanged_s : a "reload" request after the config was rewritten unchanged
+    list_s             : `procm-cli procs --list`, end to end
+    stop_all_s         : a "stop-all" request
+    start_all_s        : a "start-all" request
+    restart_latency_s  : from SIGKILL to a new running child, over a sample of processes
+    rss_bytes          : resident memory of the service with the fleet running
+  Durations are medians over --repeat runs where repeated. Results are written as JSON, to compare runs.
+
+  The dummy scripts block reading a FIFO under sh, so a fleet of 10,000 is 10,000 small processes;
+  use --runtime python for heavier ones. Run as root from anywhere:
+    python3 bench/scale.py --sizes 100,1000,10000 --output scale.json
+"""
+import os
+import sys
+import json
+import time
+import random
+import signal
+import shutil
+import asyncio
+import argparse
+import functools
+import platform
+import tempfile
+import statistics
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+SRC = os.path.join(ROOT, "src")
+CLI = os.path.join(SRC, "procm-cli")
+PREFIX = "bench" # process names are bench00000, bench00001, ...
+RUNTIMES = {
+  "sh": ("/bin/sh", "read _ 0<>{fifo}\n"), # blocks forever: the FIFO is open for writing by the reader itself
+  "python": (sys.executable, "import signal\nsignal.pause()\n"),
+}
+
+def environ(root : str):
+  """
+    Environment pointing the service and the CLI at a benchmark directory
+
+    @params
+      root = Required : benchmark directory
+    @return
+      (dict) environment variables
+  """
+  return dict(os.environ, PROCM_CONFIG=os.path.join(root, "procm_config.json"), PROCM_SOCKET=os.path.join(root, "procm.sock"),
+              PROCM_RUN_DIR=os.path.join(root, "run"), PROCM_LOG_DIR=os.path.join(root, "log"))
+
+def generate(root : str, size : int, runtime : str, capture : bool):
+  """
+    Write the dummy scripts and config of a fleet
+
+    @params
+      root = Required : benchmark directory
+      size = Required : number of processes
+      runtime = Required : key of RUNTIMES
+      capture = Required : capture output, otherwise discard it
+    @return
+      (list) config entries
+  """
+  interpreter, body = RUNTIMES[runtime]
+  scripts = os.path.join(root, "scripts")
+  os.makedirs(scripts, exist_ok=True)
+  fifo = os.path.join(root, "block")
+  if not os.path.exists(fifo):
+    os.mkfifo(fifo)
+
+  processes = []
+  for i in range(size):
+    path = os.path.join(scripts, f"{PREFIX}{i:05d}")
+    with open(path, 'w') as f:
+      f.write(body.format(fifo=fifo))
+    processes.append({"name": f"{PREFIX}{i:05d}", "path": path, "runtime": interpreter, "status": True, "log": {} if capture else False})
+  write_config(root, processes)
+  return processes
+
+def write_config(root : str, processes : list):
+  """
+    Replace the config of a fleet
+
+    @params
+      root = Required : benchmark directory
+      processes = Required : config entries
+    @return
+      None
+  """
+  path = os.path.join(root, "procm_config.json")
+  with open(f"{path}.tmp", 'w') as f:
+    json.dump({"processes": processes}, f)
+  os.replace(f"{path}.tmp", path)
+
+def summarize(values : list):
+  """
+    @params
+      values = Required : durations
+    @return
+      (dict) p50, p95, max and count, None where empty
+  """
+  values = sorted(values)
+  if len(values) == 0:
+    return {"p50": None, "p95": None, "max": None, "count": 0}
+  return {"p50": values[len(values) // 2], "p95": values[min(len(values) - 1, int(len(values) * 0.95))], "max": values[-1], "count": len(values)}
+
+async def wait_for(predicate, timeout : float, interval : float = 0.005):
+  """
+    Wait until a condition holds
+
+    @params
+      predicate = Required : function returning a bool
+      timeout = Required : seconds to wait at most
+      interval = Optional : seconds between checks
+    @return
+      (float) seconds waited
+    @raises
+      TimeoutError if the condition does not hold in time
+  """
+  start = time.perf_counter()
+  while not predicate():
+    if time.perf_counter() - start > timeout:
+      raise TimeoutError(f"condition not met in {timeout}s")
+    await asyncio.sleep(interval)
+  return time.perf_counter() - start
+
+async def timed(func, *args, repeat : int = 1):
+  """
+    Median duration of a blocking call, run off the event loop so the service keeps serving
+
+    @params
+      func = Required : function
+      args = Optional : its arguments
+      repeat = Optional : runs
+    @return
+      (float) seconds
+  """
+  loop = asyncio.get_event_loop()
+  durations = []
+  for _ in range(repeat):
+    start = time.perf_counter()
+    await loop.run_in_executor(None, func, *args)
+    durations.append(time.perf_counter() - start)
+  return statistics.median(durations)
+
+async def measure(root : str, size : int, runtime : str, capture : bool, crashes : int, repeat : int):
+  """
+    Run the service against a generated fleet and measure it. Runs in a worker interpreter whose
+    environment points the service at the benchmark directory
+
+    @params
+      root = Required : benchmark directory
+      size = Required : number of processes
+      runtime = Required : key of RUNTIMES
+      capture = Required : capture output
+      crashes = Required : processes killed to measure restart latency
+      repeat = Required : runs of the repeated measurements
+    @return
+      (dict) results
+  """
+  sys.path.insert(0, os.path.join(SRC, "procm"))
+  import psutil
+  from service import Service
+  from runtime.socket import Socket
+  from runtime.utils.proctable import scan_procs
+
+  processes = generate(root, size, runtime, capture)
+  results = {"size": size, "runtime": runtime, "capture": capture}
+  loop = asyncio.get_event_loop()
+  client = Socket()
+  timeout = 60 + size * 0.05
+
+  start = time.perf_counter()
+  service = Service()
+  results['init_s'] = time.perf_counter() - start
+  service.watch = None # reloads only on request, or config edits below would be picked up before they are timed
+
+  listening = loop.create_task(service.listen())
+  results['boot_s'] = await wait_for(lambda: all(proc.running == True for proc in service.processes), timeout)
+  await wait_for(lambda: os.path.exists(client.socket_path), 10)
+
+  durations = []
+  for _ in range(repeat):
+    start = time.perf_counter()
+    await service.poll_procs()
+    durations.append(time.perf_counter() - start)
+  results['poll_s'] = statistics.median(durations)
+  results['scan_s'] = await timed(scan_procs, repeat=repeat)
+
+  write_config(root, processes)
+  results['reload_unchanged_s'] = await timed(client.request, "reload")
+  durations = []
+  for i in range(repeat):
+    processes[i % size]['env'] = {"BENCH_RUN": str(i)} # changes one process, restarted at its next start
+    write_config(root, processes)
+    durations.append(await timed(client.request, "reload"))
+  results['reload_s'] = statistics.median(durations)
+
+  results['list_s'] = await timed(functools.partial(subprocess.run, [sys.executable, CLI, "procs", "--list"], stdout=subprocess.DEVNULL), repeat=repeat)
+  results['rss_bytes'] = psutil.Process().memory_info().rss
+
+  victims = random.sample(service.processes, min(crashes, size))
+  pids = {proc.name: proc.pid for proc in victims}
+  latencies = {}
+  killed = time.perf_counter()
+  for proc in victims:
+    os.kill(pids[proc.name], signal.SIGKILL)
+  def restarted():
+    for proc in victims:
+      if proc.name not in latencies and proc.running == True and proc.pid not in (pids[proc.name], -1):
+        latencies[proc.name] = time.perf_counter() - killed
+    return len(latencies) == len(victims)
+  await wait_for(restarted, timeout, 0.001)
+  results['restart_latency_s'] = summarize(list(latencies.values()))
+
+  results['stop_all_s'] = await timed(client.request, "stop-all")
+  results['start_all_s'] = await timed(client.request, "start-all")
+
+  service.terminate()
+  await asyncio.wait_for(listening, timeout)
+  results['max_rss_bytes'] = psutil.Process().memory_info().rss
+  return results
+
+def run(size : int, args : argparse.Namespace):
+  """
+    Benchmark one fleet size in a worker interpreter, in a fresh directory
+
+    @params
+      size = Required : number of processes
+      args = Required : command line arguments
+    @return
+      (dict) results, or the error if the worker failed
+  """
+  root = tempfile.mkdtemp(prefix="procm-bench-")
+  command = [sys.executable, os.path.realpath(__file__), "--worker", str(size), "--root", root, "--runtime", args.runtime,
+             "--crashes", str(args.crashes), "--repeat", str(args.repeat)] + (["--capture"] if args.capture else [])
+  try:
+    worker = subprocess.run(command, env=environ(root), stdout=subprocess.PIPE, text=True)
+    if worker.returncode != 0:
+      return {"size": size, "error": f"worker exited with {worker.returncode}"}
+    return json.loads(worker.stdout.strip().splitlines()[-1])
+  finally:
+    cleanup()
+    shutil.rmtree(root, ignore_errors=True)
+
+def cleanup():
+  """
+    Kill dummy processes left behind by a failed worker
+
+    @return
+      None
+  """
+  for pid in [int(pid) for pid in os.listdir("/proc") if pid.isdigit()]:
+    try:
+      with open(f"/proc/{pid}/cmdline", "rb") as f:
+        if f.read().startswith(f"procm_p_{PREFIX}".encode()):
+          os.killpg(pid, signal.SIGKILL)
+    except OSError:
+      pass
+
+def commit():
+  """
+    @return
+      (string or None) git commit the benchmark ran against
+  """
+  try:
+    return subprocess.run(["git", "-C", ROOT, "rev-parse", "HEAD"], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True, check=True).stdout.strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+def main():
+  """
+    Parse arguments, run the fleet sizes and write the results
+  """
+  parser = argparse.ArgumentParser(description="Measure the service against synthetic fleets")
+  parser.add_argument("--sizes", default="100,1000,10000", help="Comma separated fleet sizes. Default: 100,1000,10000")
+  parser.add_argument("--runtime", choices=list(RUNTIMES), default="sh", help="Dummy script runtime. Default: sh")
+  parser.add_argument("--capture", action="store_true", help="Capture the output of the dummy scripts")
+  parser.add_argument("--crashes", type=int, default=20, help="Processes killed to measure restart latency. Default: 20")
+  parser.add_argument("--repeat", type=int, default=5, help="Runs of the repeated measurements. Default: 5")
+  parser.add_argument("--output", "-o", help="File to write the JSON results to. Default: stdout")
+  parser.add_argument("--worker", type=int, help=argparse.SUPPRESS)
+  parser.add_argument("--root", help=argparse.SUPPRESS)
+  args = parser.parse_args()
+
+  if args.worker is not None:
+    results = asyncio.get_event_loop().run_until_complete(measure(args.root, args.worker, args.runtime, args.capture, args.crashes, args.repeat))
+    print(json.dumps(results))
+    return
+
+  if os.geteuid() != 0:
+    print("The benchmark must run as root")
+    sys.exit(9)
+
+  report = {
+    "meta": {"time": time.strftime("%Y-%m-%dT%H:%M:%S%z"), "commit": commit(), "python": platform.python_version(),
+             "platform": platform.platform(), "cpus": os.cpu_count()},
+    "results": [],
+  }
+  for size in [int(size) for size in args.sizes.split(",")]:
+    print(f"{size} processes...", file=sys.stderr)
+    report['results'].append(run(size, args))
+
+  output = json.dumps(report, indent=2)
+  if args.output:
+    with open(args.output, 'w') as f:
+      f.write(output + "\n")
+  else:
+    print(output)
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,217 @@
+"""
+  Socket activation
+
+  The service binds the listening sockets a process declares ("sockets") and keeps them open for as
+  long as the process is configured. They are passed to the process as fds 3, 4, ... following the
+  LISTEN_FDS convention, so connections queue in the backlog instead of being refused while it restarts.
+  A "lazy" process is only started once one of its sockets becomes readable, and with "idle_timeout" is
+  stopped again after using no CPU for that many seconds.
+
+  Addresses: "PORT", "HOST:PORT", "tcp:HOST:PORT", "tcp6:[HOST]:PORT" or "unix:/path".
+"""
+import os
+import pwd
+import socket
+import asyncio
+from .errors import *
+
+def parse_address(address : str):
+  """
+    Parse a socket address
+
+    @params
+      address = Required : address, see module docstring
+    @return
+      (int, tuple or string) address family, bind address
+    @raises
+      ValueError on an invalid address
+  """
+  if address.startswith("unix:"):
+    if not address[5:]:
+      raise ValueError(f"invalid socket address {address}")
+    return socket.AF_UNIX, address[5:]
+
+  family = socket.AF_INET
+  if address.startswith("tcp6:"):
+    family, address = socket.AF_INET6, address[5:]
+  elif address.startswith("tcp:"):
+    address = address[4:]
+
+  host, _, port = address.rpartition(":")
+  host = host.strip("[]") or ("::" if family == socket.AF_INET6 else "0.0.0.0")
+  if not port.isdigit() or not 0 < int(port) < 65536:
+    raise ValueError(f"invalid socket address {address}")
+  return family, (host, int(port))
+
+def listen(address : str, user : str = None):
+  """
+    Bind and listen on an address. The socket stays blocking, as the process it is passed to expects
+
+    @params
+      address = Required : address, see module docstring
+      user = Optional : owner of a unix socket file
+    @return
+      (socket.socket) listening socket
+  """
+  family, bind = parse_address(address)
+  sock = socket.socket(family, socket.SOCK_STREAM)
+  try:
+    if family == socket.AF_UNIX:
+      if os.path.exists(bind):
+        os.remove(bind)
+      sock.bind(bind)
+      if user:
+        pwdu = pwd.getpwnam(user)
+        os.chown(bind, pwdu.pw_uid, pwdu.pw_gid)
+    else:
+      sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+      sock.bind(bind)
+    sock.listen(socket.SOMAXCONN)
+  except OSError:
+    sock.close()
+    raise
+  return sock
+
+def shim(argv : list, executable : str, fds : list):
+  """
+    Wrap a command so the child gets fds as 3, 4, ... and LISTEN_PID set to its own pid, which is not
+    known before the fork. bash moves the fds and then execs the command in place, keeping the pid and
+    argv[0]
+
+    @params
+      argv = Required : arguments, including argv[0]
+      executable = Required : program to run
+      fds = Required : listening socket fds, in order
+    @return
+      (list) bash arguments
+  """
+  high = max(fds) + 1 # fds are first moved out of the way of the 3, 4, ... targets
+  park = " ".join(f"{high + i}<&{fd} {fd}<&-" for i, fd in enumerate(fds))
+  place = " ".join(f"{3 + i}<&{high + i} {high + i}<&-" for i in range(len(fds)))
+  script = f'export LISTEN_PID=$$ LISTEN_FDS={len(fds)}; exec {park}; exec {place}; exec -a "$0" "$@"'
+  return ["bash", "-c", script, argv[0], executable] + argv[1:]
+
+class Activation:
+
+  def __init__(self):
+    """
+      Initialize with no sockets
+
+      @return
+        None
+    """
+    self.sockets = {} # address -> listening socket
+    self.armed = {} # process name -> (process, fds, callback) waiting for a first connection
+    self.waiting = {} # fd -> names of the processes armed on it, in order
+    self.idle = {} # process name -> (pid, cpu ticks, monotonic time they last changed)
+
+  def sync(self, processes : list):
+    """
+      Bind the sockets of configured processes and close those no longer used. Each process gets its
+      sockets as 'listeners'
+
+      @params
+        processes = Required : Process objects
+      @return
+        (dict) process name -> error, for sockets that could not be bound
+    """
+    errors = {}
+    wanted = set()
+
+    for proc in processes:
+      proc.listeners = []
+      for address in proc.sockets:
+        wanted.add(address)
+        if address not in self.sockets:
+          try:
+            self.sockets[address] = listen(address, proc.user)
+          except OSError as e:
+            errors[proc.name] = f"Cannot listen on {address}: {e}"
+            continue
+        proc.listeners.append(self.sockets[address])
+
+    for address in set(self.sockets) - wanted:
+      self.sockets.pop(address).close()
+      family, bind = parse_address(address)
+      if family == socket.AF_UNIX and os.path.exists(bind):
+        os.remove(bind)
+    return errors
+
+  def arm(self, proc, callback):
+    """
+      Call back once when a connection arrives on any socket of a process. Pool members share their
+      sockets, and are woken one per connection, in the order they were armed
+
+      @params
+        proc = Required : Process
+        callback = Required : function called with the process
+      @return
+        None
+    """
+    if proc.name in self.armed or not proc.listeners:
+      return
+    loop = asyncio.get_event_loop()
+    fds = [sock.fileno() for sock in proc.listeners]
+    self.armed[proc.name] = (proc, fds, callback)
+
+    for fd in fds:
+      self.waiting.setdefault(fd, []).append(proc.name)
+      if len(self.waiting[fd]) == 1:
+        loop.add_reader(fd, self.__readable, fd)
+
+  def __readable(self, fd : int):
+    """
+      Wake the first process waiting on a socket
+
+      @params
+        fd = Required : readable socket fd
+      @return
+        None
+    """
+    proc, _, callback = self.armed[self.waiting[fd][0]]
+    self.disarm(proc)
+    callback(proc)
+
+  def disarm(self, proc):
+    """
+      Stop watching a process's sockets
+
+      @params
+        proc = Required : Process
+      @return
+        None
+    """
+    _, fds, _ = self.armed.pop(proc.name, (None, [], None))
+    for fd in fds:
+      self.waiting[fd].remove(proc.name)
+      if not self.waiting[fd]:
+        del self.waiting[fd]
+        asyncio.get_event_loop().remove_reader(fd)
+
+  def idle_for(self, proc, ticks : float, now : float):
+    """
+      Track how long a process has used no CPU
+
+      @params
+        proc = Required : Process
+        ticks = Required : its cumulative CPU ticks
+        now = Required : monotonic time
+      @return
+        (float) seconds since its CPU time last changed
+    """
+    pid, last, since = self.idle.get(proc.name, (None, None, now))
+    if pid != proc.pid or last != ticks:
+      since = now
+    self.idle[proc.name] = (proc.pid, ticks, since)
+    return now - since
+
+  def close(self):
+    """
+      Close every socket
+
+      @return
+        None
+    """
+    for proc, _, _ in list(self.armed.values()):
+      self.disarm(proc)
+    self.sync([])
@@ -0,0 +1,225 @@
+"""
+  cgroup v2 groups for managed processes
+
+  Each process that asks for it runs, with all its descendants, in <cgroup2 mount>/procm.slice/<name>.
+  Limits are the kernel's own interface files; usage is read from memory.current and cpu.stat, and a
+  group is killed as a whole through cgroup.kill
+"""
+import os
+import time
+import asyncio
+from .errors import *
+
+SLICE = "procm.slice"
+LIMITS = {"memory.max": "memory", "cpu.max": "cpu", "cpu.weight": "cpu", "io.weight": "io"} # file -> controller
+ACCOUNTING = {"memory", "pids"} # controllers enabled when available, for usage of the whole group
+
+def mount_point():
+  """
+    Find where the cgroup v2 hierarchy is mounted
+
+    @return
+      (string or None) mount point, None if there is none
+  """
+  try:
+    with open("/proc/self/mounts") as f:
+      mounts = [line.split() for line in f]
+  except OSError:
+    return None
+
+  paths = [m[1] for m in mounts if len(m) > 2 and m[2] == "cgroup2"]
+  if "/sys/fs/cgroup" in paths:
+    return "/sys/fs/cgroup"
+  return paths[0] if paths else None
+
+def write(path : str, value):
+  """
+    Write a cgroup interface file
+
+    @params
+      path = Required : file path
+      value = Required : value, written as a string
+    @return
+      None
+  """
+  with open(path, 'w') as f:
+    f.write(str(value))
+
+class CGroup:
+
+  root = None # cgroup2 mount point, found once
+
+  def __init__(self, name : str, limits : dict = None):
+    """
+      Describe the group of a process. Nothing is created until start
+
+      @params
+        name = Required : process name
+        limits = Optional : interface file -> value, keys from LIMITS
+      @return
+        None
+    """
+    if CGroup.root is None:
+      CGroup.root = mount_point() or ""
+    self.path = os.path.join(CGroup.root, SLICE, name) if CGroup.root else None
+    self.limits = limits or {}
+
+  def create(self):
+    """
+      Create the slice and the group, enabling the controllers the limits need, and apply the limits
+
+      @return
+        None
+      @raises
+        ProcessHandlerError if cgroup v2 is unavailable or the group cannot be set up
+    """
+    if self.path is None:
+      raise ProcessHandlerError("cgroup v2 is not mounted")
+
+    slice = os.path.dirname(self.path)
+    try:
+      os.makedirs(self.path, exist_ok=True)
+      wanted = {LIMITS[key] for key in self.limits}
+      for parent in (CGroup.root, slice):
+        with open(os.path.join(parent, "cgroup.controllers")) as f:
+          available = set(f.read().split())
+        missing = wanted - available
+        if missing:
+          raise ProcessHandlerError(f"cgroup controllers {sorted(missing)} are not available in {parent}")
+        enable = wanted | (ACCOUNTING & available)
+        if enable:
+          write(os.path.join(parent, "cgroup.subtree_control"), " ".join("+" + c for c in sorted(enable)))
+    except OSError as e:
+      raise ProcessHandlerError(f"Error setting up cgroup {self.path}: {e}")
+
+    self.apply()
+
+  def apply(self, limits : dict = None):
+    """
+      Write the limits, live if the group exists
+
+      @params
+        limits = Optional : new limits, defaults to the current ones
+      @return
+        None
+      @raises
+        ProcessHandlerError if a limit is rejected
+    """
+    if limits is not None:
+      self.limits = limits
+    if self.path is None or not os.path.isdir(self.path):
+      return
+
+    for key, value in self.limits.items():
+      try:
+        write(os.path.join(self.path, key), value)
+      except OSError as e:
+        raise ProcessHandlerError(f"Error setting {key}={value} on cgroup {self.path}: {e}")
+
+  def joiner(self):
+    """
+      A function moving the calling process into the group, for a child to run before exec
+
+      @return
+        (function) function to execute
+    """
+    procs = os.path.join(self.path, "cgroup.procs")
+
+    def func():
+      """wrapper function"""
+      write(procs, 0)
+
+    return func
+
+  def populated(self):
+    """
+      Determine if any process is left in the group
+
+      @return
+        (bool) true if populated
+    """
+    try:
+      with open(os.path.join(self.path, "cgroup.events")) as f:
+        for line in f:
+          key, _, value = line.partition(" ")
+          if key == "populated":
+            return value.strip() == "1"
+    except OSError:
+      pass
+    return False
+
+  async def wait_empty(self, timeout : float):
+    """
+      Wait for every process in the group to exit, checking every 0.1s
+
+      @params
+        timeout = Required : seconds to wait at most
+      @return
+        (bool) true if empty
+    """
+    deadline = time.monotonic() + timeout
+    while self.populated():
+      if time.monotonic() >= deadline:
+        return False
+      await asyncio.sleep(0.1)
+    return True
+
+  def kill(self):
+    """
+      SIGKILL every process in the group
+
+      @return
+        (bool) true if cgroup.kill is supported
+    """
+    try:
+      write(os.path.join(self.path, "cgroup.kill"), 1)
+      return True
+    except OSError:
+      return False
+
+  def pids(self):
+    """
+      Processes in the group
+
+      @return
+        (list) pids
+    """
+    try:
+      with open(os.path.join(self.path, "cgroup.procs")) as f:
+        return [int(line) for line in f if line.strip()]
+    except (OSError, ValueError):
+      return []
+
+  def usage(self):
+    """
+      Resource usage of the whole group. cpu.stat is always there; memory and task counts need their
+      controllers
+
+      @return
+        (dict or None) cpu microseconds, memory bytes, tasks (None if unknown); None if unreadable
+    """
+    try:
+      with open(os.path.join(self.path, "cpu.stat")) as f:
+        usage = {"cpu_usec": next(int(line.split()[1]) for line in f if line.startswith("usage_usec"))}
+    except (OSError, ValueError, StopIteration):
+      return None
+
+    for key, file in (("memory", "memory.current"), ("tasks", "pids.current")):
+      try:
+        with open(os.path.join(self.path, file)) as f:
+          usage[key] = int(f.read())
+      except (OSError, ValueError):
+        usage[key] = None
+    return usage
+
+  def remove(self):
+    """
+      Remove the group once empty
+
+      @return
+        None
+    """
+    try:
+      os.rmdir(self.path)
+    except (OSError, TypeError):
+      pass
@@ -3,9 +3,26 @@
 """
 import os
 import json
+import time
+import hashlib
 from .errors import *
+from .selector import Index
+from .logs import DEFAULTS as LOG_DEFAULTS
+from .policy import DEFAULTS as RESTART_DEFAULTS
+from .scheduler import find_cycle
+from .cgroup import LIMITS as CGROUP_LIMITS
+from .pool import expand, SEPARATOR
+from .placement import validate as validate_placement
+from .activation import parse_address
+from .probes import validate as validate_ready, validate_probes
+from .watchdog import validate as validate_limits
+from .utils.inotify import Inotify, IN_CLOSE_WRITE, IN_MOVED_TO, IN_MOVED_FROM, IN_CREATE, IN_DELETE, IN_IGNORED, IN_ONLYDIR
 import pwd
 
+CONFIG_EVENTS = IN_CLOSE_WRITE | IN_MOVED_TO | IN_MOVED_FROM | IN_CREATE | IN_DELETE
+SCRIPT_EVENTS = IN_MOVED_TO | IN_MOVED_FROM | IN_CREATE | IN_DELETE | IN_ONLYDIR
+CACHE_TTL = 5 # seconds validation results are trusted for when files cannot be watched
+
 class Config():
   
   def __init__(self):
@@ -15,7 +32,17 @@ class Config():
       @return
         None
     """
-    self.file = os.path.expanduser('~/procm_config.json')
+    self.file = os.environ.get('PROCM_CONFIG') or os.path.expanduser('~/procm_config.json')
+    self.config = None
+    self.index = Index() # name, path, label and tag indexes over config['processes']
+    self.stamp = None # (mtime, size, inode) of the config file last read
+    self.digest = None # hash of the config file contents last parsed
+    self.watcher = None
+    self.watches = {} # watch descriptor -> watched directory
+    self.dirty = True # a watched change has not been reloaded yet
+    self.users = {} # validation caches: username -> exists, script path -> is file
+    self.files = {}
+    self.cached_at = time.monotonic()
     self.reload()
 
   def __repr__(self):
@@ -27,33 +54,134 @@ class Config():
     """
     return self.config
 
-  def __match(self, crit : dict, p : dict):
+  def __user_exists(self, user : str):
     """
-      Determine if a process p matches criteria crit
+      Determine if a user exists. Cached until the passwd file changes
 
       @params
-        crit = Required : criteria to match by
-        p = Required : process to check against
+        user = Required : username
       @return
-        (bool) true if process matches
+        (bool) true if user exists
     """
-    return (crit.get('path') and crit.get('path') in p['path']) or (crit.get('name') and crit.get('name') == p['name']) or crit.get('all') == True
-  
-  def __user_exists(self, user : str):
+    if user not in self.users:
+      try:
+        pwd.getpwnam(user)
+        self.users[user] = True
+      except KeyError:
+        self.users[user] = False
+    return self.users[user]
+
+  def __file_exists(self, path : str):
     """
-      Determine if a user exists
+      Determine if a script exists. Cached until its directory changes
 
       @params
-        user = Required : username
+        path = Required : script path
       @return
-        (bool) true if user exists
+        (bool) true if file exists
+    """
+    if path in self.files:
+      return self.files[path]
+
+    exists = os.path.isfile(path)
+    if self.watcher is None or os.path.dirname(path) in self.watches.values():
+      self.files[path] = exists
+    return exists
+
+  def __valid(self, p : dict):
+    """
+      Determine if a process entry can be run
+
+      @params
+        p = Required : process to check
+      @return
+        (bool) true if script and user exist
+    """
+    return self.__file_exists(p['path']) and self.__user_exists(p.get('user', "root"))
+
+  def watch(self):
+    """
+      Start watching the config file, the passwd file, and script directories with inotify. Reloads then
+      cost nothing until a watched file changes
+
+      @return
+        (int or None) file descriptor readable on changes, None if inotify is unavailable
+    """
+    if self.watcher is None:
+      try:
+        self.watcher = Inotify()
+      except OSError:
+        return None
+
+      self.__add_watch(os.path.dirname(self.file), CONFIG_EVENTS)
+      self.__add_watch("/etc", CONFIG_EVENTS)
+      self.__watch_scripts()
+      self.files.clear()
+      self.users.clear()
+
+    return self.watcher.fileno()
+
+  def __add_watch(self, path : str, mask : int):
     """
+      Add an inotify watch, ignoring paths that cannot be watched
+
+      @params
+        path = Required : directory to watch
+        mask = Required : event mask
+      @return
+        (bool) true if watched
+    """
+    if path in self.watches.values():
+      return True
     try:
-      pwd.getpwnam(user)
+      self.watches[self.watcher.add(path, mask)] = path
       return True
-    except KeyError:
+    except OSError:
       return False
 
+  def __watch_scripts(self):
+    """
+      Watch the directories of all configured scripts. Scripts in directories that cannot be watched are
+      not cached
+
+      @return
+        None
+    """
+    for path in {os.path.dirname(p['path']) for p in self.config['processes']}:
+      self.__add_watch(path, SCRIPT_EVENTS)
+
+  def changes(self):
+    """
+      Drain pending inotify events, invalidating whatever they touch
+
+      @return
+        (bool) true if anything relevant changed
+    """
+    changed = False
+
+    for wd, mask, name in self.watcher.read():
+      path = self.watches.get(wd)
+
+      if mask & IN_IGNORED:
+        self.watches.pop(wd, None)
+        continue
+
+      target = os.path.join(path, name)
+
+      if target == self.file:
+        self.dirty = True
+        changed = True
+
+      if target in ("/etc/passwd", "/etc/group"):
+        self.users.clear()
+        changed = True
+
+      if target in self.files:
+        del self.files[target]
+        changed = True
+
+    return changed
+
   def validate(self):
     """
       Determine if config file is valid
@@ -64,6 +192,9 @@ class Config():
     if not 'processes' in self.config:
       raise ConfigFileError("Invalid config file: missing 'processes' key")
 
+    if not isinstance(self.config.get('daemon', {}), dict):
+      raise ConfigFileError("Invalid config file: 'daemon' must be an object")
+
     for process in self.config['processes']:
       # ensure required keys are present  
       keys = ['path', 'status', 'name']
@@ -71,6 +202,12 @@ class Config():
       if len(missing) > 0:
         raise ConfigFileError(f"Invalid config file process item: missing {missing} key in: {process}")
 
+      # ensure names leave room for pool members, and pool sizes are counts
+      if SEPARATOR in str(process['name']):
+        raise ConfigFileError(f"Invalid config file process item: '{SEPARATOR}' is reserved for pool members, in name: {process}")
+      if 'instances' in process and process['instances'] != "auto" and (not isinstance(process['instances'], int) or process['instances'] < 1):
+        raise ConfigFileError(f"Invalid config file process item: instances must be a positive count or \"auto\" in: {process}")
+
       # ensure system users exist
       if 'user' in process and not self.__user_exists(process['user']):
         raise ConfigFileError(f"Invalid config file process item: invalid user {process['user']} specified in: {process}")
@@ -79,24 +216,155 @@ class Config():
       if 'pwd' in process and not os.path.isdir(process['pwd']):
         raise ConfigFileError(f"Invalid config file process item: invalid working directory {process['pwd']} specified in: {process}")
 
+      # ensure labels and tags are flat
+      if not isinstance(process.get('labels', {}), dict) or any(isinstance(v, (dict, list)) for v in process.get('labels', {}).values()):
+        raise ConfigFileError(f"Invalid config file process item: labels must be a key/value object in: {process}")
+      if not isinstance(process.get('tags', []), list) or not all(isinstance(t, str) for t in process.get('tags', [])):
+        raise ConfigFileError(f"Invalid config file process item: tags must be a list of strings in: {process}")
+
+      # ensure restart policy options are known
+      if not isinstance(process.get('restart', {}), dict) or not set(process.get('restart', {})) <= set(RESTART_DEFAULTS):
+        raise ConfigFileError(f"Invalid config file process item: restart must be an object with keys {list(RESTART_DEFAULTS)} in: {process}")
+
+      # ensure dependencies are lists of names and priority a number
+      for key in ('after', 'requires'):
+        if not isinstance(process.get(key, []), list) or not all(isinstance(n, str) for n in process.get(key, [])):
+          raise ConfigFileError(f"Invalid config file process item: {key} must be a list of process names in: {process}")
+      if not isinstance(process.get('priority', 0), int):
+        raise ConfigFileError(f"Invalid config file process item: priority must be an integer in: {process}")
+
+      # ensure environment overrides are flat and the spawn mode is known
+      if not isinstance(process.get('env', {}), dict) or any(isinstance(v, (dict, list)) for v in process.get('env', {}).values()):
+        raise ConfigFileError(f"Invalid config file process item: env must be a key/value object in: {process}")
+      if not isinstance(process.get('env_file', ""), str):
+        raise ConfigFileError(f"Invalid config file process item: env_file must be a path in: {process}")
+      if process.get('spawn', "exec") not in ("exec", "shell"):
+        raise ConfigFileError(f"Invalid config file process item: spawn must be 'exec' or 'shell' in: {process}")
+
+      # ensure the stop grace period is a number
+      if not isinstance(process.get('stop_timeout', 5), (int, float)) or process.get('stop_timeout', 5) < 0:
+        raise ConfigFileError(f"Invalid config file process item: stop_timeout must be a number of seconds in: {process}")
+
+      # ensure cgroup limits are known
+      if not isinstance(process.get('cgroup', False), (bool, dict)) or not set(process['cgroup'] if isinstance(process.get('cgroup'), dict) else {}) <= set(CGROUP_LIMITS):
+        raise ConfigFileError(f"Invalid config file process item: cgroup must be true or an object with keys {list(CGROUP_LIMITS)} in: {process}")
+
+      # ensure placement settings are valid
+      if 'placement' in process and validate_placement(process['placement']):
+        raise ConfigFileError(f"Invalid config file process item: {validate_placement(process['placement'])} in: {process}")
+
+      # ensure socket activation settings are valid
+      if 'sockets' in process:
+        if not isinstance(process['sockets'], list) or not all(isinstance(a, str) for a in process['sockets']):
+          raise ConfigFileError(f"Invalid config file process item: sockets must be a list of addresses in: {process}")
+        try:
+          [parse_address(a) for a in process['sockets']]
+        except ValueError as e:
+          raise ConfigFileError(f"Invalid config file process item: {e} in: {process}")
+        if process.get('spawn') == "shell":
+          raise ConfigFileError(f"Invalid config file process item: sockets need the exec spawn mode in: {process}")
+      if not isinstance(process.get('lazy', True), bool) or not isinstance(process.get('idle_timeout', 0) or 0, (int, float)):
+        raise ConfigFileError(f"Invalid config file process item: lazy must be a boolean and idle_timeout a number of seconds in: {process}")
+
+      # ensure the readiness check is valid
+      if 'ready' in process:
+        error = validate_ready(process['ready'])
+        if error:
+          raise ConfigFileError(f"Invalid config file process item: {error} in: {process}")
+        if 'log' in process['ready'] and process.get('log') is False:
+          raise ConfigFileError(f"Invalid config file process item: a log readiness check needs output capture in: {process}")
+
+      # ensure health probes are valid
+      if 'probes' in process and validate_probes(process['probes']):
+        raise ConfigFileError(f"Invalid config file process item: {validate_probes(process['probes'])} in: {process}")
+
+      # ensure resource limits are valid
+      if 'limits' in process and validate_limits(process['limits']):
+        raise ConfigFileError(f"Invalid config file process item: {validate_limits(process['limits'])} in: {process}")
+
+      # ensure the supervision interval is valid
+      interval = process.get('check_interval', 2)
+      if not isinstance(interval, (int, float)) or isinstance(interval, bool) or interval <= 0:
+        raise ConfigFileError(f"Invalid config file process item: check_interval must be a positive number of seconds in: {process}")
+
+      # ensure output capture options are known
+      if not (process.get('log') in (None, False) or (isinstance(process['log'], dict) and set(process['log']) <= set(LOG_DEFAULTS))):
+        raise ConfigFileError(f"Invalid config file process item: log must be false or an object with keys {list(LOG_DEFAULTS)} in: {process}")
+
+    cycle = find_cycle(self.config['processes'])
+    if cycle:
+      raise ConfigFileError(f"Invalid config file: dependency cycle {' -> '.join(cycle)}")
+
+  def setting(self, key : str, default = None):
+    """
+      Return a service setting from the config's optional 'daemon' object
+
+      @params
+        key = Required : setting name
+        default = Optional : value if unset
+      @return
+        (any) setting
+    """
+    return self.config.get('daemon', {}).get(key, default)
+
   def reload(self):
     """
-      Re-reads the config file and updates config variable
+      Re-reads the config file and updates config variable. The file is only parsed if its stat or
+      content hash changed; when watched it is not even stat'ed until inotify reports a change
 
       @return
-        None
+        (bool) true if the config changed
       @raises
         ConfigFileError is config file is invalid
     """
-    if os.path.isfile(self.file):
-      with open(self.file, 'r') as f:
-        try:
-          self.config = json.load(f)
-          self.validate()
-        except json.decoder.JSONDecodeError as e:
-          raise ConfigFileError(f"Invalid config file: {str(e)}")
-    else:
+    if self.watcher is not None:
+      self.changes()
+      if not self.dirty:
+        return False
+    elif time.monotonic() - self.cached_at > CACHE_TTL:
+      self.files.clear()
+      self.users.clear()
+      self.cached_at = time.monotonic()
+
+    try:
+      st = os.stat(self.file)
+    except FileNotFoundError:
+      changed = self.stamp is not None or self.config is None
+      self.stamp, self.digest, self.dirty = None, None, False
       self.config = {"processes":[]}
+      self.index = Index()
+      return changed
+
+    stamp = (st.st_mtime_ns, st.st_size, st.st_ino)
+    if stamp == self.stamp and not self.dirty:
+      return False
+
+    with open(self.file, 'rb') as f:
+      data = f.read()
+
+    self.stamp, self.dirty = stamp, False
+    digest = hashlib.sha1(data).hexdigest()
+    if digest == self.digest:
+      return False
+
+    try:
+      config = json.loads(data)
+    except ValueError as e:
+      raise ConfigFileError(f"Invalid config file: {str(e)}")
+
+    self.files.clear()
+    previous, self.config = self.config, config
+    try:
+      self.validate()
+    except ConfigFileError:
+      self.config = previous if previous is not None else {"processes":[]}
+      raise
+
+    self.digest = digest
+    self.index = Index(self.config['processes'])
+    if self.watcher is not None:
+      self.__watch_scripts()
+    return True
 
   def write(self):
     """
@@ -117,7 +385,7 @@ class Config():
       @return
         (bool) true if exists
     """
-    return any([process['name'] == proc['name'] for process in self.config['processes']])
+    return self.index.get(proc['name']) is not None
 
   def append_proc(self, proc : dict):
     """
@@ -135,6 +403,7 @@ class Config():
       if len(missing) == 0:
         if os.path.isfile(proc['path']):
           self.config['processes'].append(proc)
+          self.index.add(proc)
           self.write()
           return True
         return "ERROR: Script does not exist"
@@ -148,15 +417,16 @@ class Config():
       Deletes a process by given criteria
 
       @params
-        criteria = Required : either path or name defined
+        criteria = Required : any of all, name (glob), path (partial path), select (selector expression)
       @return 
         (list) deleted procs
     """
-    removed = [l for l in self.config['processes'] if not self.__match(criteria, l) ]
-
     c = self.get_procs(criteria)
-    
-    self.config['processes'] = removed
+
+    for proc in self.index.match(criteria):
+      self.index.remove(proc['name'])
+
+    self.config['processes'] = [l for l in self.config['processes'] if self.index.get(l['name']) is l]
     self.write()
     return c
 
@@ -165,45 +435,55 @@ class Config():
       Toggles process statuses by given criteria
 
       @params
-        criteria = Required : either path or name defined
+        criteria = Required : any of all, name (glob), path (partial path), select (selector expression)
         status = Required : enable / disable
       @return 
         (int) modified procs
     """
-    c = 0 
-    
-    for i in range(len(self.config['processes'])):
-      if self.__match(criteria, self.config['processes'][i]):
-        self.config['processes'][i]['status'] = status
-        c += 1
+    procs = self.index.match(criteria)
+
+    for proc in procs:
+      proc['status'] = status
 
     self.write()
 
-    return c
+    return len(procs)
       
   def get_procs(self, criteria : dict):
     """
       Returns processes by given criteria, only valid ones
 
       @params
-        criteria = Required : either path or name defined
+        criteria = Required : any of all, name (glob), path (partial path), select (selector expression)
       @return 
         (dict) process data
     """
-    possible_procs = [ l for l in self.config['processes'] if self.__match(criteria, l) ]
-    return  [ p for p in possible_procs if (os.path.isfile(p['path']) and self.__user_exists(p.get('user', "root"))) ]
+    possible_procs = self.index.match(criteria)
+    return  [ p for p in possible_procs if self.__valid(p) ]
+
+  def get_members(self, criteria : dict):
+    """
+      Returns the valid processes matching criteria with pools expanded into their members. Criteria
+      may name a whole pool or a single member
+
+      @params
+        criteria = Required : any of all, name (glob), path (partial path), select (selector expression)
+      @return
+        (list) process data
+    """
+    return Index([m for p in self.get_procs({"all": True}) for m in expand(p)]).match(criteria)
 
   def get_broken_procs(self, criteria : dict):
     """
       Returns processes by given criteria, only broken (no file) ones
 
       @params
-        criteria = Required : either path or name defined
+        criteria = Required : any of all, name (glob), path (partial path), select (selector expression)
       @return 
         (dict) process data
     """
-    possible_procs = [ l for l in self.config['processes'] if self.__match(criteria, l) ]
-    return  [ p for p in possible_procs if not os.path.isfile(p['path']) or not self.__user_exists(p.get('user', "root")) ]
+    possible_procs = self.index.match(criteria)
+    return  [ p for p in possible_procs if not self.__valid(p) ]
     
         
         
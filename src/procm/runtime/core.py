@@ -2,29 +2,64 @@ from .errors import *
 from .config import *
 from .process import *
 from .socket import *
+from .utils.proctable import scan_procs
+from .pool import expand
+from . import status
 
 config = Config()
 socket = Socket()
 
-def fetch_processes():
+def fetch_processes(crit : dict = None):
   """
     Retrieves and returns the status of working process listed in config file
 
+    @params
+      crit = Optional : criteria to filter by, defaults to all
     @return
       (list) proccess objects
   """
   config.reload()
-  return [Process(**proc) for proc in config.get_procs({"all": True})]
+  pids = scan_procs()
+  return [Process(**proc, pids=pids) for proc in config.get_members(crit or {"all": True})]
 
-def fetch_broken_processes():
+def fetch_broken_processes(crit : dict = None):
   """
     Retrieves and returns the status of broken process listed in config file
 
+    @params
+      crit = Optional : criteria to filter by, defaults to all
     @return
       (list) proccess objects
   """
   config.reload()
-  return [Process(**proc) for proc in config.get_broken_procs({"all": True})]
+  pids = scan_procs()
+  return [Process(**member, pids=pids) for proc in config.get_broken_procs(crit or {"all": True}) for member in expand(proc)]
+
+def list_processes(crit : dict = None):
+  """
+    Rows for the valid and broken processes matching the criteria. Live state is read from the
+    service's shared status table, falling back to scanning the process table if there is none
+
+    @params
+      crit = Optional : criteria to filter by, defaults to all
+    @return
+      (list, list) rows of valid processes, rows of broken processes
+  """
+  table = status.read()
+  if table is None:
+    return [list(p) for p in fetch_processes(crit)], [list(p) for p in fetch_broken_processes(crit)]
+
+  config.reload()
+  crit = crit or {"all": True}
+  rows = []
+
+  for proc in config.get_members(crit):
+    state = table['processes'].get(proc['name'], {"running": False, "health": "", "restarts": 0, "exit_code": None, "placement": ""})
+    rows.append([proc['name'], proc['path'], "Enabled" if proc['status'] else "Disabled", proc.get('runtime', "/usr/bin/python3"),
+                 proc.get('pwd'), proc.get('user', "root"), state['running'], state['health'], state['restarts'], state['exit_code'], state['placement']])
+
+  broken = [list(p) for p in fetch_broken_processes(crit)] if len(config.get_broken_procs(crit)) > 0 else []
+  return rows, broken
 
 def append_process(proc : dict):
   """
@@ -38,46 +73,60 @@ def append_process(proc : dict):
   append = config.append_proc(proc)
   
   if append == True:
-    socket.send("r")
+    socket.request("reload")
     return "Successfully added process"
   else:
     return append
 
+def _errors(replies : list):
+  """
+    Collect the error messages of failed replies
+
+    @params
+      replies = Required : reply dicts
+    @return
+      (list) error messages
+  """
+  return [r['error'] for r in replies if not r['ok']]
+
 def delete_processes(proc : dict):
   """
-    Deletes a process from config, stops process, and calls service mon reload
+    Deletes a process from config, stops process, and calls service mon reload. The stops and the
+    reload are pipelined over one connection
 
     @params
       proc = Required : dictionary/criteria for process deletion
     @return
-      (int) number of delete processes
+      (int, list) number of deleted processes, error messages
   """
   deleted = config.delete_proc(proc)
 
-  for proc in deleted:
-    socket.send(f"stop {proc['name']}")
-    
-  socket.send("r")
-  return len(deleted)
+  with socket.connect() as conn:
+    if len(deleted) > 0:
+      conn.send_batch([("stop", {"name": proc['name']}) for proc in deleted])
+    conn.send("reload")
+    replies = [conn.recv() for _ in range(2 if len(deleted) > 0 else 1)]
 
+  stops = replies[0]['results'] if len(deleted) > 0 else []
+  return len(deleted), _errors(stops + replies[-1:])
 
 def manage_processes(proc : dict, action : str):
   """
-    Manages each process match the criteria
+    Manages each process (or pool member) matching the criteria, as one batch request
 
     @params
       proc = Required : dictionary/criteria for process start
       action = Required : action 
     @return
-      (int) number of processes managed
+      (int, list) number of processes managed, error messages
   """
-  procs = config.get_procs(proc)
-  
-  for proc in procs:
-    if action in ["start", "stop", "restart"]:
-      socket.send(f"{action} {proc['name']}")
+  procs = config.get_members(proc)
 
-  return len(procs)
+  if action not in ["start", "stop", "restart"] or len(procs) == 0:
+    return 0, []
+
+  results = socket.batch([(action, {"name": proc['name']}) for proc in procs])['results']
+  return len(results) - len(_errors(results)), _errors(results)
 
 def manage_all_processes(action : str):
   """
@@ -86,10 +135,24 @@ def manage_all_processes(action : str):
     @params
       action = Required : action 
     @return
-      None
+      (list) error messages
   """
   if action in ["start", "stop", "restart"]:
-    socket.send(f"{action}-all")
+    return _errors([socket.request(f"{action}-all")])
+  return []
+
+def rolling_restart(crit : dict, batch : int = 1):
+  """
+    Replace the processes (or pool members) matching the criteria, or all enabled ones, without a gap
+
+    @params
+      crit = Required : criteria to match by, all enabled processes if empty
+      batch = Optional : processes replaced at once
+    @return
+      (int, list) number of processes replaced, error messages
+  """
+  response = socket.request("rolling-restart", **{k: v for k, v in crit.items() if v}, batch=batch)
+  return (len(response['result']['names']), []) if response['ok'] else (0, _errors([response]))
 
 def toggle_processes(proc : dict, action : bool):
   """
@@ -102,5 +165,50 @@ def toggle_processes(proc : dict, action : bool):
       (int) procs affected
   """
   mod = config.toggle_proc(proc, action)
-  socket.send("r")
+  socket.request("reload")
   return mod
+
+def stream_logs(name : str, lines : int, follow : bool, stream : str = "stdout"):
+  """
+    Stream a process's captured output from the service
+
+    @params
+      name = Required : process name
+      lines = Required : number of trailing lines to send first
+      follow = Required : keep streaming new output until interrupted
+      stream = Optional : stdout or stderr
+    @return
+      (generator) chunks of output
+    @raises
+      ProcessHandlerError if the service rejects the request
+  """
+  with socket.connect() as conn:
+    response = conn.call("logs", name=name, lines=lines, follow=follow, stream=stream)
+    if not response['ok']:
+      raise ProcessHandlerError(response['error'])
+    yield from conn.recv_stream()
+
+def fetch_stats(crit : dict = None):
+  """
+    Resource usage of the processes matching the criteria, as sampled by the service
+
+    @params
+      crit = Optional : criteria to filter by, defaults to all
+    @return
+      (dict) name -> {"current", "fields", "fine", "coarse"}, or None if not sampled yet
+    @raises
+      ProcessHandlerError if the service rejects the request
+  """
+  response = socket.request("stats", **(crit or {}))
+  if not response['ok']:
+    raise ProcessHandlerError(response['error'])
+  return response['result']
+
+def fetch_metrics():
+  """
+    The service's self metrics
+
+    @return
+      (string) Prometheus text exposition
+  """
+  return socket.request("metrics")['result']
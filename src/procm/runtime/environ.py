@@ -0,0 +1,188 @@
+"""
+  Process environments: a per-user environment built once from the user's profile, plus per-process
+  env_file and env overrides
+"""
+import os
+import pwd
+import asyncio
+import subprocess
+from .errors import *
+from .utils.command import credentials
+
+PROFILE = ".bash_profile"
+SKIP = {"_", "PWD", "OLDPWD", "SHLVL"} # set by the shell that dumped the environment
+BUILD_TIMEOUT = 10 # seconds a profile may take to source
+
+def base(user : str):
+  """
+    The service's environment adjusted for a user, as drop_perms does
+
+    @params
+      user = Required : username
+    @return
+      (dict) environment
+  """
+  pwdu = pwd.getpwnam(user)
+  env = dict(os.environ, HOME=pwdu.pw_dir, LOGNAME=user, USER=user, USERNAME=user)
+  env.pop('MAIL', None)
+  return env
+
+def parse_env_file(data : str):
+  """
+    Parse KEY=VALUE lines. Blank lines and comments are skipped, an 'export ' prefix and matching quotes
+    around the value are removed
+
+    @params
+      data = Required : file contents
+    @return
+      (dict) variables
+  """
+  env = {}
+  for line in data.splitlines():
+    line = line.strip()
+    if not line or line.startswith("#") or "=" not in line:
+      continue
+    if line.startswith("export "):
+      line = line[len("export "):].lstrip()
+    key, value = line.split("=", 1)
+    value = value.strip()
+    if len(value) >= 2 and value[0] == value[-1] and value[0] in "'\"":
+      value = value[1:-1]
+    env[key.strip()] = value
+  return env
+
+def stamp(path : str):
+  """
+    Identify a file's version
+
+    @params
+      path = Required : file path
+    @return
+      (tuple or None) (mtime, size, inode), None if missing
+  """
+  try:
+    st = os.stat(path)
+  except OSError:
+    return None
+  return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+class Environments:
+
+  def __init__(self):
+    """
+      Initialize empty caches
+
+      @return
+        None
+    """
+    self.users = {} # username -> (profile stamp, environment)
+    self.files = {} # env_file path -> (stamp, variables)
+
+  def __profile(self, user : str):
+    """
+      Path of a user's profile
+
+      @params
+        user = Required : username
+      @return
+        (string) path
+    """
+    return os.path.join(pwd.getpwnam(user).pw_dir, PROFILE)
+
+  def fresh(self, user : str, env_file : str = None, profile : bool = True):
+    """
+      Determine if building an environment would be served from the caches
+
+      @params
+        see build
+      @return
+        (bool) true if cached and unchanged
+    """
+    if profile and (user not in self.users or self.users[user][0] != stamp(self.__profile(user))):
+      return False
+    return env_file is None or (env_file in self.files and self.files[env_file][0] == stamp(env_file))
+
+  def user(self, user : str):
+    """
+      Environment of a login shell of a user: the profile is sourced once, and again only after it
+      changes. Blocking
+
+      @params
+        user = Required : username
+      @return
+        (dict) environment, not to be modified
+    """
+    version = stamp(self.__profile(user))
+    if user in self.users and self.users[user][0] == version:
+      return self.users[user][1]
+
+    env = base(user)
+    if version is not None:
+      try:
+        result = subprocess.run(["bash", "-c", f"source ~/{PROFILE} >/dev/null 2>&1; env -0"], env=env,
+                                stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                cwd=env['HOME'] if os.path.isdir(env['HOME']) else "/", timeout=BUILD_TIMEOUT, **credentials(user))
+        pairs = [item.split("=", 1) for item in result.stdout.decode(errors="replace").split("\0") if "=" in item]
+        env = {k: v for k, v in pairs if k not in SKIP}
+      except (OSError, subprocess.SubprocessError):
+        pass # profile unusable, run with the base environment
+
+    self.users[user] = (version, env)
+    return env
+
+  def file(self, path : str):
+    """
+      Variables of an env file, re-read after it changes. Blocking
+
+      @params
+        path = Required : env file path
+      @return
+        (dict) variables, not to be modified
+      @raises
+        ProcessHandlerError if the file cannot be read
+    """
+    version = stamp(path)
+    if path in self.files and self.files[path][0] == version:
+      return self.files[path][1]
+
+    try:
+      with open(path) as f:
+        env = parse_env_file(f.read())
+    except OSError as e:
+      raise ProcessHandlerError(f"Error reading env file {path}: {e}")
+
+    self.files[path] = (version, env)
+    return env
+
+  def build(self, user : str, env : dict = None, env_file : str = None, profile : bool = True):
+    """
+      Environment of a process. Blocking when a cache is stale
+
+      @params
+        user = Required : username to run as
+        env = Optional : variables set last
+        env_file = Optional : file of variables, applied before env
+        profile = Optional : include the variables of the user's profile, otherwise just the base environment
+      @return
+        (dict) environment
+    """
+    result = dict(self.user(user) if profile else base(user))
+    if env_file is not None:
+      result.update(self.file(env_file))
+    result.update({k: str(v) for k, v in (env or {}).items()})
+    return result
+
+  async def async_build(self, user : str, env : dict = None, env_file : str = None, profile : bool = True):
+    """
+      build, off the event loop unless it can be served from the caches
+
+      @params
+        see build
+      @return
+        (dict) environment
+    """
+    if self.fresh(user, env_file, profile):
+      return self.build(user, env, env_file, profile)
+    return await asyncio.get_event_loop().run_in_executor(None, self.build, user, env, env_file, profile)
+
+environments = Environments()
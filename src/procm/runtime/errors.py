@@ -14,4 +14,16 @@ class ProcessHandlerError(Exception):
   """
     Error launching process
   """
-  pass
\ No newline at end of file
+  pass
+
+class SelectorError(Exception):
+  """
+    Invalid process selector
+  """
+  pass
+
+class ProtocolError(Exception):
+  """
+    Malformed control socket message
+  """
+  pass
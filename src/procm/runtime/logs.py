@@ -0,0 +1,400 @@
+"""
+  Capture of process output into rotating log files
+
+  Output is read from pipes owned by the service into a bounded buffer per stream, and written to disk
+  in batches on a writer thread. Rotated segments are compressed on a separate thread. If the disk
+  falls behind, new output is dropped (and counted) instead of blocking the event loop or the child.
+"""
+import os
+import gzip
+import mmap
+import time
+import shutil
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from .protocol import Stream, chunk_header, MAX_FRAME
+
+LOG_DIR = os.environ.get("PROCM_LOG_DIR", "/var/log/procm")
+
+DEFAULTS = {
+  "max_bytes": 10 * 1024 * 1024, # rotate when a segment reaches this size
+  "rotate_interval": None, # or rotate after this many seconds
+  "keep": 5, # rotated segments kept per stream
+  "buffer": 1024 * 1024, # bytes buffered per stream before output is dropped
+  "flush_interval": 0.5, # seconds output is batched for before it is written
+}
+FLUSH_BYTES = 64 * 1024 # flush early once this much is buffered
+FOLLOW_CHUNKS = 256 # chunks a follower may fall behind by before it is disconnected
+
+writer_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="procm-log")
+compress_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="procm-gzip")
+
+def log_path(name : str, stream : str):
+  """
+    Path of the live log segment of a process stream
+
+    @params
+      name = Required : process name
+      stream = Required : stdout or stderr
+    @return
+      (string) path
+  """
+  return os.path.join(LOG_DIR, f"{name}.{'out' if stream == 'stdout' else 'err'}.log")
+
+class LogWriter:
+
+  def __init__(self, path : str, options : dict = None):
+    """
+      Initialize a writer for one stream
+
+      @params
+        path = Required : live segment path
+        options = Optional : overrides of DEFAULTS
+      @return
+        None
+    """
+    self.path = path
+    self.options = dict(DEFAULTS, **(options or {}))
+    self.buffer = bytearray()
+    self.dropped = 0 # bytes dropped since the last flush
+    self.dropped_total = 0
+    self.file = None
+    self.size = 0
+    self.opened_at = None
+    self.flush_task = None
+    self.timer = None
+    self.committed = None # size of the live segment as of the last completed write
+    self.followers = set() # queues receiving each chunk once it is written
+
+  def configure(self, options : dict = None):
+    """
+      Apply new options, effective from the next write
+
+      @params
+        options = Optional : overrides of DEFAULTS
+      @return
+        None
+    """
+    self.options = dict(DEFAULTS, **(options or {}))
+
+  async def drain(self, reader : asyncio.StreamReader, tap = None):
+    """
+      Read a pipe until EOF, buffering its output. Never waits on the disk
+
+      @params
+        reader = Required : child's stdout or stderr
+        tap = Optional : function also given each chunk read, e.g. to watch for a readiness line
+      @return
+        None
+    """
+    while True:
+      data = await reader.read(65536)
+      if not data:
+        break
+      self.feed(data)
+      if tap is not None:
+        tap(data)
+
+  def feed(self, data : bytes):
+    """
+      Buffer output, dropping what does not fit
+
+      @params
+        data = Required : output
+      @return
+        None
+    """
+    room = self.options['buffer'] - len(self.buffer)
+    if len(data) > room:
+      self.dropped += len(data) - max(room, 0)
+      data = data[:max(room, 0)]
+    self.buffer += data
+
+    if len(self.buffer) >= FLUSH_BYTES:
+      self.__flush_now()
+    elif self.timer is None and self.flush_task is None:
+      self.timer = asyncio.get_event_loop().call_later(self.options['flush_interval'], self.__flush_now)
+
+  def __flush_now(self):
+    """ start a flush unless one is running; a running flush picks up new output when it is done """
+    if self.timer is not None:
+      self.timer.cancel()
+      self.timer = None
+    if self.flush_task is None:
+      self.flush_task = asyncio.get_event_loop().create_task(self.flush())
+
+  async def flush(self):
+    """
+      Write buffered output on the writer thread until the buffer is empty
+
+      @return
+        None
+    """
+    try:
+      while len(self.buffer) > 0 or self.dropped > 0:
+        chunk = bytes(self.buffer)
+        self.buffer.clear()
+        if self.dropped > 0:
+          chunk += f"\n[procm: dropped {self.dropped} bytes of output]\n".encode()
+          self.dropped_total += self.dropped
+          self.dropped = 0
+        try:
+          await asyncio.get_event_loop().run_in_executor(writer_pool, self.write, chunk)
+        except OSError:
+          self.dropped_total += len(chunk) # e.g. disk full, the next flush retries
+          break
+        self.committed = self.size
+        self.__broadcast(chunk)
+    finally:
+      self.flush_task = None
+
+  def __broadcast(self, chunk : bytes):
+    """ hand a written chunk to every follower, disconnecting followers that fell too far behind """
+    for queue in list(self.followers):
+      try:
+        queue.put_nowait(chunk)
+      except asyncio.QueueFull:
+        self.unfollow(queue)
+        while not queue.empty():
+          queue.get_nowait()
+        queue.put_nowait(None)
+
+  async def sync(self):
+    """
+      Write out everything buffered so far
+
+      @return
+        None
+    """
+    if len(self.buffer) > 0 or self.dropped > 0:
+      self.__flush_now()
+    if self.flush_task is not None:
+      await self.flush_task
+
+  def snapshot(self, follow : bool = False):
+    """
+      Open the live segment and note how much of it is written. Anything written later is delivered to
+      the returned queue instead, so a reader gets no gaps or duplicates. Must not be awaited between
+      sync() and reading the segment
+
+      @params
+        follow = Optional : also subscribe to new output
+      @return
+        (file or None, int, asyncio.Queue or None) open segment, bytes of it to read, follower queue
+    """
+    try:
+      f = open(self.path, 'rb')
+      size = os.fstat(f.fileno()).st_size
+      end = min(self.committed, size) if self.committed is not None else size
+    except FileNotFoundError:
+      f, end = None, 0
+
+    queue = None
+    if follow:
+      queue = asyncio.Queue(FOLLOW_CHUNKS)
+      self.followers.add(queue)
+    return f, end, queue
+
+  def unfollow(self, queue : asyncio.Queue):
+    """
+      Unsubscribe a follower
+
+      @params
+        queue = Required : queue returned by snapshot
+      @return
+        None
+    """
+    self.followers.discard(queue)
+
+  def write(self, chunk : bytes):
+    """
+      Append to the live segment, rotating first if needed. Runs on the writer thread
+
+      @params
+        chunk = Required : data to write
+      @return
+        None
+    """
+    if self.file is None:
+      os.makedirs(os.path.dirname(self.path), exist_ok=True)
+      self.file = open(self.path, 'ab')
+      self.size = self.file.tell()
+      self.opened_at = time.time()
+
+    interval = self.options['rotate_interval']
+    if self.size > 0 and (self.size + len(chunk) > self.options['max_bytes'] or (interval and time.time() - self.opened_at > interval)):
+      self.rotate()
+      return self.write(chunk)
+
+    self.file.write(chunk)
+    self.file.flush()
+    self.size += len(chunk)
+
+  def rotate(self):
+    """
+      Close the live segment and move it aside under a timestamped name, queueing its compression.
+      Runs on the writer thread
+
+      @return
+        None
+    """
+    self.file.close()
+    self.file = None
+    segment = f"{self.path}.{time.strftime('%Y%m%d-%H%M%S')}.{int(time.time() * 1e6) % 1000000:06d}"
+    os.rename(self.path, segment)
+    compress_pool.submit(compress, segment, self.path, self.options['keep'])
+
+  def segments(self):
+    """
+      Rotated segments of this stream, oldest first
+
+      @return
+        (list) paths
+    """
+    directory, base = os.path.split(self.path)
+    try:
+      return sorted(os.path.join(directory, f) for f in os.listdir(directory) if f.startswith(base + "."))
+    except FileNotFoundError:
+      return []
+
+  async def close(self):
+    """
+      Flush and close the live segment
+
+      @return
+        None
+    """
+    self.__flush_now()
+    if self.flush_task is not None:
+      await self.flush_task
+    for queue in list(self.followers):
+      self.unfollow(queue)
+      queue.put_nowait(None)
+    if self.file is not None:
+      await asyncio.get_event_loop().run_in_executor(writer_pool, self.file.close)
+      self.file = None
+
+def tail_offset(f, end : int, lines : int):
+  """
+    Offset of the start of the last lines of a file, found through a read only mapping
+
+    @params
+      f = Required : open file
+      end = Required : bytes of the file to consider
+      lines = Required : number of lines
+    @return
+      (int) offset
+  """
+  if end == 0 or lines <= 0:
+    return end
+
+  with mmap.mmap(f.fileno(), end, prot=mmap.PROT_READ) as m:
+    pos = end - 1 if m[end - 1] == ord("\n") else end
+    for _ in range(lines):
+      pos = m.rfind(b"\n", 0, pos)
+      if pos < 0:
+        return 0
+    return pos + 1
+
+class LogStream(Stream):
+
+  def __init__(self, writer : LogWriter, lines : int, follow : bool):
+    """
+      Stream the tail of a log, and optionally follow it
+
+      @params
+        writer = Required : log writer of the stream
+        lines = Required : number of lines to backfill
+        follow = Required : keep streaming new output
+      @return
+        None
+    """
+    self.writer = writer
+    self.lines = lines
+    self.follow = follow
+    self.file, self.end, self.queue = None, 0, None
+    self.meta = {"path": writer.path, "follow": follow}
+
+  async def open(self):
+    """
+      Flush pending output and take the snapshot to stream from
+
+      @return
+        (LogStream) self
+    """
+    await self.writer.sync()
+    self.file, self.end, self.queue = self.writer.snapshot(self.follow)
+    return self
+
+  async def send(self, r : asyncio.StreamReader, w : asyncio.StreamWriter):
+    """
+      Send the backfill straight from the segment with sendfile, then followed output as it is written
+
+      @params
+        r = Required : connection streamreader
+        w = Required : connection streamwriter
+      @return
+        None
+    """
+    loop = asyncio.get_event_loop()
+
+    if self.file is not None:
+      offset = await loop.run_in_executor(None, tail_offset, self.file, self.end, self.lines)
+      while offset < self.end:
+        count = min(self.end - offset, MAX_FRAME)
+        w.write(chunk_header(count))
+        await w.drain()
+        await loop.sendfile(w.transport, self.file, offset, count)
+        offset += count
+
+    if self.queue is None:
+      return
+
+    gone = loop.create_task(r.read(1)) # any input or EOF from the client ends the stream
+    try:
+      while True:
+        get = loop.create_task(self.queue.get())
+        await asyncio.wait([get, gone], return_when=asyncio.FIRST_COMPLETED)
+        if not get.done():
+          get.cancel()
+          return
+
+        chunk = get.result()
+        if chunk is None:
+          return
+        w.write(chunk_header(len(chunk)) + chunk)
+        await w.drain()
+    finally:
+      gone.cancel()
+
+  async def close(self):
+    """
+      Close the segment and unsubscribe
+
+      @return
+        None
+    """
+    if self.queue is not None:
+      self.writer.unfollow(self.queue)
+    if self.file is not None:
+      self.file.close()
+
+def compress(segment : str, path : str, keep : int):
+  """
+    gzip a rotated segment and prune old ones. Runs on the compression thread
+
+    @params
+      segment = Required : rotated segment
+      path = Required : live segment path the rotated segments belong to
+      keep = Required : number of rotated segments to keep
+    @return
+      None
+  """
+  with open(segment, 'rb') as src, gzip.open(segment + ".gz", 'wb') as dst:
+    shutil.copyfileobj(src, dst)
+  os.remove(segment)
+
+  directory, base = os.path.split(path)
+  rotated = sorted(f for f in os.listdir(directory) if f.startswith(base + ".") and f.endswith(".gz"))
+  for f in rotated[:max(len(rotated) - keep, 0)]:
+    os.remove(os.path.join(directory, f))
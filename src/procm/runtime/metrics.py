@@ -0,0 +1,256 @@
+"""
+  Per-process resource metrics
+
+  All managed pids are sampled in one pass per interval, straight from procfs (cpu, memory and threads
+  from the cgroup instead for processes that have one, covering their descendants). Each process keeps
+  a fixed size history: a fine ring of recent samples, and a coarse ring of averages of the fine samples
+  for longer retention. Rings are flat arrays of doubles, so memory per process is constant.
+"""
+import os
+import time
+from array import array
+
+FIELDS = ["time", "cpu", "rss", "threads", "fds", "read_bytes", "write_bytes"]
+CLK_TCK = os.sysconf("SC_CLK_TCK")
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+INTERVAL = 5 # seconds between samples
+FINE = 120 # fine samples kept: 10 minutes
+FACTOR = 60 # fine samples averaged into one coarse sample: 5 minutes
+COARSE = 288 # coarse samples kept: 24 hours
+
+def read_proc(pid : int):
+  """
+    Read the raw counters of a process
+
+    @params
+      pid = Required : process id
+    @return
+      (dict or None) cpu ticks, rss, threads, fds, io bytes; None if the process is gone
+  """
+  try:
+    with open(f"/proc/{pid}/stat", 'rb') as f:
+      stat = f.read()
+    # fields after the command name, which may itself contain spaces and parentheses
+    fields = stat[stat.rindex(b")") + 2:].split()
+    sample = {"ticks": int(fields[11]) + int(fields[12]), "threads": int(fields[17]), "rss": int(fields[21]) * PAGE_SIZE}
+  except (OSError, ValueError, IndexError):
+    return None
+
+  try:
+    sample['fds'] = len(os.listdir(f"/proc/{pid}/fd"))
+  except OSError:
+    sample['fds'] = 0
+
+  sample['read_bytes'] = sample['write_bytes'] = 0
+  try:
+    with open(f"/proc/{pid}/io", 'rb') as f:
+      for line in f:
+        key, _, value = line.partition(b":")
+        if key in (b"read_bytes", b"write_bytes"):
+          sample[key.decode()] = int(value)
+  except (OSError, ValueError):
+    pass
+
+  return sample
+
+def read_cgroup(counters : dict, cgroup):
+  """
+    Replace a process's cpu, memory and thread counters with those of its whole cgroup
+
+    @params
+      counters = Required : counters from read_proc
+      cgroup = Required : CGroup of the process
+    @return
+      None
+  """
+  usage = cgroup.usage()
+  if usage is None:
+    return
+  counters['ticks'] = usage['cpu_usec'] * CLK_TCK / 1e6
+  if usage['memory'] is not None:
+    counters['rss'] = usage['memory']
+  if usage['tasks'] is not None:
+    counters['threads'] = usage['tasks']
+
+def sample(pids : dict, cgroups : dict = None):
+  """
+    Read the counters of many processes in one pass. Blocking, meant for an executor
+
+    @params
+      pids = Required : name -> pid
+      cgroups = Optional : name -> CGroup, for processes whose usage is accounted by cgroup
+    @return
+      (dict) name -> raw counters, for processes that still exist
+  """
+  now = time.monotonic()
+  raw = {}
+  for name, pid in pids.items():
+    counters = read_proc(pid)
+    if counters is not None:
+      if cgroups and name in cgroups:
+        read_cgroup(counters, cgroups[name])
+      counters['pid'], counters['at'] = pid, now
+      raw[name] = counters
+  return raw
+
+class Ring:
+
+  def __init__(self, capacity : int, width : int = len(FIELDS)):
+    """
+      Fixed capacity ring of rows of doubles
+
+      @params
+        capacity = Required : rows kept
+        width = Optional : values per row
+      @return
+        None
+    """
+    self.capacity = capacity
+    self.width = width
+    self.data = array('d', bytes(8 * capacity * width))
+    self.count = 0 # rows ever pushed
+
+  def push(self, row : list):
+    """
+      Append a row, overwriting the oldest once full
+
+      @params
+        row = Required : width values
+      @return
+        None
+    """
+    start = (self.count % self.capacity) * self.width
+    self.data[start:start + self.width] = array('d', row)
+    self.count += 1
+
+  def rows(self, n : int = None):
+    """
+      Return the last n rows, oldest first
+
+      @params
+        n = Optional : number of rows, defaults to all kept
+      @return
+        (list) rows
+    """
+    n = min(self.count, self.capacity, self.count if n is None else n)
+    out = []
+    for i in range(self.count - n, self.count):
+      start = (i % self.capacity) * self.width
+      out.append(self.data[start:start + self.width].tolist())
+    return out
+
+class History:
+
+  def __init__(self):
+    """
+      Fine and coarse sample history of one process
+
+      @return
+        None
+    """
+    self.fine = Ring(FINE)
+    self.coarse = Ring(COARSE)
+    self.sums = array('d', bytes(8 * len(FIELDS)))
+    self.summed = 0
+    self.last = None # previous raw counters, to turn cpu ticks into a rate
+
+  def add(self, raw : dict, now : float):
+    """
+      Record a raw sample
+
+      @params
+        raw = Required : counters from read_proc
+        now = Required : wall time of the sample
+      @return
+        (dict) the derived sample
+    """
+    cpu = 0.0
+    if self.last is not None and self.last['pid'] == raw['pid'] and raw['at'] > self.last['at']:
+      cpu = 100.0 * (raw['ticks'] - self.last['ticks']) / CLK_TCK / (raw['at'] - self.last['at'])
+    self.last = raw
+
+    row = [now, cpu, raw['rss'], raw['threads'], raw['fds'], raw['read_bytes'], raw['write_bytes']]
+    self.fine.push(row)
+
+    for i, value in enumerate(row):
+      self.sums[i] += value
+    self.summed += 1
+    if self.summed == FACTOR:
+      self.coarse.push([value / FACTOR for value in self.sums])
+      self.sums = array('d', bytes(8 * len(FIELDS)))
+      self.summed = 0
+
+    return dict(zip(FIELDS, row))
+
+  def current(self):
+    """
+      @return
+        (dict or None) latest sample
+    """
+    rows = self.fine.rows(1)
+    return dict(zip(FIELDS, rows[0])) if rows else None
+
+class Metrics:
+
+  def __init__(self):
+    """
+      Histories of all processes, by name
+
+      @return
+        None
+    """
+    self.histories = {}
+
+  def record(self, raw : dict):
+    """
+      Record the result of sample()
+
+      @params
+        raw = Required : name -> raw counters
+      @return
+        None
+    """
+    now = time.time()
+    for name, counters in raw.items():
+      if name not in self.histories:
+        self.histories[name] = History()
+      self.histories[name].add(counters, now)
+
+  def current(self, name : str):
+    """
+      Latest sample of a process
+
+      @params
+        name = Required : process name
+      @return
+        (dict or None) sample
+    """
+    history = self.histories.get(name)
+    return history.current() if history else None
+
+  def forget(self, name : str):
+    """
+      Drop the history of a removed process
+
+      @params
+        name = Required : process name
+      @return
+        None
+    """
+    self.histories.pop(name, None)
+
+  def report(self, name : str, points : int = 30):
+    """
+      Current values and short histories of a process, for the stats command
+
+      @params
+        name = Required : process name
+        points = Optional : history rows of each resolution
+      @return
+        (dict or None) {"current": sample, "fields": FIELDS, "fine": rows, "coarse": rows}
+    """
+    history = self.histories.get(name)
+    if history is None:
+      return None
+    return {"current": history.current(), "fields": FIELDS, "fine": history.fine.rows(points), "coarse": history.coarse.rows(points)}
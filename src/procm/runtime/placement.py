@@ -0,0 +1,253 @@
+"""
+  CPU affinity, NUMA placement and scheduling policies
+
+  A process's "placement" config is resolved to concrete settings once per start and applied by the
+  child before exec, so everything it spawns inherits them:
+    cpus   : list of CPUs or a cpulist string ("0-3,8"), or "auto" to pin each pool member to its own CPU,
+             spread round robin across NUMA nodes
+    numa   : node number, or "auto" to spread pool members across nodes
+    nice   : nice level
+    sched  : "other", "batch" or "idle"
+    ionice : "idle", "best-effort[:level]" or "realtime[:level]"
+"""
+import os
+import glob
+import ctypes
+import platform
+
+SCHED = {"other": os.SCHED_OTHER, "batch": os.SCHED_BATCH, "idle": os.SCHED_IDLE}
+IOPRIO_CLASS = {"realtime": 1, "best-effort": 2, "idle": 3}
+IOPRIO_CLASS_SHIFT = 13
+IOPRIO_WHO_PROCESS = 1
+SYS_IOPRIO = {"x86_64": (251, 252), "aarch64": (30, 31), "i686": (289, 290), "armv7l": (314, 315)} # set, get
+KEYS = ["cpus", "numa", "nice", "sched", "ionice"]
+libc = ctypes.CDLL(None, use_errno=True)
+MACHINE = platform.machine()
+
+def parse_cpulist(text : str):
+  """
+    Parse a kernel cpulist such as "0-3,8,10-11"
+
+    @params
+      text = Required : cpulist
+    @return
+      (list) sorted CPU numbers
+  """
+  cpus = set()
+  for part in text.strip().split(","):
+    if not part:
+      continue
+    first, _, last = part.partition("-")
+    cpus.update(range(int(first), int(last or first) + 1))
+  return sorted(cpus)
+
+def format_cpulist(cpus):
+  """
+    Format CPU numbers as a compact cpulist
+
+    @params
+      cpus = Required : CPU numbers
+    @return
+      (string) cpulist
+  """
+  ranges = []
+  for cpu in sorted(cpus):
+    if ranges and cpu == ranges[-1][1] + 1:
+      ranges[-1][1] = cpu
+    else:
+      ranges.append([cpu, cpu])
+  return ",".join(str(a) if a == b else f"{a}-{b}" for a, b in ranges)
+
+_nodes = None
+
+def nodes():
+  """
+    CPUs of each NUMA node the service may run on, read once
+
+    @return
+      (dict) node -> sorted CPU numbers
+  """
+  global _nodes
+  if _nodes is None:
+    allowed = os.sched_getaffinity(0)
+    _nodes = {}
+    for path in glob.glob("/sys/devices/system/node/node[0-9]*/cpulist"):
+      try:
+        with open(path) as f:
+          cpus = [cpu for cpu in parse_cpulist(f.read()) if cpu in allowed]
+      except (OSError, ValueError):
+        continue
+      if cpus:
+        _nodes[int(path.split("/")[-2][4:])] = cpus
+    if not _nodes:
+      _nodes = {0: sorted(allowed)}
+  return _nodes
+
+def parse_ionice(value : str):
+  """
+    Parse an ionice setting
+
+    @params
+      value = Required : "class" or "class:level"
+    @return
+      (int) ioprio value
+    @raises
+      ValueError on an unknown class or level
+  """
+  name, _, level = value.partition(":")
+  level = int(level or 4)
+  if name not in IOPRIO_CLASS or not 0 <= level <= 7:
+    raise ValueError(f"invalid ionice {value}")
+  return IOPRIO_CLASS[name] << IOPRIO_CLASS_SHIFT | (0 if name == "idle" else level)
+
+def validate(placement : dict):
+  """
+    Check a placement config
+
+    @params
+      placement = Required : placement config
+    @return
+      (string or None) error message, None if valid
+  """
+  if not isinstance(placement, dict) or not set(placement) <= set(KEYS):
+    return f"placement must be an object with keys {KEYS}"
+  try:
+    cpus = placement.get('cpus')
+    if isinstance(cpus, str) and cpus != "auto":
+      parse_cpulist(cpus)
+    elif cpus is not None and cpus != "auto" and not (isinstance(cpus, list) and all(isinstance(c, int) for c in cpus)):
+      return "placement cpus must be a list, a cpulist or auto"
+    if placement.get('numa') not in (None, "auto") and not isinstance(placement['numa'], int):
+      return "placement numa must be a node number or auto"
+    if not isinstance(placement.get('nice', 0), int) or not -20 <= placement.get('nice', 0) <= 19:
+      return "placement nice must be between -20 and 19"
+    if placement.get('sched', "other") not in SCHED:
+      return f"placement sched must be one of {list(SCHED)}"
+    if 'ionice' in placement:
+      parse_ionice(placement['ionice'])
+  except (ValueError, TypeError) as e:
+    return f"placement: {e}"
+  return None
+
+class Placement:
+
+  def __init__(self, config : dict, instance : int = None):
+    """
+      Resolve a placement config for one process
+
+      @params
+        config = Required : placement config
+        instance = Optional : pool member index, for automatic spreading
+      @return
+        None
+    """
+    topology = nodes()
+    cpus = None
+
+    numa = config.get('numa')
+    if numa == "auto" and instance is not None:
+      numa = sorted(topology)[instance % len(topology)]
+    if isinstance(numa, int) and numa in topology:
+      cpus = set(topology[numa])
+
+    wanted = config.get('cpus')
+    if wanted == "auto" and instance is not None:
+      node = topology[numa] if isinstance(numa, int) and numa in topology else None
+      if node is None:
+        ordered = sorted(topology)
+        node = topology[ordered[instance % len(ordered)]]
+        instance //= len(ordered)
+      cpus = {node[instance % len(node)]}
+    elif isinstance(wanted, str) and wanted != "auto":
+      cpus = set(parse_cpulist(wanted)) & cpus if cpus else set(parse_cpulist(wanted))
+    elif isinstance(wanted, list):
+      cpus = set(wanted) & cpus if cpus else set(wanted)
+
+    self.cpus = cpus or None
+    self.nice = config.get('nice')
+    self.sched = config.get('sched')
+    self.ionice = parse_ionice(config['ionice']) if 'ionice' in config else None
+
+  def __bool__(self):
+    return any(v is not None for v in (self.cpus, self.nice, self.sched, self.ionice))
+
+  def apply(self, pid : int = 0):
+    """
+      Apply the placement to a thread, 0 for the calling one. Meant to run in the child before exec
+
+      @params
+        pid = Optional : thread id
+      @return
+        None
+    """
+    if self.cpus:
+      os.sched_setaffinity(pid, self.cpus)
+    if self.nice is not None:
+      os.setpriority(os.PRIO_PROCESS, pid, self.nice)
+    if self.sched is not None:
+      os.sched_setscheduler(pid, SCHED[self.sched], os.sched_param(0))
+    if self.ionice is not None:
+      ioprio(pid, self.ionice)
+
+  def preexec(self):
+    """
+      @return
+        (function) function applying the placement, for a child to run before exec
+    """
+    def func():
+      """wrapper function"""
+      self.apply(0)
+
+    return func
+
+def ioprio(pid : int, value : int = None):
+  """
+    Set or get the I/O priority of a thread. There is no libc wrapper, so the syscall is made directly
+
+    @params
+      pid = Required : thread id, 0 for the calling one
+      value = Optional : ioprio value to set, get if None
+    @return
+      (int or None) ioprio value, None if unsupported
+  """
+  numbers = SYS_IOPRIO.get(MACHINE)
+  if numbers is None:
+    return None
+  if value is None:
+    result = libc.syscall(numbers[1], IOPRIO_WHO_PROCESS, pid)
+  else:
+    result = libc.syscall(numbers[0], IOPRIO_WHO_PROCESS, pid, value)
+  if result < 0:
+    errno = ctypes.get_errno()
+    raise OSError(errno, os.strerror(errno))
+  return result
+
+def effective(pid : int):
+  """
+    Read back the placement a process actually runs with
+
+    @params
+      pid = Required : process id
+    @return
+      (string) summary, e.g. "cpu 0-3, nice 10, batch, io idle"
+  """
+  parts = []
+  try:
+    cpus = os.sched_getaffinity(pid)
+    if cpus != os.sched_getaffinity(0):
+      parts.append(f"cpu {format_cpulist(cpus)}")
+    nice = os.getpriority(os.PRIO_PROCESS, pid)
+    if nice != 0:
+      parts.append(f"nice {nice}")
+    policy = os.sched_getscheduler(pid)
+    parts += [name for name, value in SCHED.items() if value == policy and name != "other"]
+    value = ioprio(pid)
+    if value:
+      name = next((n for n, c in IOPRIO_CLASS.items() if c == value >> IOPRIO_CLASS_SHIFT), None)
+      if name == "idle":
+        parts.append("io idle")
+      elif name:
+        parts.append(f"io {name}:{value & 0x7}")
+  except OSError:
+    pass
+  return ", ".join(parts)
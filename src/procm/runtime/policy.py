@@ -0,0 +1,109 @@
+"""
+  Restart policy: exponential backoff for crash loops, and a restart budget per time window
+"""
+import time
+import random
+from collections import deque
+
+DEFAULTS = {
+  "backoff": 1, # seconds before the second quick restart, doubled for each one after
+  "max_backoff": 60, # cap on the backoff
+  "jitter": 0.2, # +/- fraction applied to the backoff, so crash loops do not synchronize
+  "reset_after": 30, # seconds of uptime after which an exit is no longer part of a crash loop
+  "max_restarts": 10, # restarts allowed per window before the process is FATAL
+  "window": 300, # seconds
+}
+HISTORY = 20 # exits kept per process
+
+class RestartPolicy:
+
+  def __init__(self, options : dict = None):
+    """
+      Initialize the policy of one process
+
+      @params
+        options = Optional : overrides of DEFAULTS
+      @return
+        None
+    """
+    self.configure(options)
+    self.failures = 0 # consecutive exits after less than reset_after seconds of uptime
+    self.restarts = deque() # monotonic times of restarts inside the window
+    self.history = deque(maxlen=HISTORY) # recent exits: wall time, exit code, uptime
+
+  def configure(self, options : dict = None):
+    """
+      Apply new options
+
+      @params
+        options = Optional : overrides of DEFAULTS
+      @return
+        None
+    """
+    self.options = dict(DEFAULTS, **(options or {}))
+
+  def reset(self):
+    """
+      Forget the crash loop and restart budget, e.g. on a manual start
+
+      @return
+        None
+    """
+    self.failures = 0
+    self.restarts.clear()
+
+  def snapshot(self):
+    """
+      State to carry over a restart of the service. Restart times are monotonic, which holds until reboot
+
+      @return
+        (dict) failures, restart times and exit history
+    """
+    return {"failures": self.failures, "restarts": list(self.restarts), "history": list(self.history)}
+
+  def restore(self, state : dict):
+    """
+      Pick up the state of a previous service
+
+      @params
+        state = Required : result of snapshot
+      @return
+        None
+    """
+    self.failures = state.get('failures', 0)
+    self.restarts = deque(state.get('restarts', []))
+    self.history = deque(state.get('history', []), maxlen=HISTORY)
+
+  def recent(self):
+    """
+      Determine if the process exited recently, i.e. within reset_after seconds
+
+      @return
+        (bool) true if it did
+    """
+    return len(self.history) > 0 and time.time() - self.history[-1]['time'] < self.options['reset_after']
+
+  def exited(self, exit_code : int, uptime : float):
+    """
+      Record an exit and decide when to restart
+
+      @params
+        exit_code = Required : exit status, None if unknown
+        uptime = Required : seconds the process ran for
+      @return
+        (float or None) seconds to wait before restarting, None if the restart budget is spent
+    """
+    self.history.append({"time": time.time(), "exit_code": exit_code, "uptime": uptime})
+    self.failures = 1 if uptime >= self.options['reset_after'] else self.failures + 1
+
+    now = time.monotonic()
+    while self.restarts and now - self.restarts[0] > self.options['window']:
+      self.restarts.popleft()
+    if len(self.restarts) >= self.options['max_restarts']:
+      return None
+    self.restarts.append(now)
+
+    if self.failures <= 1:
+      return 0 # restart right away unless it is crash looping
+    delay = min(self.options['backoff'] * 2 ** (self.failures - 2), self.options['max_backoff'])
+    return delay * (1 + random.uniform(-self.options['jitter'], self.options['jitter']))
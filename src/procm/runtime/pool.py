@@ -0,0 +1,42 @@
+"""
+  Worker pools: a config entry with "instances": N (or "auto", one per CPU) is managed as N member
+  processes named <name>@0 ... <name>@N-1. Each member gets PROCM_INSTANCE and PROCM_POOL_SIZE in its
+  environment
+"""
+import os
+
+SEPARATOR = "@"
+
+def size(spec : dict):
+  """
+    Number of members of a pool entry
+
+    @params
+      spec = Required : config entry
+    @return
+      (int or None) members, None if the entry is not a pool
+  """
+  instances = spec.get('instances')
+  if instances is None:
+    return None
+  if instances == "auto":
+    return os.cpu_count() or 1
+  return int(instances)
+
+def expand(spec : dict):
+  """
+    The process entries a config entry stands for
+
+    @params
+      spec = Required : config entry
+    @return
+      (list) the entry itself, or one entry per pool member
+  """
+  n = size(spec)
+  if n is None:
+    return [spec]
+
+  base = {key: value for key, value in spec.items() if key != 'instances'}
+  return [dict(base, name=f"{spec['name']}{SEPARATOR}{i}", pool=spec['name'], instance=i,
+               env=dict(spec.get('env') or {}, PROCM_INSTANCE=str(i), PROCM_POOL_SIZE=str(n)))
+          for i in range(n)]
@@ -0,0 +1,405 @@
+"""
+  Readiness checks and health probes
+
+  A process's "ready" config says how a freshly started child shows it is ready to take over, which a
+  rolling restart waits for before stopping the old one:
+    notify : true, the child sends "READY=1" to the datagram socket in $NOTIFY_SOCKET (sd_notify)
+    log    : regular expression matched against each line the child writes to stdout or stderr
+    tcp    : "PORT" or "HOST:PORT" accepting connections
+    http   : "PORT/path", "HOST:PORT/path" or "http://HOST:PORT/path" answering a GET with 2xx or 3xx
+    exec   : shell command exiting 0, run as the process's user
+    timeout: seconds to wait at most, 30 by default
+  Without one, a child is taken as ready once it has kept running for a second, or once its readiness
+  probe passes if it has one.
+
+  Its "probes" config checks a running child periodically: "liveness" restarts it after 'failures'
+  consecutive failed checks, and "readiness" is reported in its status. Each has one of tcp, http or exec,
+  and an interval, a timeout per check, a failure threshold and a delay after start, in seconds.
+"""
+import os
+import re
+import pwd
+import shlex
+import socket
+import signal
+import asyncio
+from .errors import *
+from .utils.command import async_spawn
+from .status import RUN_DIR
+
+KINDS = ["notify", "log", "tcp", "http", "exec"]
+PROBE_KINDS = ["tcp", "http", "exec"]
+PROBE_DEFAULTS = {"interval": 10, "timeout": 1, "failures": 3, "delay": 0}
+PROBES = ["liveness", "readiness"]
+TIMEOUT = 30 # seconds a child has to become ready by default
+SETTLE = 1 # seconds a child without a readiness check has to keep running
+RETRY = 0.5 # seconds between tcp, http and exec attempts
+NOTIFY_DIR = os.path.join(RUN_DIR, "notify")
+
+def parse_tcp(target):
+  """
+    Parse a tcp probe target
+
+    @params
+      target = Required : "PORT" or "HOST:PORT", or a port number
+    @return
+      (string, int) host, port
+    @raises
+      ValueError on an invalid target
+  """
+  host, _, port = str(target).rpartition(":")
+  if not port.isdigit() or not 0 < int(port) < 65536:
+    raise ValueError(f"invalid tcp target {target}")
+  return host.strip("[]") or "127.0.0.1", int(port)
+
+def parse_http(target : str):
+  """
+    Parse an http probe target
+
+    @params
+      target = Required : "PORT/path", "HOST:PORT/path" or "http://HOST:PORT/path"
+    @return
+      (string, int, string) host, port, path
+    @raises
+      ValueError on an invalid target
+  """
+  if target.startswith("http://"):
+    target = target[len("http://"):]
+  address, slash, path = target.partition("/")
+  host, port = parse_tcp(address)
+  return host, port, slash + path or "/"
+
+def parse_target(kind : str, target):
+  """
+    Check the target of a tcp, http or exec check
+
+    @params
+      kind = Required : check kind
+      target = Required : its target
+    @raises
+      ValueError or TypeError on an invalid target
+  """
+  if kind == "tcp":
+    parse_tcp(target)
+  elif kind == "http":
+    parse_http(target)
+  elif kind == "exec" and not isinstance(target, str):
+    raise TypeError("exec must be a command")
+
+def validate(ready : dict):
+  """
+    Check a readiness config
+
+    @params
+      ready = Required : readiness config
+    @return
+      (string or None) error message, None if valid
+  """
+  if not isinstance(ready, dict) or not set(ready) <= set(KINDS + ["timeout"]):
+    return f"ready must be an object with one of {KINDS} and an optional timeout"
+  if len([kind for kind in KINDS if kind in ready]) != 1:
+    return f"ready needs exactly one of {KINDS}"
+  if not isinstance(ready.get('timeout', TIMEOUT), (int, float)) or ready.get('timeout', TIMEOUT) <= 0:
+    return "ready timeout must be a positive number of seconds"
+  try:
+    if 'log' in ready:
+      re.compile(ready['log'])
+    for kind in PROBE_KINDS:
+      if kind in ready:
+        parse_target(kind, ready[kind])
+  except (re.error, ValueError, TypeError) as e:
+    return f"ready: {e}"
+  if 'notify' in ready and ready['notify'] is not True:
+    return "ready notify must be true"
+  return None
+
+def validate_probes(probes : dict):
+  """
+    Check a probes config
+
+    @params
+      probes = Required : probes config
+    @return
+      (string or None) error message, None if valid
+  """
+  if not isinstance(probes, dict) or not set(probes) <= set(PROBES):
+    return f"probes must be an object with keys {PROBES}"
+  for name, probe in probes.items():
+    if not isinstance(probe, dict) or not set(probe) <= set(PROBE_KINDS + list(PROBE_DEFAULTS)):
+      return f"{name} probe must be an object with one of {PROBE_KINDS} and {list(PROBE_DEFAULTS)}"
+    kinds = [kind for kind in PROBE_KINDS if kind in probe]
+    if len(kinds) != 1:
+      return f"{name} probe needs exactly one of {PROBE_KINDS}"
+    try:
+      parse_target(kinds[0], probe[kinds[0]])
+    except (ValueError, TypeError) as e:
+      return f"{name} probe: {e}"
+    for key in PROBE_DEFAULTS:
+      value = probe.get(key, PROBE_DEFAULTS[key])
+      if not isinstance(value, (int, float)) or isinstance(value, bool) or value < 0 or (value == 0 and key != "delay"):
+        return f"{name} probe {key} must be a positive number"
+    if not isinstance(probe.get('failures', 1), int):
+      return f"{name} probe failures must be a count"
+  return None
+
+async def tcp(host : str, port : int, timeout : float):
+  """
+    Check that a port accepts connections
+
+    @params
+      host = Required : host
+      port = Required : port
+      timeout = Required : seconds to wait at most
+    @return
+      (bool) true if a connection was accepted
+  """
+  try:
+    _, w = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+    w.close()
+    return True
+  except (OSError, asyncio.TimeoutError):
+    return False
+
+async def http(host : str, port : int, path : str, timeout : float):
+  """
+    Check that a GET on an HTTP endpoint succeeds
+
+    @params
+      host = Required : host
+      port = Required : port
+      path = Required : request path
+      timeout = Required : seconds to wait at most
+    @return
+      (bool) true if the status is 2xx or 3xx
+  """
+  async def get():
+    r, w = await asyncio.open_connection(host, port)
+    try:
+      w.write(f"GET {path} HTTP/1.0\r\nHost: {host}:{port}\r\nUser-Agent: procm\r\n\r\n".encode())
+      return (await r.readline()).split()
+    finally:
+      w.close()
+
+  try:
+    status = await asyncio.wait_for(get(), timeout)
+  except (OSError, asyncio.TimeoutError):
+    return False
+  return len(status) >= 2 and status[1].isdigit() and 200 <= int(status[1]) < 400
+
+async def command(cmd : str, timeout : float, user : str = "root", cwd : str = None):
+  """
+    Run a check command, killing its process group if it takes too long
+
+    @params
+      cmd = Required : shell command
+      timeout = Required : seconds to wait at most
+      user = Optional : user to run as
+      cwd = Optional : working directory
+    @return
+      (bool) true if it exited 0
+  """
+  try:
+    proc = await async_spawn(f"bash -c {shlex.quote(cmd)}", cwd, user)
+  except (OSError, ProcessHandlerError):
+    return False
+  try:
+    return await asyncio.wait_for(proc.wait(), timeout) == 0
+  except asyncio.TimeoutError:
+    try:
+      os.killpg(proc.pid, signal.SIGKILL)
+    except ProcessLookupError:
+      pass
+    await proc.wait()
+    return False
+
+async def check(kind : str, target, timeout : float, user : str = "root", cwd : str = None):
+  """
+    Run one tcp, http or exec check
+
+    @params
+      kind = Required : check kind
+      target = Required : its target
+      timeout = Required : seconds to wait at most
+      user = Optional : user exec checks run as
+      cwd = Optional : working directory of exec checks
+    @return
+      (bool) true if it passed
+  """
+  if kind == "tcp":
+    return await tcp(*parse_tcp(target), timeout)
+  if kind == "http":
+    return await http(*parse_http(target), timeout)
+  return await command(target, timeout, user, cwd)
+
+class Probe:
+
+  def __init__(self, spec : dict):
+    """
+      State of one periodic probe of a process
+
+      @params
+        spec = Required : probe config
+      @return
+        None
+    """
+    self.spec = spec
+    self.config = dict(PROBE_DEFAULTS, **spec)
+    self.kind = next(kind for kind in PROBE_KINDS if kind in spec)
+    self.pid = None # child the results are about
+    self.failures = 0 # consecutive failed checks
+    self.passing = None # result of the last check, None before the first
+
+  def watch(self, pid : int):
+    """
+      Follow a child, starting over if it is not the one checked so far
+
+      @params
+        pid = Required : pid of the running child, or None
+      @return
+        (bool) true if it is a new child
+    """
+    if pid == self.pid:
+      return False
+    self.pid, self.failures, self.passing = pid, 0, None
+    return True
+
+  async def check(self, user : str = "root", cwd : str = None):
+    """
+      Check the child once
+
+      @params
+        user = Optional : user exec checks run as
+        cwd = Optional : working directory of exec checks
+      @return
+        (bool) true if it passed
+    """
+    return await check(self.kind, self.config[self.kind], self.config['timeout'], user, cwd)
+
+  def record(self, passed : bool):
+    """
+      Count a result
+
+      @params
+        passed = Required : result of a check
+      @return
+        (bool) true once the failure threshold is reached
+    """
+    self.passing = passed
+    self.failures = 0 if passed else self.failures + 1
+    return self.failures >= self.config['failures']
+
+class Readiness:
+
+  def __init__(self, config : dict, name : str, user : str = "root", cwd : str = None):
+    """
+      Prepare to wait for one child of a process to become ready. A notify socket is bound right away,
+      so it exists before the child starts
+
+      @params
+        config = Required : readiness config
+        name = Required : process name
+        user = Optional : user the process runs as, which owns the notify socket and runs exec checks
+        cwd = Optional : working directory of exec checks
+      @return
+        None
+    """
+    self.config = config
+    self.user = user
+    self.cwd = cwd
+    self.kind = next((kind for kind in KINDS if kind in config), None)
+    self.timeout = config.get('timeout', TIMEOUT if self.kind else SETTLE)
+    self.ready = asyncio.get_event_loop().create_future()
+    self.pattern = re.compile(config['log'].encode()) if 'log' in config else None
+    self.partial = b"" # output after the last newline
+    self.sock = None
+    self.path = None
+
+    if config.get('notify'):
+      os.makedirs(NOTIFY_DIR, exist_ok=True)
+      self.path = os.path.join(NOTIFY_DIR, f"{name}.{os.getpid()}.{id(self)}.sock")
+      self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+      self.sock.bind(self.path)
+      if user != "root":
+        pwdu = pwd.getpwnam(user)
+        os.chown(self.path, pwdu.pw_uid, pwdu.pw_gid)
+      self.sock.setblocking(False)
+      asyncio.get_event_loop().add_reader(self.sock, self.__notified)
+
+  def env(self):
+    """
+      @return
+        (dict) variables the child needs to report readiness
+    """
+    return {"NOTIFY_SOCKET": self.path} if self.path else {}
+
+  def __notified(self):
+    """ read notify datagrams until READY=1 """
+    try:
+      message = self.sock.recv(4096)
+    except OSError:
+      return
+    if b"READY=1" in message.split(b"\n") and not self.ready.done():
+      self.ready.set_result(True)
+
+  def tap(self, data : bytes):
+    """
+      Look for the log pattern in a chunk of the child's output
+
+      @params
+        data = Required : output
+      @return
+        None
+    """
+    if self.pattern is None or self.ready.done():
+      return
+    lines = (self.partial + data).split(b"\n")
+    self.partial = lines.pop()[-65536:]
+    if any(self.pattern.search(line) for line in lines):
+      self.ready.set_result(True)
+
+  async def __poll(self):
+    """ retry the tcp, http or exec check until it passes """
+    while True:
+      if await check(self.kind, self.config[self.kind], self.timeout if self.kind == "exec" else RETRY * 2, self.user, self.cwd):
+        return True
+      await asyncio.sleep(RETRY)
+
+  async def wait(self, child : asyncio.subprocess.Process):
+    """
+      Wait for the child to become ready
+
+      @params
+        child = Required : child handle
+      @return
+        (string or None) why it is not ready, None if it is
+    """
+    waiting = [asyncio.ensure_future(child.wait())]
+    if self.kind is not None:
+      waiting.append(asyncio.ensure_future(self.ready if self.kind in ("notify", "log") else self.__poll()))
+    try:
+      done, _ = await asyncio.wait(waiting, timeout=self.timeout, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+      for future in waiting:
+        future.cancel()
+
+    if self.kind is not None and waiting[1] in done:
+      return None
+    if waiting[0] in done:
+      return f"exited with {child.returncode} before it was ready"
+    return None if self.kind is None else f"not ready after {self.timeout}s"
+
+  def close(self):
+    """
+      Remove the notify socket
+
+      @return
+        None
+    """
+    if self.sock is not None:
+      asyncio.get_event_loop().remove_reader(self.sock)
+      self.sock.close()
+      self.sock = None
+      try:
+        os.remove(self.path)
+      except OSError:
+        pass
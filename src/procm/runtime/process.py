@@ -1,9 +1,19 @@
-from .utils.command import exec_shell, async_exec_shell
-import os, signal, psutil, time, asyncio
+from .utils.command import async_spawn, async_exec, async_wait_pid, async_wait_group
+from .environ import environments
+from .cgroup import CGroup
+from .placement import Placement, effective
+from .activation import shim
+from .probes import Readiness, Probe
+from .errors import *
+from .utils.proctable import scan_procs, check_pid, start_time
+from .logs import LogWriter, log_path
+from . import telemetry
+from .policy import RestartPolicy
+import os, signal, time, shlex, asyncio
 
 class Process:
 
-  def __init__(self, name : str, path : str, status : bool, runtime : str = "/usr/bin/python3",  pwd : str = None, user : str = "root"):
+  def __init__(self, name : str, path : str, status : bool, runtime : str = "/usr/bin/python3",  pwd : str = None, user : str = "root", labels : dict = None, tags : list = None, log = None, restart : dict = None, after : list = None, requires : list = None, priority : int = 0, env : dict = None, env_file : str = None, spawn : str = "exec", stop_timeout : float = 5, cgroup = None, pool : str = None, instance : int = None, placement : dict = None, sockets : list = None, lazy : bool = True, idle_timeout : float = None, ready : dict = None, probes : dict = None, limits : dict = None, check_interval : float = 2, pids : dict = None, state : dict = None):
     """
       Initialize variables
 
@@ -13,6 +23,61 @@ class Process:
         runtime = Optional : runtime executor, defaults to python3
         pwd = Optional : script runtime working directory, defaults to None
         user = Optional : system username to run process as
+        labels = Optional : key/value labels for selectors
+        tags = Optional : tags for selectors
+        log = Optional : output capture options (see logs.DEFAULTS), or false to discard output
+        restart = Optional : restart policy options (see policy.DEFAULTS)
+        after = Optional : names of processes to start before this one (and stop after it)
+        requires = Optional : like after, and this one is not started if they fail to start
+        priority = Optional : among processes ready to start or stop, higher goes first
+        env = Optional : environment variables, applied over env_file and the user's profile
+        env_file = Optional : file of KEY=VALUE lines
+        spawn = Optional : "exec" to run the runtime directly, or "shell" to exec it from a login bash
+        stop_timeout = Optional : seconds the process group gets to exit after a stop signal before SIGKILL
+        cgroup = Optional : true, or cgroup limits (see cgroup.LIMITS), to run in a cgroup of its own
+        pool = Optional : name of the pool this process is a member of
+        instance = Optional : index of this process in its pool
+        placement = Optional : CPU, NUMA and scheduling settings (see placement module)
+        sockets = Optional : addresses the service listens on and passes to the process (see activation module)
+        lazy = Optional : with sockets, start on the first connection rather than right away
+        idle_timeout = Optional : with lazy, seconds without CPU use after which the process is stopped
+        ready = Optional : how a new child shows it is ready, for rolling restarts (see probes module)
+        probes = Optional : periodic liveness and readiness checks (see probes module)
+        limits = Optional : resource limits enforced by restarting (see watchdog module)
+        check_interval = Optional : seconds between supervision checks, before backing off (see supervisor module)
+        pids = Optional : name -> pid index from scan_procs, to avoid a scan per process
+        state = Optional : state saved by a previous service (see snapshot), adopted instead of polling
+      @return
+        None
+    """
+    self.logs = {} # stream -> LogWriter
+    self.policy = RestartPolicy(restart)
+    self.cgroup = None
+    self.probes = {} # liveness / readiness -> Probe
+    self.listeners = [] # listening sockets held by the service for this process
+    self.configure(name, path, status, runtime, pwd, user, labels, tags, log, restart, after, requires, priority, env, env_file, spawn, stop_timeout, cgroup, pool, instance, placement, sockets, lazy, idle_timeout, ready, probes, limits, check_interval)
+    self.running = False
+    self.proc = None # asyncio handle when the child is owned by this interpreter
+    self.exit_code = None
+    self.restarts = 0
+    self.started_at = None # wall time of the last start by this interpreter
+    self.placed = "" # placement the process was last seen running with
+    self.on_exit = None # coroutine function called with self when an owned child exits
+    self.replacing = False # a rolling restart is starting a new child next to this one
+    self.on_change = None # function called with self when the running state changes
+    self.pid_start = None # start time of pid, see proctable.start_time
+    if state is not None:
+      self.restore(state)
+    else:
+      self.poll(pids)
+
+  def configure(self, name : str, path : str, status : bool, runtime : str = "/usr/bin/python3",  pwd : str = None, user : str = "root", labels : dict = None, tags : list = None, log = None, restart : dict = None, after : list = None, requires : list = None, priority : int = 0, env : dict = None, env_file : str = None, spawn : str = "exec", stop_timeout : float = 5, cgroup = None, pool : str = None, instance : int = None, placement : dict = None, sockets : list = None, lazy : bool = True, idle_timeout : float = None, ready : dict = None, probes : dict = None, limits : dict = None, check_interval : float = 2):
+    """
+      Apply config values, leaving runtime state (child handle, running status) untouched. Changes to
+      the command take effect the next time the process starts
+
+      @params
+        see __init__
       @return
         None
     """
@@ -20,10 +85,72 @@ class Process:
     self.file = path
     self.proc_stat = status
     self.inter = runtime
-    self.running = False
     self.pwd = pwd
     self.user = user
-    self.poll()
+    self.labels = labels or {}
+    self.tags = tags or []
+    self.log = log
+    for writer in self.logs.values():
+      writer.configure(log or None)
+    self.policy.configure(restart)
+    self.after = after or []
+    self.requires = requires or []
+    self.priority = priority
+    self.env = env or {}
+    self.env_file = env_file
+    self.spawn = spawn
+    self.stop_timeout = stop_timeout
+    self.pool = pool
+    self.instance = instance
+    self.placement = placement or {}
+    self.sockets = sockets or []
+    self.lazy = lazy and len(self.sockets) > 0
+    self.idle_timeout = idle_timeout
+    self.ready = ready
+    self.limits = limits or {}
+    self.check_interval = check_interval
+    self.configure_cgroup(cgroup)
+    self.probes = {name: self.probes[name] if name in self.probes and self.probes[name].spec == spec else Probe(spec)
+                   for name, spec in (probes or {}).items()} # unchanged probes keep their state
+
+  def configure_cgroup(self, cgroup):
+    """
+      Set up, change, or drop the cgroup. Limits of an existing group change live
+
+      @params
+        cgroup = Required : true, limits, or false/None for no cgroup
+      @return
+        None
+    """
+    limits = cgroup if isinstance(cgroup, dict) else {}
+    if not cgroup:
+      self.cgroup = None
+    elif self.cgroup is None or self.cgroup.path != CGroup(self.name).path:
+      self.cgroup = CGroup(self.name, limits)
+    elif self.cgroup.limits != limits:
+      try:
+        self.cgroup.apply(limits)
+      except ProcessHandlerError as e:
+        print(e)
+
+  def health(self):
+    """
+      Summarize the probe results of the running child
+
+      @return
+        (string) "failing" if liveness checks fail, "ready" or "unready" from the readiness probe,
+        "healthy" if the liveness probe passes, "" if unknown
+    """
+    if self.running != True:
+      return ""
+    liveness, readiness = self.probes.get('liveness'), self.probes.get('readiness')
+    if liveness is not None and liveness.pid == self.pid and liveness.failures > 0:
+      return "failing"
+    if readiness is not None and readiness.pid == self.pid and readiness.passing is not None:
+      return "ready" if readiness.passing else "unready"
+    if liveness is not None and liveness.pid == self.pid and liveness.passing:
+      return "healthy"
+    return ""
 
   def __repr__(self):
     """
@@ -32,7 +159,7 @@ class Process:
       @return
         (dict) process path, status, run status, and runtime
     """
-    return str({"name":self.name, "path": self.file, "status": self.proc_stat, "runtime": self.inter, "running": self.running, "pwd": self.pwd, "user": self.user})
+    return str({"name":self.name, "path": self.file, "status": self.proc_stat, "runtime": self.inter, "running": self.running, "pwd": self.pwd, "user": self.user, "exit_code": self.exit_code, "restarts": self.restarts})
 
   def __iter__(self):
     """
@@ -42,43 +169,235 @@ class Process:
         (list) dict keys
     """
     enabled = "Enabled" if self.proc_stat else "Disabled"
-    return iter([self.name, self.file, enabled, self.inter, self.pwd, self.user, self.running])
+    return iter([self.name, self.file, enabled, self.inter, self.pwd, self.user, self.running, self.health(), self.restarts, self.exit_code, self.placed])
 
-  def poll(self):
+  def poll(self, pids : dict = None):
     """
       Determine if a process is running, refreshes variables
 
+      @params
+        pids = Optional : name -> pid index from scan_procs. Scans the process table if not given
       @return
         (bool) running
     """
-    if psutil.pid_exists(getattr(self, 'pid', -1)):
-      return self.pid
-    
-    pid = exec_shell(f"pidof -s procm_p_{self.name}")
+    if self.owned():
+      return True
 
-    self.running = (not pid == "") if self.running != "STOPPED" else self.running
-    self.pid = -1 if pid == "" else int(pid)
+    if pids is None:
+      pids = scan_procs()
 
-    return (not pid == "")
+    pid = pids.get(self.name, -1)
+    previous = (self.running, getattr(self, 'pid', None))
 
-  async def __block_til_stopped(self):
+    self.running = (pid != -1) if self.running in (True, False) else self.running
+    if pid != getattr(self, 'pid', None) and pid > 0:
+      self.placed = effective(pid)
+      self.pid_start = start_time(pid)
+    self.pid = pid
+
+    if previous != (self.running, self.pid):
+      self.changed()
+
+    return pid != -1
+
+  def snapshot(self):
     """
-      Wait 5 seconds for process to stop. If not stopped, then kill it with SIGKILL
+      Runtime state to carry over a restart of the service
 
+      @return
+        (dict) pid and its start time, running state, restart count and history
+    """
+    running = False if self.running == "BACKOFF" else self.running # the backoff wait dies with the service
+    return {"pid": self.pid, "start_time": self.pid_start, "running": running, "restarts": self.restarts,
+            "exit_code": self.exit_code, "started_at": self.started_at, "placed": self.placed,
+            "policy": self.policy.snapshot()}
+
+  def restore(self, state : dict):
+    """
+      Pick up the state saved by a previous service. A child it recorded as running is adopted if its pid
+      is still the same process, judged by its start time and name; otherwise the process is started
+      afresh, without counting it as a restart
+
+      @params
+        state = Required : result of snapshot
+      @return
+        None
+    """
+    self.restarts = state.get('restarts', 0)
+    self.exit_code = state.get('exit_code')
+    self.started_at = state.get('started_at')
+    self.policy.restore(state.get('policy', {}))
+    self.running = state.get('running', False)
+    self.pid = state.get('pid', -1)
+    self.pid_start = state.get('start_time')
+    self.placed = state.get('placed', "")
+
+    if self.running != True:
+      self.pid = -1
+    elif self.pid > 0 and self.pid_start is not None and start_time(self.pid) == self.pid_start and check_pid(self.pid, self.name):
+      self.watch_pid()
+    else:
+      self.running, self.pid, self.started_at = False, -1, None
+
+  def watch_pid(self):
+    """
+      Learn of the exit of an adopted child as soon as it happens, through a pidfd. Without pidfds its exit
+      is found by the next supervision check instead
+
+      @return
+        None
+    """
+    try:
+      fd = os.pidfd_open(self.pid)
+    except (AttributeError, OSError):
+      return
+    loop = asyncio.get_event_loop()
+    pid = self.pid
+
+    def exited():
+      loop.remove_reader(fd)
+      os.close(fd)
+      if self.pid != pid or self.owned():
+        return # already found dead, or replaced
+      self.exit_code = None
+      self.pid = -1
+      self.running = False if self.running == True else self.running
+      self.changed()
+      if self.on_exit:
+        loop.create_task(self.on_exit(self))
+
+    loop.add_reader(fd, exited)
+
+  def verify(self):
+    """
+      Cheaply confirm that a running process not owned by this interpreter is still the one last seen,
+      without scanning the process table
+
+      @return
+        (bool) true if confirmed; false if its state needs a poll
+    """
+    return self.owned() or (self.running == True and self.pid > 0 and check_pid(self.pid, self.name))
+
+  async def async_poll(self):
+    """
+      poll, with any process table scan done off the event loop
+
+      @return
+        (bool) running
+    """
+    if self.owned():
+      return True
+
+    return await asyncio.get_event_loop().run_in_executor(None, self.poll)
+
+  def changed(self):
+    """
+      Notify the on_change listener of a state change
+
+      @return
+        None
+    """
+    if self.on_change:
+      self.on_change(self)
+
+  def owned(self):
+    """
+      Determine if the process is a live child of this interpreter, in which case its state is
+      event driven and never needs to be polled
+
+      @return
+        (bool) true if owned and alive
+    """
+    return self.proc is not None and self.proc.returncode is None
+
+  async def __watch(self, proc : asyncio.subprocess.Process):
+    """
+      Wait on an owned child and record its exit as soon as it happens
+
+      @params
+        proc = Required : child handle to wait on
+      @return
+        None
+    """
+    code = await proc.wait()
+
+    if self.proc is not proc:
+      return # replaced by a newer child
+
+    self.exit_code = code
+    self.pid = -1
+    self.running = False if self.running == True else self.running
+    self.changed()
+
+    if self.on_exit:
+      await self.on_exit(self)
+
+  def send_signal(self, sig : int):
+    """
+      Signal the process's group, or just the process if it does not lead one (e.g. started by an older
+      version), and everything in its cgroup
+
+      @params
+        sig = Required : signal
+      @return
+        None
+    """
+    if self.pid <= 0:
+      return
+    try:
+      if os.getpgid(self.pid) == self.pid:
+        os.killpg(self.pid, sig)
+      else:
+        os.kill(self.pid, sig)
+    except ProcessLookupError:
+      pass
+
+    if self.cgroup is not None:
+      for pid in self.cgroup.pids(): # descendants that left the group
+        try:
+          os.kill(pid, sig)
+        except ProcessLookupError:
+          pass
+
+  async def __block_til_stopped(self, pid : int, timeout : float, whole : bool = True):
+    """
+      Wait for the process, then the rest of its group (or cgroup), to exit. Whatever is left after the
+      timeout is killed with SIGKILL
+
+      @params
+        pid = Required : pid that was signalled
+        timeout = Required : seconds to wait at most
+        whole = Optional : wait on the whole cgroup, false when another child of the process shares it
       @return 
         None
     """
-    time = 0
-    
-    while time < 5:
-      await asyncio.sleep(0.1) # poll every 0.1 second
+    cgroup = self.cgroup if whole else None
+    if pid <= 0:
+      return
+    deadline = time.monotonic() + timeout
 
-      if not self.poll():
-        return
+    if self.proc is not None and self.proc.pid == pid:
+      try:
+        await asyncio.wait_for(asyncio.shield(self.proc.wait()), timeout)
+        exited = True
+      except asyncio.TimeoutError:
+        exited = False
+    else:
+      exited = await async_wait_pid(pid, timeout)
 
-      time += 0.1
+    if exited:
+      remaining = max(0, deadline - time.monotonic())
+      exited = await (cgroup.wait_empty(remaining) if cgroup is not None else async_wait_group(pid, remaining))
 
-    os.kill(self.pid, signal.SIGKILL)
+    if not exited and cgroup is not None and cgroup.kill():
+      await cgroup.wait_empty(1) # cgroup.kill returns before the processes are gone
+    elif not exited:
+      for kill in (os.killpg, os.kill): # the group, or the process if it does not lead one
+        try:
+          kill(pid, signal.SIGKILL)
+          break
+        except ProcessLookupError:
+          pass
 
   async def start(self):
     """
@@ -87,13 +406,140 @@ class Process:
       @return
         None
     """    
-    self.poll()
+    await self.async_poll()
     
     if self.running != True:
-      await async_exec_shell(f"nohup bash -c 'cd {self.pwd}; exec -a procm_p_{self.name} {self.inter} {self.file}' >/dev/null 2>&1 &", self.pwd, self.user)
-      self.running = True
-      self.poll()
-        
+      spawned = time.perf_counter()
+      self.attach(await self.__spawn())
+      telemetry.SPAWN.observe(time.perf_counter() - spawned)
+
+  async def __spawn(self, extra : dict = None):
+    """
+      Launch a child from the current config, without recording it as the process
+
+      @params
+        extra = Optional : additional environment variables
+      @return
+        (asyncio.subprocess.Process) child handle
+    """
+    env = await environments.async_build(self.user, self.env, self.env_file, self.spawn != "shell")
+    env.update(extra or {})
+    preexec = []
+    if self.cgroup is not None:
+      self.cgroup.create()
+      preexec.append(self.cgroup.joiner())
+    placement = Placement(self.placement, self.instance)
+    if placement:
+      preexec.append(placement.preexec())
+
+    if self.spawn == "shell":
+      return await async_spawn(f"-a procm_p_{self.name} {self.inter} {self.file}", self.pwd, self.user, self.log is not False, env, preexec)
+
+    runtime = shlex.split(self.inter)
+    argv = [f"procm_p_{self.name}"] + runtime[1:] + [self.file]
+    if self.listeners:
+      fds = [sock.fileno() for sock in self.listeners]
+      return await async_exec(shim(argv, runtime[0], fds), "bash", self.pwd, self.user, env, self.log is not False, preexec, fds)
+    return await async_exec(argv, runtime[0], self.pwd, self.user, env, self.log is not False, preexec)
+
+  def attach(self, proc : asyncio.subprocess.Process, capture : bool = True):
+    """
+      Record a started child as the process and watch it
+
+      @params
+        proc = Required : child handle
+        capture = Optional : start capturing its output, unless that is already done
+      @return
+        None
+    """
+    self.proc = proc
+    self.pid = proc.pid
+    self.pid_start = start_time(self.pid)
+    self.placed = effective(self.pid)
+    if capture:
+      self.capture(proc)
+    self.running = True
+    if self.started_at is not None:
+      self.restarts += 1
+      telemetry.RESTARTS.inc()
+    self.started_at = time.time()
+    self.changed()
+    asyncio.get_event_loop().create_task(self.__watch(proc))
+
+  async def replace(self):
+    """
+      Restart without a gap: start a new child next to the running one, wait until it is ready (see the
+      'ready' config or readiness probe; without either, until it has run for a second), then stop the old one. A new child that
+      does not become ready is stopped and the old one keeps running
+
+      @return
+        None
+      @raises
+        ProcessHandlerError if the new child is not ready
+    """
+    await self.async_poll()
+    old = self.pid if self.running == True else -1
+    ready = self.ready
+    if ready is None and 'readiness' in self.probes:
+      probe = self.probes['readiness']
+      ready = {probe.kind: probe.config[probe.kind]}
+    readiness = Readiness(ready or {}, self.name, self.user, self.pwd)
+    self.replacing = True
+
+    try:
+      child = await self.__spawn(readiness.env())
+      self.capture(child, readiness.tap)
+      error = await readiness.wait(child)
+    finally:
+      readiness.close()
+      self.replacing = False
+
+    if error is not None:
+      await self.__stop_pid(child.pid)
+      raise ProcessHandlerError(f"{self.name}: new instance {error}, kept the running one")
+
+    self.attach(child, capture=False)
+    if old > 0:
+      await self.__stop_pid(old)
+
+  def capture(self, proc : asyncio.subprocess.Process, tap = None):
+    """
+      Start copying a child's output pipes into the process log writers
+
+      @params
+        proc = Required : child handle
+        tap = Optional : function also given the output, see LogWriter.drain
+      @return
+        None
+    """
+    for stream in ("stdout", "stderr"):
+      pipe = getattr(proc, stream)
+      if pipe is not None:
+        asyncio.get_event_loop().create_task(self.log_writer(stream).drain(pipe, tap))
+
+  def log_writer(self, stream : str):
+    """
+      Return the log writer of a stream, creating it if needed
+
+      @params
+        stream = Required : stdout or stderr
+      @return
+        (LogWriter) writer
+    """
+    if stream not in self.logs:
+      self.logs[stream] = LogWriter(log_path(self.name, stream), self.log or None)
+    return self.logs[stream]
+
+  async def close_logs(self):
+    """
+      Flush and close the log writers
+
+      @return
+        None
+    """
+    for writer in self.logs.values():
+      await writer.close()
+
   async def restart(self):
     """
       Restart the process, even if running
@@ -104,25 +550,38 @@ class Process:
     await self.stop(signal.SIGTERM) # SIGTERM 
     await self.start()
     
-  async def stop(self, sig : signal = signal.SIGTERM):
+  async def __stop_pid(self, pid : int):
     """
-      Stops the process
+      Stop one child and its process group, leaving the rest of the cgroup alone
 
+      @params
+        pid = Required : child pid, which leads its group
       @return
         None
     """
-    self.poll()
-
-    if self.running == True:
-      os.kill(self.pid, sig)
-    
-    self.running = "STOPPED"
+    try:
+      os.killpg(pid, signal.SIGTERM)
+    except ProcessLookupError:
+      return
+    await self.__block_til_stopped(pid, self.stop_timeout, whole=False)
 
-    await self.__block_til_stopped()
-    
+  async def stop(self, sig : signal = signal.SIGTERM, timeout : float = None):
+    """
+      Stops the process and its process group
 
-    
+      @params
+        sig = Optional : signal to send first
+        timeout = Optional : seconds before SIGKILL, defaults to stop_timeout
+      @return
+        None
+    """
+    await self.async_poll()
+    pid = self.pid if self.running == True else -1
 
+    if pid > 0:
+      self.send_signal(sig)
     
+    self.running = "STOPPED"
+    self.changed()
 
-    
+    await self.__block_til_stopped(pid, self.stop_timeout if timeout is None else timeout)
@@ -0,0 +1,187 @@
+"""
+  Control socket wire format
+
+  Every message is a frame: a 4 byte big-endian length followed by a UTF-8 JSON object.
+    request : {"id": 1, "cmd": "start", "args": {"name": "x"}}
+    batch   : {"id": 2, "batch": [{"cmd": "stop", "args": {"name": "x"}}, {"cmd": "reload"}]}
+    reply   : {"id": 1, "ok": true, "result": ...} or {"id": 1, "ok": false, "error": "..."}
+    batch reply : {"id": 2, "ok": <all ok>, "results": [<reply without id>, ...]}
+
+  Frames are limited to 16 MiB, so the first byte of a frame is always 0. Anything else is a legacy
+  plain text message such as "start x" or "r".
+
+  A reply with "stream": true is followed by raw data chunks, each a 4 byte big-endian header of
+  DATA | length followed by length bytes. An empty chunk ends the stream.
+"""
+import json
+import struct
+from .errors import *
+
+HEADER = struct.Struct(">I")
+MAX_FRAME = (1 << 24) - 1
+DATA = 1 << 24
+
+LEGACY = {"r": "reload", "start-all": "start-all", "stop-all": "stop-all", "restart-all": "restart-all"}
+
+def encode(message : dict):
+  """
+    Encode a message as a frame
+
+    @params
+      message = Required : JSON serializable dict
+    @return
+      (bytes) frame
+    @raises
+      ProtocolError if the message is too large
+  """
+  payload = json.dumps(message, separators=(",", ":")).encode()
+  if len(payload) > MAX_FRAME:
+    raise ProtocolError(f"Frame of {len(payload)} bytes exceeds the {MAX_FRAME} byte limit")
+  return HEADER.pack(len(payload)) + payload
+
+def decode(payload : bytes):
+  """
+    Decode a frame payload
+
+    @params
+      payload = Required : frame body, without the header
+    @return
+      (dict) message
+    @raises
+      ProtocolError if the payload is not a JSON object
+  """
+  try:
+    message = json.loads(payload)
+  except ValueError as e:
+    raise ProtocolError(f"Invalid frame: {e}")
+  if not isinstance(message, dict):
+    raise ProtocolError("Invalid frame: expected a JSON object")
+  return message
+
+def chunk_header(size : int):
+  """
+    Header of a raw data chunk
+
+    @params
+      size = Required : chunk length, at most MAX_FRAME
+    @return
+      (bytes) header
+  """
+  return HEADER.pack(DATA | size)
+
+class Stream:
+  """
+    Command result that streams raw data chunks after its reply. meta is sent as the reply result
+  """
+  meta = None
+
+  async def send(self, r, w):
+    """
+      Write the data chunks, without the final empty chunk
+
+      @params
+        r = Required : connection streamreader, to notice the client leaving
+        w = Required : connection streamwriter
+      @return
+        None
+    """
+    raise NotImplementedError
+
+  async def close(self):
+    """
+      Release the stream's resources
+
+      @return
+        None
+    """
+    pass
+
+def parse_legacy(message : str):
+  """
+    Translate a legacy plain text message into a command
+
+    @params
+      message = Required : e.g. "start <name>" or "r"
+    @return
+      (string, dict) command and arguments
+    @raises
+      ProtocolError on an unknown message
+  """
+  parts = message.split()
+  if len(parts) == 1 and parts[0] in LEGACY:
+    return LEGACY[parts[0]], {}
+  if len(parts) == 2 and parts[0] in ("start", "stop", "restart"):
+    return parts[0], {"name": parts[1]}
+  raise ProtocolError(f"Unknown message: {message!r}")
+
+def reply(id, result = None, error : Exception = None):
+  """
+    Build a reply message
+
+    @params
+      id = Required : request id, None inside a batch
+      result = Optional : command result
+      error = Optional : exception raised by the command
+    @return
+      (dict) reply
+  """
+  message = {} if id is None else {"id": id}
+  if error is None:
+    message.update({"ok": True, "result": result})
+  else:
+    message.update({"ok": False, "error": str(error) or type(error).__name__})
+  return message
+
+def recv_frame(sock):
+  """
+    Read one frame from a blocking socket
+
+    @params
+      sock = Required : connected socket
+    @return
+      (dict) message
+    @raises
+      WorkerConnectionError if the connection closes mid frame
+  """
+  size = HEADER.unpack(recv_exactly(sock, HEADER.size))[0]
+  return decode(recv_exactly(sock, size))
+
+def recv_chunks(sock):
+  """
+    Read the data chunks of a streamed reply from a blocking socket
+
+    @params
+      sock = Required : connected socket
+    @return
+      (generator) chunks of bytes, until the stream ends
+    @raises
+      ProtocolError on a frame that is not a data chunk
+  """
+  while True:
+    header = HEADER.unpack(recv_exactly(sock, HEADER.size))[0]
+    if not header & DATA:
+      raise ProtocolError("Expected a data chunk")
+    size = header & MAX_FRAME
+    if size == 0:
+      return
+    yield recv_exactly(sock, size)
+
+def recv_exactly(sock, size : int):
+  """
+    Read exactly size bytes from a blocking socket
+
+    @params
+      sock = Required : connected socket
+      size = Required : number of bytes
+    @return
+      (bytes) data
+    @raises
+      WorkerConnectionError if the connection closes first
+  """
+  data = bytearray()
+  while len(data) < size:
+    chunk = sock.recv(size - len(data))
+    if not chunk:
+      raise WorkerConnectionError("Connection to worker closed unexpectedly")
+    data += chunk
+  return bytes(data)
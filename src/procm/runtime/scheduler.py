@@ -0,0 +1,183 @@
+"""
+  Dependency aware, concurrency limited scheduling of start and stop actions
+
+  A process runs its action once everything it is ordered 'after' (or 'requires') in the same batch has
+  finished; stops run in the reverse order. Ready processes are dispatched highest 'priority' first, and
+  at most 'concurrency' throttled actions (starts) run at once across all batches
+"""
+import os
+import heapq
+import asyncio
+from .errors import *
+
+def dependencies(spec : dict):
+  """
+    Names a process entry is ordered after
+
+    @params
+      spec = Required : process entry or Process
+    @return
+      (list) names
+  """
+  if isinstance(spec, dict):
+    return list(spec.get('after', [])) + list(spec.get('requires', []))
+  return spec.after + spec.requires
+
+def find_cycle(specs : list):
+  """
+    Find a dependency cycle among process entries. Edges to unknown names are ignored
+
+    @params
+      specs = Required : process entries
+    @return
+      (list or None) names forming a cycle, None if there is none
+  """
+  edges = {spec['name']: dependencies(spec) for spec in specs}
+  state = {} # name -> 1 visiting, 2 done
+
+  for root in edges:
+    if state.get(root):
+      continue
+    stack = [(root, iter(edges[root]))]
+    path = [root]
+    state[root] = 1
+
+    while stack:
+      name, children = stack[-1]
+      child = next(children, None)
+      if child is None:
+        state[name] = 2
+        stack.pop()
+        path.pop()
+      elif child in edges and state.get(child) == 1:
+        return path[path.index(child):] + [child]
+      elif child in edges and not state.get(child):
+        state[child] = 1
+        stack.append((child, iter(edges[child])))
+        path.append(child)
+  return None
+
+class Scheduler:
+
+  def __init__(self, concurrency : int = None, resolve = None):
+    """
+      Initialize the scheduler
+
+      @params
+        concurrency = Optional : actions allowed to run at once, defaults to the number of CPUs
+        resolve = Optional : function name -> Process or False, to check 'requires' outside a batch
+      @return
+        None
+    """
+    self.resolve = resolve
+    self.limit = None
+    self.configure(concurrency)
+
+  def configure(self, concurrency : int = None):
+    """
+      Set the concurrency limit. Actions already running keep their slot
+
+      @params
+        concurrency = Optional : actions allowed to run at once, defaults to the number of CPUs
+      @return
+        None
+    """
+    limit = max(1, concurrency or os.cpu_count() or 1)
+    if limit != self.limit:
+      self.limit = limit
+      self.slots = asyncio.Semaphore(limit)
+
+  async def __slot(self, action, proc):
+    """
+      Run one action inside a concurrency slot
+
+      @params
+        action = Required : coroutine function taking the process
+        proc = Required : process
+      @return
+        (any) result of the action
+    """
+    async with self.slots:
+      return await action(proc)
+
+  async def run(self, procs : list, action, reverse : bool = False, throttle : bool = True):
+    """
+      Run an action on processes in dependency order. When starting, a process whose required process
+      failed, or is neither in the batch nor running, is not started
+
+      @params
+        procs = Required : processes
+        action = Required : coroutine function taking a process
+        reverse = Optional : dependents first, for stopping
+        throttle = Optional : count against the concurrency limit. Stops, which mostly wait, need not
+      @return
+        (dict) name -> exception for the processes the action failed for
+    """
+    loop = asyncio.get_event_loop()
+    batch = {proc.name: proc for proc in procs}
+    waiting = {name: set() for name in batch} # name -> unfinished names it waits for
+    blocks = {name: [] for name in batch} # name -> names waiting for it
+
+    for proc in procs:
+      for dep in dependencies(proc):
+        if dep in batch and dep != proc.name:
+          first, then = (proc.name, dep) if reverse else (dep, proc.name)
+          waiting[then].add(first)
+          blocks[first].append(then)
+
+    order = {name: i for i, name in enumerate(batch)}
+    ready = [(-batch[name].priority, order[name], name) for name in batch if not waiting[name]]
+    heapq.heapify(ready)
+    running = {} # task -> name
+    failed = {}
+
+    def finish(name, error = None):
+      if error is not None:
+        failed[name] = error
+      for other in blocks[name]:
+        waiting[other].discard(name)
+        if not waiting[other]:
+          heapq.heappush(ready, (-batch[other].priority, order[other], other))
+
+    while ready or running:
+      while ready:
+        name = heapq.heappop(ready)[2]
+        proc = batch[name]
+
+        if not reverse:
+          broken = [dep for dep in proc.requires if dep in failed or (dep in batch and batch[dep].running != True)]
+          missing = None if broken else self.__missing_outside(proc, batch)
+          if broken or missing:
+            finish(name, ProcessHandlerError(f"{name} requires {(broken or [missing])[0]}, which is not running"))
+            continue
+
+        running[loop.create_task(self.__slot(action, proc) if throttle else action(proc))] = name
+
+      if not running:
+        break
+      done, _ = await asyncio.wait(list(running), return_when=asyncio.FIRST_COMPLETED)
+      for task in done:
+        finish(running.pop(task), task.exception())
+
+    for name in batch:
+      if waiting[name] and name not in failed:
+        failed[name] = ProcessHandlerError(f"{name} is part of a dependency cycle")
+    return failed
+
+  def __missing_outside(self, proc, batch : dict):
+    """
+      The required process outside the batch that is not running, if any
+
+      @params
+        proc = Required : process about to start
+        batch = Required : name -> process being acted on
+      @return
+        (string or None) name
+    """
+    for name in proc.requires:
+      if name in batch:
+        continue
+      other = self.resolve(name) if self.resolve else None
+      if not other or other.running != True:
+        return name
+    return None
@@ -0,0 +1,275 @@
+"""
+  Indexed process lookup and selector expressions
+
+  A selector is a comma separated list of terms which must all match:
+    name=<glob>     process name, or pool name for all its members
+    path=<glob>     script path
+    <key>=<glob>    label value, e.g. tier=ingest or region=*
+    <key>!=<glob>   label absent or not matching
+    <glob>          tag
+"""
+import bisect
+from fnmatch import fnmatchcase
+from .errors import *
+
+WILDCARDS = "*?["
+
+def literal_prefix(pattern : str):
+  """
+    Return the part of a glob before its first wildcard
+
+    @params
+      pattern = Required : glob pattern
+    @return
+      (string) literal prefix
+  """
+  for i, c in enumerate(pattern):
+    if c in WILDCARDS:
+      return pattern[:i]
+  return pattern
+
+class Index:
+
+  def __init__(self, entries : list = None):
+    """
+      Build the index over a list of process entries (config dicts)
+
+      @params
+        entries = Optional : process entries
+      @return
+        None
+    """
+    self.entries = {} # name -> entry
+    self.order = {} # name -> insertion sequence, to return matches in config order
+    self.names = [] # sorted names
+    self.paths = [] # sorted (path, name)
+    self.labels = {} # key -> value -> set of names
+    self.tags = {} # tag -> set of names
+    self.pools = {} # pool -> set of member names
+    self.seq = 0
+
+    for entry in entries or []:
+      self.add(entry)
+
+  def __len__(self):
+    return len(self.entries)
+
+  def get(self, name : str):
+    """
+      Look up an entry by exact name
+
+      @params
+        name = Required : process name
+      @return
+        (dict or None) entry
+    """
+    return self.entries.get(name)
+
+  def add(self, entry : dict):
+    """
+      Index an entry, replacing any entry of the same name
+
+      @params
+        entry = Required : process entry with at least name and path
+      @return
+        None
+    """
+    name = entry['name']
+    if name in self.entries:
+      self.remove(name)
+
+    self.entries[name] = entry
+    self.order[name] = self.seq
+    self.seq += 1
+    bisect.insort(self.names, name)
+    bisect.insort(self.paths, (entry['path'], name))
+
+    for key, value in (entry.get('labels') or {}).items():
+      self.labels.setdefault(key, {}).setdefault(str(value), set()).add(name)
+    for tag in entry.get('tags') or []:
+      self.tags.setdefault(tag, set()).add(name)
+    if entry.get('pool'):
+      self.pools.setdefault(entry['pool'], set()).add(name)
+
+  def remove(self, name : str):
+    """
+      Remove an entry from the index
+
+      @params
+        name = Required : process name
+      @return
+        (dict or None) removed entry
+    """
+    entry = self.entries.pop(name, None)
+    if entry is None:
+      return None
+
+    del self.order[name]
+    self.names.pop(bisect.bisect_left(self.names, name))
+    self.paths.pop(bisect.bisect_left(self.paths, (entry['path'], name)))
+
+    for key, value in (entry.get('labels') or {}).items():
+      self.__discard(self.labels[key], str(value), name)
+      if not self.labels[key]:
+        del self.labels[key]
+    for tag in entry.get('tags') or []:
+      self.__discard(self.tags, tag, name)
+    if entry.get('pool'):
+      self.__discard(self.pools, entry['pool'], name)
+
+    return entry
+
+  def __discard(self, index : dict, key : str, name : str):
+    """ remove name from an inverted index bucket, dropping empty buckets """
+    index[key].discard(name)
+    if not index[key]:
+      del index[key]
+
+  def __names_from(self, prefix : str):
+    """ names starting with prefix, from the sorted name list """
+    i = bisect.bisect_left(self.names, prefix)
+    while i < len(self.names) and self.names[i].startswith(prefix):
+      yield self.names[i]
+      i += 1
+
+  def __paths_from(self, prefix : str):
+    """ (path, name) pairs whose path starts with prefix, from the sorted path list """
+    i = bisect.bisect_left(self.paths, (prefix,))
+    while i < len(self.paths) and self.paths[i][0].startswith(prefix):
+      yield self.paths[i]
+      i += 1
+
+  def by_name(self, pattern : str):
+    """
+      Names matching a glob, narrowed through the sorted name list by the glob's literal prefix, plus
+      the members of pools whose name matches
+
+      @params
+        pattern = Required : glob
+      @return
+        (set) names
+    """
+    prefix = literal_prefix(pattern)
+    if prefix == pattern:
+      return ({pattern} if pattern in self.entries else set()) | self.pools.get(pattern, set())
+    names = {name for name in self.__names_from(prefix) if fnmatchcase(name, pattern)}
+    return names.union(*[members for pool, members in self.pools.items() if fnmatchcase(pool, pattern)])
+
+  def by_path(self, pattern : str):
+    """
+      Names whose script path matches a glob, narrowed by its literal prefix
+
+      @params
+        pattern = Required : glob
+      @return
+        (set) names
+    """
+    prefix = literal_prefix(pattern)
+    return {name for path, name in self.__paths_from(prefix) if fnmatchcase(path, pattern)}
+
+  def by_path_part(self, part : str):
+    """
+      Names whose script path contains a substring (the --path filter). Absolute paths use the prefix index
+
+      @params
+        part = Required : partial path
+      @return
+        (set) names
+    """
+    if part.startswith("/"):
+      return {name for path, name in self.__paths_from(part)}
+    return {name for path, name in self.paths if part in path}
+
+  def by_label(self, key : str, pattern : str):
+    """
+      Names with a label value matching a glob
+
+      @params
+        key = Required : label key
+        pattern = Required : glob
+      @return
+        (set) names
+    """
+    values = self.labels.get(key, {})
+    if literal_prefix(pattern) == pattern:
+      return set(values.get(pattern, ()))
+    return set().union(*[names for value, names in values.items() if fnmatchcase(value, pattern)])
+
+  def by_tag(self, pattern : str):
+    """
+      Names with a tag matching a glob
+
+      @params
+        pattern = Required : glob
+      @return
+        (set) names
+    """
+    if literal_prefix(pattern) == pattern:
+      return set(self.tags.get(pattern, ()))
+    return set().union(*[names for tag, names in self.tags.items() if fnmatchcase(tag, pattern)])
+
+  def select(self, expr : str):
+    """
+      Evaluate a selector expression
+
+      @params
+        expr = Required : selector, see module docstring
+      @return
+        (set) names
+      @raises
+        SelectorError on an invalid expression
+    """
+    include, exclude = [], []
+
+    for term in [t.strip() for t in expr.split(",")]:
+      if term == "":
+        raise SelectorError(f"Invalid selector: empty term in '{expr}'")
+
+      if "!=" in term:
+        key, pattern = term.split("!=", 1)
+        exclude.append(self.__term(key.strip(), pattern.strip()))
+      elif "=" in term:
+        key, pattern = term.split("=", 1)
+        include.append(self.__term(key.strip(), pattern.strip()))
+      else:
+        include.append(self.by_tag(term))
+
+    if len(include) == 0:
+      include.append(set(self.entries))
+
+    include.sort(key=len)
+    matches = include[0].intersection(*include[1:])
+    return matches.difference(*exclude)
+
+  def __term(self, key : str, pattern : str):
+    """ evaluate a key=pattern term """
+    if key == "":
+      raise SelectorError(f"Invalid selector term: '{key}={pattern}'")
+    if key == "name":
+      return self.by_name(pattern)
+    if key == "path":
+      return self.by_path(pattern)
+    return self.by_label(key, pattern)
+
+  def match(self, criteria : dict):
+    """
+      Select entries by criteria, any of which may match: all, name (glob), path (partial path),
+      select (selector expression)
+
+      @params
+        criteria = Required : criteria to match by
+      @return
+        (list) matching entries, in insertion order
+    """
+    if criteria.get('all') == True:
+      return list(self.entries.values())
+
+    names = set()
+    if criteria.get('name'):
+      names |= self.by_name(criteria['name'])
+    if criteria.get('path'):
+      names |= self.by_path_part(criteria['path'])
+    if criteria.get('select'):
+      names |= self.select(criteria['select'])
+
+    return [self.entries[name] for name in sorted(names, key=self.order.get)]
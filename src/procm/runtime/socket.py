@@ -2,11 +2,19 @@ import socket
 import sys, os
 import asyncio
 from .errors import *
+from .protocol import *
+
+SOCKET_PATH = os.environ.get("PROCM_SOCKET", "/var/run/procm.sock")
 
 class Socket:
 
   def __init__(self, proc : type(lambda x : None) = None):
-    self.socket_path = "/var/run/procm.sock"
+    """
+      @params
+        proc = Optional : coroutine function called with (command, args) for each request when serving.
+          Its return value is the reply result, and exceptions it raises are returned as errors
+    """
+    self.socket_path = SOCKET_PATH
     self.socket = None
     self.func = proc
 
@@ -57,7 +65,9 @@ class Socket:
 
   async def async_process(self, r : asyncio.StreamReader, w : asyncio.StreamWriter):
     """
-      Handles async socket message processing
+      Handles async socket message processing. Frames are handled in the order received, so a client can
+      pipeline any number of requests and read the replies back in order. Legacy plain text messages are
+      handled once, without a reply
 
       @params
         r = Required : streamreader
@@ -65,33 +75,235 @@ class Socket:
       @return
         None
     """
-    request = (await r.read(1024)).decode('utf8')
-    await self.func(request)
-    
+    try:
+      while True:
+        try:
+          header = await r.readexactly(HEADER.size)
+        except asyncio.IncompleteReadError as e:
+          header = e.partial
+          if len(header) == 0 or header[0] == 0:
+            return
+
+        if header[0] != 0:
+          await self.__call({"cmd": None, "legacy": (header + await r.read(1024)).decode('utf8')})
+          return
+
+        try:
+          message = decode(await r.readexactly(HEADER.unpack(header)[0]))
+        except ProtocolError as e:
+          w.write(encode(reply(None, error=e)))
+          return
+
+        response, stream = await self.__dispatch(message)
+        w.write(encode(response))
+        if stream is not None:
+          try:
+            await stream.send(r, w)
+            w.write(chunk_header(0))
+          finally:
+            await stream.close()
+        await w.drain()
+    except (ConnectionError, asyncio.IncompleteReadError):
+      pass # client went away
+    finally:
+      w.close()
+
+  async def __dispatch(self, message : dict):
+    """
+      Run a request or batch. Commands of a batch run concurrently
+
+      @params
+        message = Required : decoded request frame
+      @return
+        (dict, Stream or None) reply, and data to stream after it
+    """
+    if "batch" in message:
+      results = await asyncio.gather(*[self.__call(m, False) for m in message['batch'] if isinstance(m, dict)])
+      results = [result for result, _ in results]
+      return {"id": message.get('id'), "ok": all(r['ok'] for r in results), "results": results}, None
+
+    result, stream = await self.__call(message)
+    return dict({"id": message.get('id')}, **result), stream
+
+  async def __call(self, message : dict, streaming : bool = True):
+    """
+      Run a single command through the request handler
+
+      @params
+        message = Required : {"cmd": ..., "args": {...}}, or {"legacy": "..."} for plain text messages
+        streaming = Optional : whether the command may return a Stream
+      @return
+        (dict, Stream or None) reply without id, and data to stream after it
+    """
+    try:
+      if message.get('legacy') is not None:
+        cmd, args = parse_legacy(message['legacy'])
+      else:
+        cmd, args = message.get('cmd'), message.get('args') or {}
+      result = await self.func(cmd, args)
+    except Exception as e:
+      return reply(None, error=e), None
+
+    if not isinstance(result, Stream):
+      return reply(None, result), None
+    if not streaming:
+      await result.close()
+      return reply(None, error=ProtocolError(f"{cmd} cannot be batched")), None
+    return dict(reply(None, result.meta), stream=True), result
+
+  def connect(self):
+    """
+      Open a client connection to the service
+
+      @return
+        (Connection) connection
+      @raises
+        WorkerConnectionError is connection fails
+    """
+    return Connection(self.socket_path)
+
+  def request(self, cmd : str, **args):
+    """
+      Send a single command and wait for its reply
+
+      @params
+        cmd = Required : command name
+        args = Optional : command arguments
+      @return
+        (dict) reply
+      @raises
+        WorkerConnectionError is connection fails
+    """
+    with self.connect() as conn:
+      return conn.call(cmd, **args)
+
+  def batch(self, commands : list):
+    """
+      Send several commands as one frame, which the service runs concurrently
+
+      @params
+        commands = Required : list of (command, args) tuples
+      @return
+        (dict) batch reply, with one result per command
+      @raises
+        WorkerConnectionError is connection fails
+    """
+    with self.connect() as conn:
+      conn.send_batch(commands)
+      return conn.recv()
 
   def send(self, message : str):
     """
-      Send a message to the socket.
+      Send a legacy plain text message to the socket, e.g. "start <name>" or "r"
 
       @params
         message = Required : the message to send
+      @return
+        (dict) reply
+      @raises
+        WorkerConnectionError is connection fails
+    """
+    cmd, args = parse_legacy(message)
+    return self.request(cmd, **args)
+
+class Connection:
+
+  def __init__(self, path : str):
+    """
+      Connect to the service socket
+
+      @params
+        path = Required : socket path
       @return
         None
       @raises
         WorkerConnectionError is connection fails
     """
+    self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    self.next_id = 1
     try:
-      with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
-        client.connect(self.socket_path)
-        client.send(message.encode())
-        client.close()
+      self.socket.connect(path)
     except (ConnectionRefusedError, FileNotFoundError) as e:
+      self.socket.close()
       raise WorkerConnectionError("Connection to worker refused. Is the service running?")
 
-  
-          
+  def __enter__(self):
+    return self
 
-      
+  def __exit__(self, *exc):
+    self.close()
+
+  def __write(self, message : dict):
+    """ assign an id and write a frame, returning the id """
+    message['id'] = self.next_id
+    self.next_id += 1
+    try:
+      self.socket.sendall(encode(message))
+    except (BrokenPipeError, ConnectionResetError):
+      raise WorkerConnectionError("Connection to worker closed unexpectedly")
+    return message['id']
+
+  def send(self, cmd : str, **args):
+    """
+      Write a request without waiting for the reply, for pipelining
+
+      @params
+        cmd = Required : command name
+        args = Optional : command arguments
+      @return
+        (int) request id
+    """
+    return self.__write({"cmd": cmd, "args": args})
+
+  def send_batch(self, commands : list):
+    """
+      Write a batch request without waiting for the reply
+
+      @params
+        commands = Required : list of (command, args) tuples
+      @return
+        (int) request id
+    """
+    return self.__write({"batch": [{"cmd": cmd, "args": args or {}} for cmd, args in commands]})
+
+  def recv(self):
+    """
+      Read the next reply
+
+      @return
+        (dict) reply
+      @raises
+        WorkerConnectionError if the connection closes
+    """
+    return recv_frame(self.socket)
+
+  def recv_stream(self):
+    """
+      Read the data following a reply with "stream": true
 
-    
+      @return
+        (generator) chunks of bytes
+    """
+    return recv_chunks(self.socket)
 
+  def call(self, cmd : str, **args):
+    """
+      Send a request and wait for its reply
+
+      @params
+        cmd = Required : command name
+        args = Optional : command arguments
+      @return
+        (dict) reply
+    """
+    self.send(cmd, **args)
+    return self.recv()
+
+  def close(self):
+    """
+      Close the connection
+
+      @return
+        None
+    """
+    self.socket.close()
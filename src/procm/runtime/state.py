@@ -0,0 +1,105 @@
+"""
+  Runtime state persisted across restarts of the service
+
+  The service keeps a snapshot of what it knows about each process that a config cannot tell: the pid of a
+  running process and when it started (which rules out a reused pid), restart counts and the restart
+  policy's history. The snapshot is written a moment after changes, and right before the service exits,
+  replacing the file atomically. A new service adopts the processes still running from it in one pass,
+  without scanning the process table.
+
+  /run is cleared at boot, which is what the snapshot is for: processes outliving one service instance.
+"""
+import os
+import json
+import time
+import asyncio
+from .status import RUN_DIR
+
+PATH = os.path.join(RUN_DIR, "state.json")
+VERSION = 1
+DELAY = 1 # seconds changes are batched for before the snapshot is written
+
+class StateFile:
+
+  def __init__(self, source, path : str = PATH, delay : float = DELAY):
+    """
+      Initialize
+
+      @params
+        source = Required : function returning the snapshot, name -> process state
+        path = Optional : snapshot path
+        delay = Optional : seconds to batch changes for
+      @return
+        None
+    """
+    self.source = source
+    self.path = path
+    self.delay = delay
+    self.timer = None
+    self.frozen = False
+    self.loop = asyncio.get_event_loop()
+
+  def load(self):
+    """
+      Read the snapshot left by a previous service
+
+      @return
+        (dict) process name -> state, empty if there is no usable snapshot
+    """
+    try:
+      with open(self.path) as f:
+        data = json.load(f)
+    except (OSError, ValueError):
+      return {}
+    if not isinstance(data, dict) or data.get('version') != VERSION:
+      return {}
+    return data.get('processes', {})
+
+  def save(self):
+    """
+      Write the snapshot now, atomically
+
+      @return
+        None
+    """
+    if self.timer is not None:
+      self.timer.cancel()
+      self.timer = None
+    if self.frozen:
+      return
+
+    data = {"version": VERSION, "pid": os.getpid(), "saved": time.time(), "processes": self.source()}
+    tmp = f"{self.path}.{os.getpid()}"
+    try:
+      os.makedirs(os.path.dirname(self.path), exist_ok=True)
+      with open(tmp, 'w') as f:
+        json.dump(data, f, separators=(",", ":"))
+      os.replace(tmp, self.path)
+    except OSError as e:
+      print(f"Cannot save state to {self.path}: {e}")
+
+  def touch(self):
+    """
+      Note a change, saving once the batching delay has passed. Safe to call from executor threads, which
+      poll processes
+
+      @return
+        None
+    """
+    if self.timer is None and not self.frozen:
+      self.loop.call_soon_threadsafe(self.__arm)
+
+  def __arm(self):
+    """ start the batching delay on the event loop, unless already started """
+    if self.timer is None and not self.frozen:
+      self.timer = self.loop.call_later(self.delay, self.save)
+
+  def freeze(self):
+    """
+      Stop saving, keeping the last snapshot, e.g. while the service stops every process on its way out
+
+      @return
+        None
+    """
+    self.save()
+    self.frozen = True
@@ -0,0 +1,198 @@
+"""
+  Shared memory status table
+
+  The service publishes the live state of every process into a memory mapped file, so the CLI and
+  external monitors can read it without polling processes or talking to the socket.
+
+  Layout (little endian):
+    header : magic "PRCM", version (H), record size (H), capacity (I), count (I), sequence (Q),
+             service pid (i), updated (d)
+    records: name (64s), pid (i), state (B), has exit code (B), health (B), restarts (I), exit code (i),
+             started (d), placement (48s)
+
+  The sequence is odd while the table is being written. Readers copy the table and retry until they
+  see the same even sequence before and after the copy.
+"""
+import os
+import mmap
+import time
+import struct
+from .errors import *
+
+RUN_DIR = os.environ.get("PROCM_RUN_DIR", "/run/procm") # status table, state snapshot, notify sockets
+PATH = os.path.join(RUN_DIR, "status")
+MAGIC = b"PRCM"
+VERSION = 3
+HEADER = struct.Struct("<4sHHIIQid")
+RECORD = struct.Struct("<64siBBBxIid48s")
+SEQ_OFFSET = struct.calcsize("<4sHHII")
+
+STATES = [False, True, "STOPPED", "BACKOFF", "FATAL"] # running values of Process, by state code
+HEALTH = ["", "healthy", "ready", "unready", "failing"] # Process.health values, by code
+
+class StatusTable:
+
+  def __init__(self, path : str = PATH, capacity : int = 256):
+    """
+      Create the table file and map it
+
+      @params
+        path = Optional : table file path
+        capacity = Optional : initial number of records, grown as needed
+      @return
+        None
+    """
+    self.path = path
+    self.capacity = 0
+    self.count = 0
+    self.seq = 0
+    self.slots = {} # name -> record index
+    self.map = None
+    self.__allocate(capacity)
+
+  def __allocate(self, capacity : int):
+    """
+      (Re)create the backing file with room for capacity records. The file is replaced atomically, so
+      readers holding the old mapping keep a consistent (if stale) view
+
+      @params
+        capacity = Required : number of records
+      @return
+        None
+    """
+    os.makedirs(os.path.dirname(self.path), exist_ok=True)
+    tmp = f"{self.path}.{os.getpid()}"
+    size = HEADER.size + capacity * RECORD.size
+
+    fd = os.open(tmp, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+      os.ftruncate(fd, size)
+      new = mmap.mmap(fd, size)
+    finally:
+      os.close(fd)
+
+    if self.map is not None:
+      new[HEADER.size:HEADER.size + self.count * RECORD.size] = self.map[HEADER.size:HEADER.size + self.count * RECORD.size]
+      self.map.close()
+
+    self.map, self.capacity = new, capacity
+    self.__header()
+    os.replace(tmp, self.path)
+
+  def __header(self):
+    """ write the header with the current sequence """
+    HEADER.pack_into(self.map, 0, MAGIC, VERSION, RECORD.size, self.capacity, self.count, self.seq, os.getpid(), time.time())
+
+  def __begin(self):
+    """ mark the table as being written """
+    self.seq += 1
+    struct.pack_into("<Q", self.map, SEQ_OFFSET, self.seq)
+
+  def __end(self):
+    """ publish the header, ending the write """
+    self.seq += 1
+    self.__header()
+
+  def __pack(self, index : int, proc):
+    """ write one process record """
+    RECORD.pack_into(self.map, HEADER.size + index * RECORD.size, proc.name.encode()[:64], proc.pid,
+                     STATES.index(proc.running), proc.exit_code is not None, HEALTH.index(proc.health()), proc.restarts,
+                     proc.exit_code or 0, proc.started_at or 0, proc.placed.encode()[:48])
+
+  def publish(self, processes : list):
+    """
+      Rewrite the whole table, e.g. after the process list changed
+
+      @params
+        processes = Required : Process objects
+      @return
+        None
+    """
+    if len(processes) > self.capacity:
+      self.__allocate(max(len(processes), self.capacity * 2))
+
+    self.__begin()
+    for index, proc in enumerate(processes):
+      self.__pack(index, proc)
+    self.count = len(processes)
+    self.slots = {proc.name: index for index, proc in enumerate(processes)}
+    self.__end()
+
+  def update(self, proc):
+    """
+      Rewrite the record of a single process, e.g. when it starts or exits
+
+      @params
+        proc = Required : Process object
+      @return
+        None
+    """
+    index = self.slots.get(proc.name)
+    if index is None:
+      return
+
+    self.__begin()
+    self.__pack(index, proc)
+    self.__end()
+
+  def close(self):
+    """
+      Unmap and remove the table
+
+      @return
+        None
+    """
+    self.map.close()
+    try:
+      os.remove(self.path)
+    except FileNotFoundError:
+      pass
+
+def read(path : str = PATH, retries : int = 100):
+  """
+    Read a consistent snapshot of the status table
+
+    @params
+      path = Optional : table file path
+      retries = Optional : attempts before giving up on a table under constant writes
+    @return
+      (dict or None) {"pid": service pid, "updated": time, "processes": {name: record dict}}, None if the
+      table does not exist or its service is not running
+  """
+  try:
+    with open(path, 'rb') as f:
+      data = mmap.mmap(f.fileno(), 0, prot=mmap.PROT_READ)
+  except (FileNotFoundError, ValueError):
+    return None
+
+  try:
+    for _ in range(retries):
+      magic, version, size, capacity, count, seq, pid, updated = HEADER.unpack_from(data, 0)
+      if magic != MAGIC or version != VERSION or size != RECORD.size:
+        return None
+      if seq % 2 == 1:
+        continue
+
+      records = data[HEADER.size:HEADER.size + count * RECORD.size]
+      if struct.unpack_from("<Q", data, SEQ_OFFSET)[0] == seq:
+        break
+    else:
+      return None
+  finally:
+    data.close()
+
+  try:
+    os.kill(pid, 0)
+  except ProcessLookupError:
+    return None # stale table of a dead service
+  except PermissionError:
+    pass
+
+  processes = {}
+  for name, proc_pid, state, has_exit, health, restarts, exit_code, started, placed in RECORD.iter_unpack(records):
+    name = name.rstrip(b"\0").decode(errors="replace")
+    processes[name] = {"name": name, "pid": proc_pid, "running": STATES[state], "health": HEALTH[health], "restarts": restarts,
+                       "exit_code": exit_code if has_exit else None, "started": started,
+                       "placement": placed.rstrip(b"\0").decode(errors="replace")}
+
+  return {"pid": pid, "updated": updated, "processes": processes}
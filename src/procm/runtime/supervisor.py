@@ -0,0 +1,135 @@
+"""
+  Per-process supervision deadlines
+
+  Each process is checked on its own schedule instead of the whole fleet every 2 seconds. A process's
+  interval starts at its 'check_interval' (2s by default) and doubles after every check that finds it
+  running and stable, up to the 'max_check_interval' daemon setting (30s by default). A process that exited
+  or restarted within its restart window goes back to its base interval, and one that is not meant to run
+  is checked at the longest interval. Checks due within a short slack of each other run together, so they
+  share one scan of the process table.
+"""
+import time
+import heapq
+import asyncio
+
+CHECK_INTERVAL = 2 # seconds between checks of a process, before backing off
+MAX_INTERVAL = 30 # seconds between checks of a stable process
+SLACK = 0.05 # fraction of an interval a check may run early, to join others
+
+class Supervisor:
+
+  def __init__(self, max_interval : float = MAX_INTERVAL):
+    """
+      Initialize with no deadlines
+
+      @params
+        max_interval = Optional : longest interval between checks of a process
+      @return
+        None
+    """
+    self.heap = [] # (deadline, name); stale entries are skipped
+    self.deadlines = {} # name -> deadline of its live entry
+    self.intervals = {} # name -> interval used for its last deadline
+    self.max_interval = max_interval
+    self.wake = asyncio.Event()
+
+  def schedule(self, name : str, delay : float):
+    """
+      Check a process after a delay, unless it is already due sooner
+
+      @params
+        name = Required : process name
+        delay = Required : seconds from now
+      @return
+        None
+    """
+    deadline = time.monotonic() + max(0, delay)
+    if name in self.deadlines and self.deadlines[name] <= deadline:
+      return
+    self.deadlines[name] = deadline
+    heapq.heappush(self.heap, (deadline, name))
+    if self.heap[0] == (deadline, name):
+      self.wake.set()
+
+  def tighten(self, name : str, base : float = CHECK_INTERVAL):
+    """
+      Go back to the base interval, e.g. after an exit
+
+      @params
+        name = Required : process name
+        base = Optional : base interval of the process
+      @return
+        None
+    """
+    self.intervals[name] = base
+    self.schedule(name, base)
+
+  def forget(self, name : str):
+    """
+      Stop checking a process
+
+      @params
+        name = Required : process name
+      @return
+        None
+    """
+    self.deadlines.pop(name, None)
+    self.intervals.pop(name, None)
+
+  def interval(self, proc):
+    """
+      Adapt the interval of a process after a check
+
+      @params
+        proc = Required : Process just checked
+      @return
+        (float) seconds until its next check
+    """
+    base = min(proc.check_interval, self.max_interval)
+    if not proc.proc_stat or proc.running in ("STOPPED", "FATAL"):
+      interval = self.max_interval # nothing to restart, only an outside start to notice
+    elif proc.running != True or proc.policy.recent():
+      interval = base
+    else:
+      interval = min(self.intervals.get(proc.name, base) * 2, self.max_interval)
+    self.intervals[proc.name] = interval
+    return interval
+
+  def due(self):
+    """
+      Take the processes whose checks are due, including those due within the slack
+
+      @return
+        (list) names
+    """
+    now = time.monotonic()
+    names = []
+    while self.heap:
+      deadline, name = self.heap[0]
+      if self.deadlines.get(name) != deadline:
+        heapq.heappop(self.heap) # rescheduled or forgotten
+      elif deadline <= now + SLACK * self.intervals.get(name, CHECK_INTERVAL):
+        heapq.heappop(self.heap)
+        del self.deadlines[name]
+        names.append(name)
+      else:
+        break
+    return names
+
+  async def sleep(self):
+    """
+      Sleep until the earliest deadline, or until an earlier one is scheduled
+
+      @return
+        None
+    """
+    while self.heap and self.deadlines.get(self.heap[0][1]) != self.heap[0][0]:
+      heapq.heappop(self.heap)
+    self.wake.clear()
+    timeout = self.heap[0][0] - time.monotonic() if self.heap else None
+    if timeout is not None and timeout <= 0:
+      return
+    try:
+      await asyncio.wait_for(self.wake.wait(), timeout)
+    except asyncio.TimeoutError:
+      pass
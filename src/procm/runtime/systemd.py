@@ -31,6 +31,7 @@ def write_systemd():
           "User=root\n"
           f"ExecStart=/usr/bin/python3 {curr_dir}/service.py\n"
           "Restart=always\n"
+          "KillMode=process\n" # the service stops its processes itself, or leaves them to be adopted (SIGUSR2)
           "TimeoutStartSec=10\n"
           "RestartSec=10\n\n"
           "[Install]\n"
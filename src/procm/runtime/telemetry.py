@@ -0,0 +1,181 @@
+"""
+  Self metrics of the service, rendered in the Prometheus text format
+
+  Histograms keep a count per bucket, so observing is a bisect and an increment, and a scrape only
+  renders the counters.
+"""
+import bisect
+from array import array
+
+LATENCY_BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+def format_labels(labels : tuple, extra : str = None):
+  """
+    Render a label set
+
+    @params
+      labels = Required : (name, value) pairs
+      extra = Optional : already rendered label to append
+    @return
+      (string) {a="b",...} or empty
+  """
+  parts = ['%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in labels]
+  if extra:
+    parts.append(extra)
+  return "{" + ",".join(parts) + "}" if parts else ""
+
+class Metric:
+
+  kind = "untyped"
+
+  def __init__(self, name : str, help : str):
+    """
+      @params
+        name = Required : metric name
+        help = Required : help text
+    """
+    self.name = name
+    self.help = help
+    self.series = {} # label tuple -> value
+
+  def render(self):
+    """
+      @return
+        (list) exposition lines
+    """
+    lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+    for labels, value in self.series.items():
+      lines.append(f"{self.name}{format_labels(labels)} {value}")
+    return lines
+
+class Counter(Metric):
+
+  kind = "counter"
+
+  def inc(self, amount : float = 1, **labels):
+    """
+      Increase the counter
+
+      @params
+        amount = Optional : increment
+        labels = Optional : label values
+      @return
+        None
+    """
+    key = tuple(sorted(labels.items()))
+    self.series[key] = self.series.get(key, 0) + amount
+
+class Gauge(Metric):
+
+  kind = "gauge"
+
+  def __init__(self, name : str, help : str, func : type(lambda: None) = None):
+    """
+      @params
+        name = Required : metric name
+        help = Required : help text
+        func = Optional : called at scrape time, returning {label tuple: value}
+    """
+    super().__init__(name, help)
+    self.func = func
+
+  def set(self, value : float, **labels):
+    """
+      Set the gauge
+
+      @params
+        value = Required : value
+        labels = Optional : label values
+      @return
+        None
+    """
+    self.series[tuple(sorted(labels.items()))] = value
+
+  def render(self):
+    if self.func is not None:
+      self.series = self.func()
+    return super().render()
+
+class Histogram(Metric):
+
+  kind = "histogram"
+
+  def __init__(self, name : str, help : str, buckets : list = LATENCY_BUCKETS):
+    """
+      @params
+        name = Required : metric name
+        help = Required : help text
+        buckets = Optional : upper bounds, ascending
+    """
+    super().__init__(name, help)
+    self.bounds = list(buckets)
+
+  def observe(self, value : float, **labels):
+    """
+      Record an observation
+
+      @params
+        value = Required : observed value
+        labels = Optional : label values
+      @return
+        None
+    """
+    key = tuple(sorted(labels.items()))
+    series = self.series.get(key)
+    if series is None:
+      series = self.series[key] = [array('Q', bytes(8 * (len(self.bounds) + 1))), 0.0]
+    series[0][bisect.bisect_left(self.bounds, value)] += 1
+    series[1] += value
+
+  def render(self):
+    lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+    for labels, (counts, total) in self.series.items():
+      cumulative = 0
+      for bound, count in zip(self.bounds + ["+Inf"], counts):
+        cumulative += count
+        le = 'le="%s"' % bound
+        lines.append(f"{self.name}_bucket{format_labels(labels, le)} {cumulative}")
+      lines.append(f"{self.name}_sum{format_labels(labels)} {total}")
+      lines.append(f"{self.name}_count{format_labels(labels)} {cumulative}")
+    return lines
+
+class Registry:
+
+  def __init__(self):
+    self.metrics = []
+
+  def add(self, metric : Metric):
+    """
+      Register a metric
+
+      @params
+        metric = Required : metric
+      @return
+        (Metric) the metric
+    """
+    self.metrics.append(metric)
+    return metric
+
+  def render(self):
+    """
+      Render every metric
+
+      @return
+        (string) Prometheus text exposition
+    """
+    lines = []
+    for metric in self.metrics:
+      lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+registry = Registry()
+
+POLL_CYCLE = registry.add(Histogram("procm_poll_cycle_seconds", "Time spent in one supervision cycle"))
+LOOP_LAG = registry.add(Histogram("procm_event_loop_lag_seconds", "Delay of timer callbacks on the service event loop"))
+COMMAND = registry.add(Histogram("procm_command_seconds", "Time to handle a control socket command"))
+SPAWN = registry.add(Histogram("procm_spawn_seconds", "Time from spawning a process until it is running"))
+RESTART_LATENCY = registry.add(Histogram("procm_restart_latency_seconds", "Time from a process exit until its replacement is running"))
+RESTARTS = registry.add(Counter("procm_restarts_total", "Processes started again after they ran before"))
+LIMIT_RESTARTS = registry.add(Counter("procm_limit_restarts_total", "Processes restarted for exceeding a resource limit"))
+PROBE_FAILURES = registry.add(Counter("procm_probe_failures_total", "Failed liveness and readiness checks"))
+COMMANDS_ACTIVE = registry.add(Gauge("procm_commands_in_progress", "Control socket commands being handled"))
@@ -0,0 +1,128 @@
+"""
+  One timer heap for many recurring actions
+
+  Rather than a sleeping task per probe, actions are kept in a heap ordered by deadline and a single
+  task sleeps until the earliest one. Due actions run as tasks, at most 'concurrency' at once; while all
+  slots are taken the heap waits, so a slow batch delays later actions instead of piling up tasks.
+"""
+import time
+import heapq
+import asyncio
+import itertools
+
+class Timers:
+
+  def __init__(self, concurrency : int = 64):
+    """
+      Initialize an empty heap
+
+      @params
+        concurrency = Optional : actions allowed to run at once
+      @return
+        None
+    """
+    self.heap = [] # (deadline, token, key, action)
+    self.current = {} # key -> token of its live entry, older entries are skipped
+    self.tokens = itertools.count()
+    self.wake = asyncio.Event()
+    self.running = set() # action tasks
+    self.limit = None
+    self.configure(concurrency)
+
+  def configure(self, concurrency : int = 64):
+    """
+      Set the concurrency limit. Actions already running keep their slot
+
+      @params
+        concurrency = Optional : actions allowed to run at once
+      @return
+        None
+    """
+    limit = max(1, concurrency or 64)
+    if limit != self.limit:
+      self.limit = limit
+      self.slots = asyncio.Semaphore(limit)
+
+  def schedule(self, key, delay : float, action):
+    """
+      Run an action after a delay, replacing any action pending under the same key
+
+      @params
+        key = Required : hashable identifying the action
+        delay = Required : seconds from now
+        action = Required : coroutine function taking no arguments
+      @return
+        None
+    """
+    token = next(self.tokens)
+    deadline = time.monotonic() + max(0, delay)
+    self.current[key] = token
+    heapq.heappush(self.heap, (deadline, token, key, action))
+    if self.heap[0][1] == token:
+      self.wake.set() # new earliest deadline
+
+  def cancel(self, key):
+    """
+      Drop the action pending under a key, if any
+
+      @params
+        key = Required : key given to schedule
+      @return
+        None
+    """
+    self.current.pop(key, None)
+
+  def pending(self, key):
+    """
+      @params
+        key = Required : key given to schedule
+      @return
+        (bool) true if an action is pending under the key
+    """
+    return key in self.current
+
+  def __finished(self, task : asyncio.Task, slots : asyncio.Semaphore):
+    """ release the slot of a finished action, reporting its error """
+    self.running.discard(task)
+    slots.release()
+    if not task.cancelled() and task.exception() is not None:
+      print(f"Timer action failed: {task.exception()!r}")
+
+  async def run(self):
+    """
+      Run due actions forever
+
+      @return
+        None
+    """
+    loop = asyncio.get_event_loop()
+    while True:
+      while self.heap and self.heap[0][0] <= time.monotonic():
+        _, token, key, action = heapq.heappop(self.heap)
+        if self.current.get(key) != token:
+          continue # cancelled or rescheduled
+        del self.current[key]
+        slots = self.slots
+        await slots.acquire()
+        task = loop.create_task(action())
+        self.running.add(task)
+        task.add_done_callback(lambda task, slots=slots: self.__finished(task, slots))
+
+      self.wake.clear()
+      timeout = self.heap[0][0] - time.monotonic() if self.heap else None
+      try:
+        await asyncio.wait_for(self.wake.wait(), timeout)
+      except asyncio.TimeoutError:
+        pass
+
+  def close(self):
+    """
+      Drop every pending action and cancel the running ones
+
+      @return
+        None
+    """
+    self.heap.clear()
+    self.current.clear()
+    for task in list(self.running):
+      task.cancel()
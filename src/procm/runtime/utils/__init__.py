@@ -1 +1,3 @@
-from . import command
\ No newline at end of file
+from . import command
+from . import proctable
+from . import inotify
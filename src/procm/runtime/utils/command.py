@@ -3,7 +3,8 @@
 """
 import subprocess
 import asyncio
-import os, pwd
+import shutil
+import os, pwd, sys, time
 from ..errors import *
 
 def exec_shell(command : str, cwd : str = None, user : str = "root"):
@@ -47,6 +48,177 @@ async def async_exec_shell(command : str, cwd : str = None, user : str = "root")
       
     return stdout.decode().strip()
 
+async def async_spawn(command : str, cwd : str = None, user : str = "root", capture : bool = False, env : dict = None, preexec : list = None):
+    """
+      Launch a long running command as a child of the current event loop, in a session and process group
+      of its own. The profile is sourced, and the command is exec'd by bash, so the returned handle's pid is
+      the command itself
+
+      @params
+        command = Required : command to execute
+        cwd = Optional : working directory
+        user = Optional : username of user to drop to
+        capture = Optional : pipe stdout and stderr to the caller instead of discarding them
+        env = Optional : environment, defaults to the current one
+        preexec = Optional : functions the child runs before dropping to the user
+      @return
+        (asyncio.subprocess.Process) handle to the child
+    """
+    output = asyncio.subprocess.PIPE if capture else asyncio.subprocess.DEVNULL
+    return await asyncio.create_subprocess_exec(
+        "bash", "-c", "source ~/.bash_profile; exec " + command, stdin=asyncio.subprocess.DEVNULL,
+        stdout=output, stderr=output, cwd=cwd, env=env, start_new_session=True, **credentials(user, preexec)
+    )
+
+async def async_exec(argv : list, executable : str, cwd : str = None, user : str = "root", env : dict = None, capture : bool = False, preexec : list = None, pass_fds : tuple = ()):
+    """
+      Launch a long running program directly, without a shell, in a session and process group of its
+      own. argv[0] is passed as given, so it can name the process independently of the executable
+
+      @params
+        argv = Required : arguments, including argv[0]
+        executable = Required : program to run, looked up in the environment's PATH if not a path
+        cwd = Optional : working directory
+        user = Optional : username of user to run as
+        env = Optional : environment, defaults to the current one
+        capture = Optional : pipe stdout and stderr to the caller instead of discarding them
+        preexec = Optional : functions the child runs before dropping to the user
+        pass_fds = Optional : fds the child inherits
+      @return
+        (asyncio.subprocess.Process) handle to the child
+      @raises
+        ProcessHandlerError if the program cannot be started
+    """
+    if "/" not in executable:
+      found = shutil.which(executable, path=(env or os.environ).get("PATH"))
+      if found is None:
+        raise ProcessHandlerError(f"Error running {executable}: not found in PATH")
+      executable = found
+
+    output = asyncio.subprocess.PIPE if capture else asyncio.subprocess.DEVNULL
+    try:
+      return await asyncio.create_subprocess_exec(
+          *argv, executable=executable, stdin=asyncio.subprocess.DEVNULL, stdout=output, stderr=output,
+          cwd=cwd, env=env, start_new_session=True, pass_fds=pass_fds, **credentials(user, preexec)
+      )
+    except (OSError, subprocess.SubprocessError) as e:
+      raise ProcessHandlerError(f"Error running {executable}: {e}")
+
+async def async_wait_pid(pid : int, timeout : float):
+    """
+      Wait for a process that is not a child of this interpreter to exit. Uses a pidfd where available,
+      otherwise checks for it every 0.1s with a null signal
+
+      @params
+        pid = Required : process id
+        timeout = Required : seconds to wait at most
+      @return
+        (bool) true if it exited
+    """
+    if pid <= 0:
+      return True
+    loop = asyncio.get_event_loop()
+
+    try:
+      fd = os.pidfd_open(pid)
+    except ProcessLookupError:
+      return True
+    except (AttributeError, OSError):
+      fd = None
+
+    if fd is not None:
+      exited = loop.create_future()
+      loop.add_reader(fd, lambda: exited.done() or exited.set_result(True))
+      try:
+        await asyncio.wait_for(exited, timeout)
+        return True
+      except asyncio.TimeoutError:
+        return False
+      finally:
+        loop.remove_reader(fd)
+        os.close(fd)
+
+    return await async_wait_group(pid, timeout, os.kill)
+
+async def async_wait_group(pgid : int, timeout : float, probe = os.killpg):
+    """
+      Wait for every member of a process group to exit, checking every 0.1s with a null signal
+
+      @params
+        pgid = Required : process group id
+        timeout = Required : seconds to wait at most
+        probe = Optional : function sending the null signal
+      @return
+        (bool) true if the group is gone
+    """
+    deadline = time.monotonic() + timeout
+
+    while pgid > 0:
+      try:
+        probe(pgid, 0)
+      except ProcessLookupError:
+        return True
+      except PermissionError:
+        pass
+      if time.monotonic() >= deadline:
+        return False
+      await asyncio.sleep(0.1)
+    return True
+
+def pidfd_watcher(loop : asyncio.AbstractEventLoop):
+    """
+      Have the event loop learn of child exits through pidfds, rather than a thread per child as Python
+      before 3.12 does by default
+
+      @params
+        loop = Required : event loop children are started from
+      @return
+        (bool) true if installed
+    """
+    if sys.version_info >= (3, 12) or not hasattr(os, "pidfd_open"):
+      return False
+    try:
+      os.close(os.pidfd_open(os.getpid()))
+    except OSError:
+      return False
+
+    watcher = asyncio.PidfdChildWatcher()
+    watcher.attach_loop(loop)
+    asyncio.set_child_watcher(watcher)
+    return True
+
+def credentials(user : str, preexec : list = None):
+  """
+    Subprocess arguments to run as another user. On Python 3.9+ the ids are set by subprocess itself,
+    which keeps the fast spawn path available; with preexec functions, or on older versions, the child
+    runs them and then drop_perms
+
+    @params
+      user = Required : username of user to run as
+      preexec = Optional : functions the child runs before dropping to the user
+    @return
+      (dict) keyword arguments for subprocess
+  """
+  try:
+    pwdu = pwd.getpwnam(user)
+  except KeyError:
+    raise ProcessHandlerError(f"Error running as {user}. Halted.")
+
+  same = pwdu.pw_uid == os.geteuid() and pwdu.pw_gid == os.getegid()
+  if preexec or (not same and sys.version_info < (3, 9)):
+    hooks = list(preexec or []) + ([] if same else [drop_perms(user)])
+
+    def func():
+      """wrapper function"""
+      for hook in hooks:
+        hook()
+
+    return {"preexec_fn": func}
+
+  if same:
+    return {}
+  return {"user": pwdu.pw_uid, "group": pwdu.pw_gid, "extra_groups": os.getgrouplist(user, pwdu.pw_gid)}
+
 def drop_perms(user : str):
   """
     setuid/guid to another user, dropping permissions
@@ -63,8 +235,10 @@ def drop_perms(user : str):
 
   def func():
     """wrapper function"""
-    os.setgid(pwdu.pw_uid)
-    os.setuid(pwdu.pw_gid)
+    if pwdu.pw_uid != os.geteuid():
+      os.initgroups(user, pwdu.pw_gid)
+    os.setgid(pwdu.pw_gid)
+    os.setuid(pwdu.pw_uid)
     os.environ.update({'HOME': pwdu.pw_dir, 'LOGNAME': user, 'USER': user, 'USERNAME': user})
     os.environ.pop('MAIL', None)
 
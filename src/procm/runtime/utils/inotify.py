@@ -0,0 +1,99 @@
+"""
+  Minimal inotify bindings through libc, used to watch the config file without polling
+"""
+import os
+import struct
+import ctypes, ctypes.util
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o0004000
+
+EVENT = struct.Struct("iIII")
+
+class Inotify:
+
+  def __init__(self):
+    """
+      Open a non-blocking inotify instance
+
+      @return
+        None
+      @raises
+        OSError if inotify is unavailable
+    """
+    self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+    if not hasattr(self.libc, "inotify_init1"):
+      raise OSError("inotify is not supported on this system")
+
+    self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    if self.fd < 0:
+      raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+  def fileno(self):
+    """
+      @return
+        (int) the inotify file descriptor, readable when events are pending
+    """
+    return self.fd
+
+  def add(self, path : str, mask : int):
+    """
+      Watch a path
+
+      @params
+        path = Required : file or directory to watch
+        mask = Required : IN_* event mask
+      @return
+        (int) watch descriptor
+      @raises
+        OSError if the path cannot be watched
+    """
+    wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+    if wd < 0:
+      errno = ctypes.get_errno()
+      raise OSError(errno, os.strerror(errno), path)
+    return wd
+
+  def read(self):
+    """
+      Drain pending events without blocking
+
+      @return
+        (list) (watch descriptor, mask, name) tuples
+    """
+    events = []
+
+    while True:
+      try:
+        data = os.read(self.fd, 65536)
+      except BlockingIOError:
+        return events
+
+      offset = 0
+      while offset < len(data):
+        wd, mask, _, size = EVENT.unpack_from(data, offset)
+        offset += EVENT.size
+        name = data[offset:offset + size].rstrip(b"\0").decode(errors="replace")
+        offset += size
+        events.append((wd, mask, name))
+
+  def close(self):
+    """
+      Close the inotify instance
+
+      @return
+        None
+    """
+    os.close(self.fd)
@@ -0,0 +1,108 @@
+"""
+  Read the system process table in a single pass
+"""
+import os
+import psutil
+
+PREFIX = "procm_p_"
+
+def scan_procs(prefix : str = PREFIX):
+    """
+      Scan the process table once and index managed processes by name, using the argv0 they were
+      started with (procm_p_<name>). Replaces a pidof fork per process
+
+      @params
+        prefix = Optional : argv0 prefix of managed processes
+      @return
+        (dict) process name -> lowest matching pid
+    """
+    if not os.path.isdir("/proc"):
+      return _scan_psutil(prefix)
+
+    pids = {}
+    raw = prefix.encode()
+
+    for entry in os.listdir("/proc"):
+      if not entry.isdigit():
+        continue
+
+      try:
+        with open(f"/proc/{entry}/cmdline", "rb") as f:
+          argv0 = f.read(4096).split(b"\0", 1)[0]
+      except OSError:
+        continue # exited during the scan, or not readable
+
+      if argv0.startswith(raw):
+        _index(pids, argv0[len(raw):].decode(errors="replace"), int(entry))
+
+    return pids
+
+def check_pid(pid : int, name : str, prefix : str = PREFIX):
+    """
+      Confirm that a pid still runs a managed process, by its argv0, without scanning the process table.
+      Guards against the pid having been reused
+
+      @params
+        pid = Required : pid last seen for the process
+        name = Required : process name
+        prefix = Optional : argv0 prefix of managed processes
+      @return
+        (bool) true if the pid runs procm_p_<name>
+    """
+    if not os.path.isdir("/proc"):
+      try:
+        cmdline = psutil.Process(pid).cmdline()
+      except psutil.Error:
+        return False
+      return len(cmdline) > 0 and cmdline[0] == prefix + name
+
+    try:
+      with open(f"/proc/{pid}/cmdline", "rb") as f:
+        return f.read(4096).split(b"\0", 1)[0] == (prefix + name).encode()
+    except OSError:
+      return False
+
+def start_time(pid : int):
+    """
+      When a process started, which together with its pid identifies it across pid reuse
+
+      @params
+        pid = Required : process id
+      @return
+        (float or None) clock ticks since boot (seconds since the epoch without procfs), None if it is gone
+    """
+    if not os.path.isdir("/proc"):
+      try:
+        return psutil.Process(pid).create_time()
+      except psutil.Error:
+        return None
+
+    try:
+      with open(f"/proc/{pid}/stat", "rb") as f:
+        data = f.read()
+      return float(data[data.rindex(b")") + 2:].split()[19]) # field 22, counting from the state after the name
+    except (OSError, ValueError, IndexError):
+      return None
+
+def _scan_psutil(prefix : str):
+    """
+      Portable fallback of scan_procs for systems without procfs
+
+      @params
+        prefix = Required : argv0 prefix of managed processes
+      @return
+        (dict) process name -> lowest matching pid
+    """
+    pids = {}
+
+    for proc in psutil.process_iter(['pid', 'cmdline']):
+      cmdline = proc.info['cmdline']
+      if cmdline and cmdline[0].startswith(prefix):
+        _index(pids, cmdline[0][len(prefix):], proc.info['pid'])
+
+    return pids
+
+def _index(pids : dict, name : str, pid : int):
+    """ keep the lowest pid per name, similar to pidof -s """
+    if name not in pids or pid < pids[name]:
+      pids[name] = pid
@@ -0,0 +1,166 @@
+"""
+  Resource limits enforced by restarting
+
+  A process's "limits" config restarts it gracefully once a resource stays above a threshold for a
+  while, judged on the samples the service takes every metrics.INTERVAL seconds:
+    max_rss      : bytes, or a size such as "512M" or "2G"
+    max_cpu      : percent of one CPU, e.g. "95%"
+    max_open_fds : count
+  Each may end in "for DURATION" ("60s", "5m", "1h"); without it, one sample over the threshold is enough.
+  e.g. {"max_rss": "2G for 60s", "max_cpu": "95% for 5m", "max_open_fds": 4096}
+"""
+import functools
+
+RULES = {"max_rss": "rss", "max_cpu": "cpu", "max_open_fds": "fds"} # limit -> sample field
+SIZES = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+DURATIONS = {"": 1, "s": 1, "m": 60, "h": 3600}
+
+def parse_size(text : str):
+  """
+    Parse a byte count with an optional K, M, G or T suffix (powers of 1024)
+
+    @params
+      text = Required : size
+    @return
+      (int) bytes
+    @raises
+      ValueError on an invalid size
+  """
+  text = text.strip().upper()
+  if text.endswith("B"):
+    text = text[:-1] # "2GB", "512B"
+  unit = text[-1:] if text[-1:] in SIZES else ""
+  return int(float(text[:len(text) - len(unit)]) * SIZES[unit])
+
+def parse_duration(text : str):
+  """
+    Parse a duration with an optional s, m or h suffix
+
+    @params
+      text = Required : duration
+    @return
+      (float) seconds
+    @raises
+      ValueError on an invalid duration
+  """
+  text = text.strip().lower()
+  unit = text[-1:] if text[-1:] in DURATIONS else ""
+  return float(text[:len(text) - len(unit)]) * DURATIONS[unit]
+
+@functools.lru_cache(maxsize=1024)
+def parse_rule(key : str, value):
+  """
+    Parse one limit
+
+    @params
+      key = Required : limit name, from RULES
+      value = Required : threshold, optionally followed by "for DURATION"
+    @return
+      (float, float) threshold in sample units, seconds it must be exceeded for
+    @raises
+      ValueError on an invalid limit
+  """
+  if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+    raise ValueError(f"invalid {key} {value}")
+  if not isinstance(value, str):
+    return float(value), 0.0
+
+  threshold, _, duration = value.partition(" for ")
+  threshold = threshold.strip()
+  if key == "max_rss":
+    limit = parse_size(threshold)
+  elif key == "max_cpu":
+    limit = float(threshold.rstrip("%"))
+  else:
+    limit = int(threshold)
+  return float(limit), parse_duration(duration) if duration else 0.0
+
+def validate(limits : dict):
+  """
+    Check a limits config
+
+    @params
+      limits = Required : limits config
+    @return
+      (string or None) error message, None if valid
+  """
+  if not isinstance(limits, dict) or not set(limits) <= set(RULES):
+    return f"limits must be an object with keys {list(RULES)}"
+  for key, value in limits.items():
+    try:
+      threshold, duration = parse_rule(key, value)
+    except (ValueError, TypeError):
+      return f"invalid limit {key}: {value}, expected e.g. \"2G for 60s\", \"95% for 5m\" or 4096"
+    if threshold <= 0 or duration < 0:
+      return f"limit {key} must be positive"
+  return None
+
+def format_value(key : str, value : float):
+  """
+    Format a sample value for a message
+
+    @params
+      key = Required : limit name
+      value = Required : value in sample units
+    @return
+      (string) e.g. "2.1G", "97%" or "4100"
+  """
+  if key == "max_cpu":
+    return f"{value:.0f}%"
+  if key == "max_rss":
+    for unit in ["B", "K", "M", "G"]:
+      if abs(value) < 1024:
+        return f"{value:.1f}{unit}"
+      value /= 1024
+    return f"{value:.1f}T"
+  return f"{value:.0f}"
+
+class Watchdog:
+
+  def __init__(self):
+    """
+      Initialize with no breaches
+
+      @return
+        None
+    """
+    self.breaches = {} # (process name, limit) -> (pid, monotonic time the limit was first exceeded)
+
+  def check(self, proc, sample : dict, now : float):
+    """
+      Compare a process's latest sample against its limits
+
+      @params
+        proc = Required : Process
+        sample = Required : latest sample, see metrics.History.add
+        now = Required : monotonic time
+      @return
+        (string, string or None) limit exceeded for long enough and a description, (None, None) if none
+    """
+    for key, value in proc.limits.items():
+      threshold, duration = parse_rule(key, value)
+      current = sample[RULES[key]]
+      if current <= threshold:
+        self.breaches.pop((proc.name, key), None)
+        continue
+
+      pid, since = self.breaches.get((proc.name, key), (None, now))
+      if pid != proc.pid:
+        since = now # first breach by this child
+      self.breaches[(proc.name, key)] = (proc.pid, since)
+      if now - since >= duration:
+        held = f" for {now - since:.0f}s" if duration else ""
+        return key, f"{key.split('_', 1)[1]} {format_value(key, current)} above {format_value(key, threshold)}{held}"
+    return None, None
+
+  def forget(self, name : str):
+    """
+      Drop the breaches of a process, e.g. after it was restarted or removed
+
+      @params
+        name = Required : process name
+      @return
+        None
+    """
+    for key in [key for key in self.breaches if key[0] == name]:
+      del self.breaches[key]
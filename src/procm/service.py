@@ -7,27 +7,133 @@ from runtime.config import *
 from runtime.process import *
 from runtime.socket import *
 from runtime.core import *
+from runtime.selector import Index
+from runtime.scheduler import Scheduler
+from runtime.timers import Timers
+from runtime.watchdog import Watchdog
+from runtime.supervisor import Supervisor, MAX_INTERVAL
+from runtime import pool
+from runtime.activation import Activation
+from runtime.state import StateFile
+from runtime.status import StatusTable
+from runtime.logs import LogStream
+from runtime import metrics
+from runtime import telemetry
+from runtime.utils.proctable import scan_procs
+from runtime.utils.command import pidfd_watcher
 
 import time
+import random
+import signal
 import asyncio
 
+COMMANDS = ["reload", "start", "stop", "restart", "start-all", "stop-all", "restart-all", "rolling-restart", "logs", "stats", "metrics"]
+
 class Service:
 
   def __init__(self):
     """ Run init tasks, start 'enabled' processes """
+    pidfd_watcher(asyncio.get_event_loop())
     self.socket = Socket(self.process_message)
-    self.processes = fetch_processes()
+    self.processes = []
+    self.specs = {} # name -> config entry each process was last configured from
+    self.names = {} # name -> process
+    self.index = Index() # selector index over specs
+    self.watch = config.watch()
+    self.status = StatusTable()
+    self.metrics = metrics.Metrics()
+    self.active = 0 # commands being handled
+    self.scheduler = Scheduler(resolve=self.get_proc)
+    self.activation = Activation()
+    self.timers = Timers() # health probes
+    self.supervisor = Supervisor() # supervision check deadlines
+    self.watchdog = Watchdog()
+    self.recycling = set() # names of processes being restarted for exceeding a limit
+    self.tasks = [] # background loops run by listen
+    self.stopping = None # shutdown task, once SIGTERM is received
+    self.state = StateFile(self.__snapshot)
+    self.saved = self.state.load() # name -> state left by a previous service, adopted by the first reload
+    telemetry.registry.add(telemetry.Gauge("procm_processes", "Managed processes by state", self.__states))
+    self.reload()
+    self.saved = {}
         
   async def listen(self):
     """
-      Listens on the socket and processes messages. Runs forever
+      Listens on the socket and processes messages. Runs until SIGTERM, which shuts the fleet down
 
       @return 
         None
     """
-    await asyncio.wait([self.socket.async_listen(), # run in background
-                        self.manage_procs()])
-    
+    loop = asyncio.get_event_loop()
+    if self.watch is not None:
+      loop.add_reader(self.watch, self.config_changed)
+    loop.add_signal_handler(signal.SIGTERM, self.terminate)
+    loop.add_signal_handler(signal.SIGUSR2, self.detach)
+
+    self.tasks = [loop.create_task(self.socket.async_listen()), # run in background
+                  loop.create_task(self.manage_procs()),
+                  loop.create_task(self.sample_procs()),
+                  loop.create_task(self.watch_loop()),
+                  loop.create_task(self.timers.run())] \
+                 + ([loop.create_task(self.serve_metrics(config.setting('metrics_port')))] if config.setting('metrics_port') else [])
+    await asyncio.wait(self.tasks)
+    if self.stopping is not None:
+      await self.stopping
+
+  def terminate(self):
+    """
+      SIGTERM handler: start shutting down, once
+
+      @return
+        None
+    """
+    if self.stopping is None:
+      self.stopping = asyncio.get_event_loop().create_task(self.shutdown())
+
+  def detach(self):
+    """
+      SIGUSR2 handler: exit leaving every process running, to be adopted by the next service (e.g. after
+      an upgrade, restarted by systemd). Their output is no longer captured once this service is gone
+
+      @return
+        None
+    """
+    if self.stopping is not None:
+      return
+    for task in self.tasks:
+      task.cancel()
+    self.timers.close()
+    self.state.freeze()
+    for proc in self.processes:
+      proc.on_exit = None
+      proc.on_change = None
+    self.stopping = asyncio.get_event_loop().create_task(self.__close())
+
+  async def shutdown(self):
+    """
+      Stop every process in parallel, all under the 'shutdown_timeout' daemon setting (30s by default)
+      at most, then stop listening. The state saved beforehand has the next service start them again
+
+      @return
+        None
+    """
+    for task in self.tasks:
+      task.cancel() # no more restarts or commands
+    self.timers.close()
+    self.state.freeze()
+
+    deadline = config.setting('shutdown_timeout', 30)
+    await asyncio.gather(*[proc.stop(timeout=min(proc.stop_timeout, deadline)) for proc in self.processes], return_exceptions=True)
+    for proc in self.processes:
+      proc.on_change = None
+    await self.__close()
+
+  async def __close(self):
+    """ flush the logs, release the listening sockets and the status table """
+    await asyncio.gather(*[proc.close_logs() for proc in self.processes], return_exceptions=True)
+    self.activation.close()
+    self.status.close()
+
   def get_proc(self, name : str):
     """
       Given a name, return the process or false
@@ -37,10 +143,267 @@ class Service:
       @return
         (bool or Process) object or False
     """
-    for proc in self.processes:
-      if proc.name == name:
-        return proc
-    return False
+    return self.names.get(name, False)
+
+  def select(self, criteria : dict):
+    """
+      Return the processes matching selection criteria, see Index.match
+
+      @params
+        criteria = Required : criteria to match by
+      @return
+        (list) processes
+    """
+    return [self.names[spec['name']] for spec in self.index.match(criteria)]
+
+  def reload(self):
+    """
+      Reconcile the live process list against the config. Only added, removed, or changed entries are
+      touched: unchanged processes keep their objects, children, and state
+
+      @return
+        None
+    """
+    config.reload()
+    specs = config.get_members({"all": True})
+    live = {proc.name: proc for proc in self.processes}
+    pids = scan_procs() if any(spec['name'] not in live and spec['name'] not in self.saved for spec in specs) else None
+    processes = []
+
+    for spec in specs:
+      proc = live.pop(spec['name'], None)
+
+      if proc is None:
+        proc = Process(**spec, pids=pids, state=self.saved.pop(spec['name'], None))
+        proc.on_exit = self.handle_exit
+        proc.on_change = self.__changed
+      elif self.specs.get(proc.name) is not spec and self.specs.get(proc.name) != spec:
+        proc.configure(**spec)
+        self.index.add(spec)
+        self.supervisor.schedule(proc.name, 0)
+
+      if proc.name not in self.specs:
+        self.index.add(spec)
+        self.supervisor.schedule(proc.name, 0)
+      self.specs[proc.name] = spec
+      self.names[proc.name] = proc
+      processes.append(proc)
+
+    for proc in live.values():
+      """ removed from config, or no longer valid (e.g. script missing mid-deploy), which is left running """
+      proc.on_exit = None
+      proc.on_change = None
+      self.activation.disarm(proc)
+      del self.specs[proc.name]
+      del self.names[proc.name]
+      self.index.remove(proc.name)
+      self.metrics.forget(proc.name)
+      self.watchdog.forget(proc.name)
+      self.supervisor.forget(proc.name)
+      if not self.__configured(proc):
+        asyncio.get_event_loop().create_task(self.__remove(proc))
+
+    if len(live) > 0 or len(processes) != len(self.processes):
+      self.status.publish(processes)
+      self.state.touch()
+    self.processes = processes
+    self.scheduler.configure(config.setting('concurrency'))
+    self.supervisor.max_interval = config.setting('max_check_interval', MAX_INTERVAL)
+    for name, error in self.activation.sync(processes).items():
+      print(f"{name}: {error}")
+
+    self.timers.configure(config.setting('probe_concurrency', 64))
+    for proc in processes:
+      for kind, probe in proc.probes.items():
+        if not self.timers.pending((proc.name, kind)):
+          self.schedule_probe(proc.name, kind, random.uniform(0, probe.config['interval'])) # spread the first checks
+
+  def __changed(self, proc : Process):
+    """ on_change listener: publish the state of a process and have the snapshot saved """
+    self.status.update(proc)
+    self.state.touch()
+
+  def __snapshot(self):
+    """ runtime state of every process, saved for the next service """
+    return {proc.name: proc.snapshot() for proc in self.processes}
+
+  def __configured(self, proc : Process):
+    """
+      Determine if a process is still in the config, valid or not. A pool member is while its pool has
+      at least as many instances as its index
+
+      @params
+        proc = Required : process
+      @return
+        (bool) true if configured
+    """
+    if proc.pool is None:
+      return config.check_exist({"name": proc.name})
+    spec = config.index.get(proc.pool)
+    return spec is not None and (pool.size(spec) or 0) > int(proc.name.rsplit(pool.SEPARATOR, 1)[1])
+
+  async def __remove(self, proc : Process):
+    """
+      Tear down a process removed from the config
+
+      @params
+        proc = Required : process
+      @return
+        None
+    """
+    await proc.stop()
+    await proc.close_logs()
+    if proc.cgroup is not None:
+      proc.cgroup.remove()
+
+  def config_changed(self):
+    """
+      Called when inotify reports a change to the config file, passwd, or a script directory. Hand edits
+      are picked up without an 'r' message
+
+      @return
+        None
+    """
+    if config.changes():
+      try:
+        self.reload()
+      except ConfigFileError as e:
+        print(f"Config not reloaded: {e}")
+
+  async def handle_exit(self, proc : Process):
+    """
+      Called as soon as a child exits, or is found dead. Restarts it unless it was manually stopped
+      or is disabled; a lazy socket activated process instead waits for its next connection
+
+      @params
+        proc = Required : process that exited
+      @return
+        None
+    """
+    self.supervisor.tighten(proc.name, proc.check_interval)
+    if proc.running != False or not proc.proc_stat or proc.replacing:
+      return
+
+    if proc.lazy:
+      self.activation.arm(proc, self.activate)
+      return
+
+    await self.__restart(proc)
+
+  def activate(self, proc : Process):
+    """
+      Called when a connection arrives for a lazy process that is not running
+
+      @params
+        proc = Required : process
+      @return
+        None
+    """
+    if proc.running == False and proc.proc_stat:
+      asyncio.get_event_loop().create_task(self.__restart(proc))
+
+  async def __restart(self, proc : Process):
+    """
+      Restart an exited process: right away the first time, with exponential backoff while it keeps
+      crashing soon after starting, and not at all (FATAL) once its restart budget is spent
+
+      @params
+        proc = Required : process that exited
+      @return
+        None
+    """
+    if proc.running != False or not proc.proc_stat:
+      return
+
+    if proc.started_at is not None:
+      delay = proc.policy.exited(proc.exit_code, time.time() - proc.started_at)
+
+      if delay is None:
+        proc.running = "FATAL"
+        proc.changed()
+        print(f"{proc.name} restarted {proc.policy.options['max_restarts']} times in {proc.policy.options['window']}s, giving up")
+        return
+
+      if delay > 0:
+        proc.running = "BACKOFF"
+        proc.changed()
+        await asyncio.sleep(delay)
+        if proc.running != "BACKOFF":
+          return # stopped or started by hand meanwhile
+        proc.running = False
+
+    start = time.perf_counter()
+    await proc.start()
+    if proc.running == True:
+      telemetry.RESTART_LATENCY.observe(time.perf_counter() - start)
+
+  def schedule_probe(self, name : str, kind : str, delay : float):
+    """
+      Schedule the next check of a process's probe
+
+      @params
+        name = Required : process name
+        kind = Required : liveness or readiness
+        delay = Required : seconds from now
+      @return
+        None
+    """
+    self.timers.schedule((name, kind), delay, lambda: self.__probe(name, kind))
+
+  async def __probe(self, name : str, kind : str):
+    """
+      Check a running process's probe once and schedule the next check, until the process or the probe
+      leaves the config. A liveness probe failing 'failures' times in a row restarts the process
+
+      @params
+        name = Required : process name
+        kind = Required : liveness or readiness
+      @return
+        None
+    """
+    proc = self.names.get(name)
+    probe = proc.probes.get(kind) if proc else None
+    if probe is None:
+      return
+
+    delay = probe.config['interval']
+    try:
+      if proc.running != True or proc.pid <= 0 or proc.replacing:
+        probe.watch(None)
+      elif probe.watch(proc.pid) and probe.config['delay'] > 0:
+        delay = probe.config['delay'] # give a new child time to come up
+      else:
+        health = proc.health()
+        passed = await probe.check(proc.user, proc.pwd)
+        if probe.pid != proc.pid:
+          return # replaced meanwhile
+        failed = probe.record(passed)
+        if not passed:
+          telemetry.PROBE_FAILURES.inc(probe=kind)
+        if proc.health() != health:
+          proc.changed()
+        if failed and kind == "liveness":
+          print(f"{name} failed {probe.failures} liveness checks, restarting")
+          probe.watch(None)
+          asyncio.get_event_loop().create_task(self.__recover(proc))
+    finally:
+      if proc.probes.get(kind) is probe and self.names.get(name) is proc:
+        self.schedule_probe(name, kind, delay)
+
+  async def __recover(self, proc : Process):
+    """
+      Restart an unresponsive process. It counts as a crash for the restart policy, so a process that keeps
+      hanging backs off like one that keeps exiting
+
+      @params
+        proc = Required : process
+      @return
+        None
+    """
+    await proc.stop()
+    if proc.running == "STOPPED":
+      proc.running = False
+      await self.__restart(proc)
 
   async def __run_routine(self, tasks : list):
     """
@@ -53,97 +416,368 @@ class Service:
     """
     if len(tasks) > 0:
       await asyncio.wait(tasks)
-  
-  async def process_message(self, message : str):
+
+  async def __run_action(self, procs : list, action : str):
     """
-      Process a message received from a socket
+      Run start, stop, or restart on processes through the scheduler: in dependency order (stops in
+      reverse), independent ones concurrently up to the concurrency limit. A restart stops everything
+      selected, then starts it again
 
       @params
-        message = Required : message to process
+        procs = Required : processes
+        action = Required : method name
       @return
-        None
+        (dict) names of the processes acted on
+      @raises
+        ProcessHandlerError listing the processes the action failed for
+    """
+    if action in ("start", "restart"):
+      for proc in procs:
+        proc.policy.reset() # a manual start clears crash loop backoff and FATAL
+
+    failed = {}
+    if action in ("stop", "restart"):
+      failed.update(await self.scheduler.run(procs, lambda proc: proc.stop(), reverse=True, throttle=False))
+    if action in ("start", "restart"):
+      failed.update(await self.scheduler.run(procs, lambda proc: proc.start()))
+
+    if len(failed) > 0:
+      raise ProcessHandlerError(f"Failed to {action} {({name: str(e) for name, e in failed.items()})}")
+    return {"names": [proc.name for proc in procs]}
+
+  async def __roll(self, procs : list, batch : int):
     """
-    if message == "r":
+      Rolling restart: replace processes a batch at a time, each new instance taking over once it is
+      ready, and stop at the first batch where one is not
+
+      @params
+        procs = Required : processes
+        batch = Required : processes replaced at once
+      @return
+        (dict) names of the processes replaced
+      @raises
+        ProcessHandlerError naming the processes that were not replaced
+    """
+    batch = max(1, batch)
+    for i in range(0, len(procs), batch):
+      group = procs[i:i + batch]
+      for proc in group:
+        proc.policy.reset()
+      results = await asyncio.gather(*[proc.replace() for proc in group], return_exceptions=True)
+      failed = {proc.name: str(result) for proc, result in zip(group, results) if isinstance(result, BaseException)}
+      if len(failed) > 0:
+        skipped = [proc.name for proc in procs[i + batch:]]
+        raise ProcessHandlerError(f"Rolling restart aborted: {failed}" + (f", not restarted: {skipped}" if skipped else ""))
+    return {"names": [proc.name for proc in procs]}
+
+  async def process_message(self, cmd : str, args : dict):
+    """
+      Process a request received from the socket, timing it
+
+      @params
+        cmd = Required : command
+        args = Required : command arguments
+      @return
+        (any) result sent back to the client
+    """
+    start = time.perf_counter()
+    self.active += 1
+    telemetry.COMMANDS_ACTIVE.set(self.active)
+    try:
+      return await self.__handle(cmd, args)
+    finally:
+      self.active -= 1
+      telemetry.COMMANDS_ACTIVE.set(self.active)
+      telemetry.COMMAND.observe(time.perf_counter() - start, command=cmd if cmd in COMMANDS else "unknown")
+
+  async def __handle(self, cmd : str, args : dict):
+    """
+      Run a command
+
+      @params
+        cmd = Required : command
+        args = Required : command arguments
+      @return
+        (any) result sent back to the client
+      @raises
+        ProtocolError on an unknown command, ProcessHandlerError if the command fails
+    """
+    if cmd == "reload":
       """ Reload the process list """
-      self.processes = fetch_processes()
-      
-    elif "restart " in message:
-      """ restart the proc given 'restart <procname>' """
-      proc = self.get_proc(message.split()[1])
-      if proc:
-        await proc.restart()
-        
-    elif "start " in message:
-      """ starts the proc given 'start <procname>' - must go after restart"""
-      proc = self.get_proc(message.split()[1])
-      if proc:
-        await proc.start()
-        
-    elif "stop " in message:
-      """ stop the proc given 'stop <procname>' """
-      proc = self.get_proc(message.split()[1])
-      if proc:
-        await proc.stop()
-  
-    elif "stop-all" in message:
+      self.reload()
+      return {"processes": len(self.processes)}
+
+    elif cmd in ("start", "stop", "restart"):
+      """ act on the procs matching 'name', 'path', or 'select' """
+      procs = self.select(args)
+      if len(procs) == 0:
+        raise ProcessHandlerError(f"No process matches {args}")
+      return await self.__run_action(procs, cmd)
+
+    elif cmd == "stop-all":
       """ halt everything """
-      tasks = []
-      for proc in self.processes:  # can we optimize these three loops?
-        tasks.append(asyncio.get_event_loop().create_task(proc.stop()))
-      await self.__run_routine(tasks)
-        
-    elif "restart-all" in message:
+      return await self.__run_action(self.processes, "stop")
+
+    elif cmd == "restart-all":
       """ restart everything """
-      tasks = []
-      for proc in self.processes:
-        if proc.proc_stat:
-          tasks.append(asyncio.get_event_loop().create_task(proc.restart()))
-      await self.__run_routine(tasks)
-        
-    elif "start-all" in message:
+      return await self.__run_action([proc for proc in self.processes if proc.proc_stat], "restart")
+
+    elif cmd == "start-all":
       """ start everything """
-      tasks = []
-      for proc in self.processes: 
-        if proc.proc_stat:
-          tasks.append(asyncio.get_event_loop().create_task(proc.start()))
-      await self.__run_routine(tasks)
+      return await self.__run_action([proc for proc in self.processes if proc.proc_stat], "start")
+
+    elif cmd == "rolling-restart":
+      """ replace the procs matching the criteria (or all enabled ones) without a gap, 'batch' at a time """
+      procs = self.select(args) if any(args.get(k) for k in ("name", "path", "select")) else [proc for proc in self.processes if proc.proc_stat]
+      if len(procs) == 0:
+        raise ProcessHandlerError(f"No process matches {args}")
+      return await self.__roll(procs, int(args.get('batch') or 1))
+
+    elif cmd == "logs":
+      """ stream the last 'lines' lines of a process's 'stream' (stdout or stderr), and 'follow' it """
+      procs = self.select({"name": args.get('name')})
+      if len(procs) != 1:
+        raise ProcessHandlerError(f"logs needs exactly one process, {len(procs)} match {args.get('name')}")
+      if args.get('stream', "stdout") not in ("stdout", "stderr"):
+        raise ProtocolError(f"Unknown stream: {args['stream']}")
+      writer = procs[0].log_writer(args.get('stream', "stdout"))
+      return await LogStream(writer, int(args.get('lines', 10)), bool(args.get('follow'))).open()
+
+    elif cmd == "stats":
+      """ resource usage of the procs matching the criteria, or all """
+      procs = self.select(args) if any(args.get(k) for k in ("name", "path", "select")) else self.processes
+      return {proc.name: self.metrics.report(proc.name, int(args.get('points', 30))) for proc in procs}
+
+    elif cmd == "metrics":
+      """ service self metrics, in the Prometheus text format """
+      return telemetry.registry.render()
 
-  async def poll_procs(self):
+    raise ProtocolError(f"Unknown command: {cmd}")
+
+  async def poll_procs(self, procs : list = None):
     """
-      Runs poll on all processes
+      Runs poll on processes not owned by the service whose last pid cannot be confirmed cheaply, against
+      one scan of the process table done off the event loop. Owned children report their own exits
 
+      @params
+        procs = Optional : processes to check, defaults to all
       @return 
         None
     """    
-    for proc in self.processes:
-      proc.poll()
+    unowned = [proc for proc in (self.processes if procs is None else procs) if not proc.verify()]
+
+    if len(unowned) > 0:
+      pids = await asyncio.get_event_loop().run_in_executor(None, scan_procs)
+      for proc in unowned:
+        proc.poll(pids)
       
-  async def restart_stopped(self):
+  async def restart_stopped(self, procs : list = None):
     """
-      Loop through procs and restart stopped ones, assuming it was not manually stopped (status = "STOPPED")
+      Loop through procs and restart stopped ones, assuming it was not manually stopped (status = "STOPPED"),
+      subject to the restart policy. Processes never started by this service (i.e. at boot) are started
+      through the scheduler, and lazy ones wait for a connection
 
+      @params
+        procs = Optional : processes to check, defaults to all
       @return 
         None
     """
     tasks = []
+    fresh = []
 
-    for proc in self.processes:
+    for proc in (self.processes if procs is None else procs):
       if proc.running == False and proc.proc_stat:
-        tasks.append(asyncio.get_event_loop().create_task(proc.start()))
+        if proc.lazy:
+          self.activation.arm(proc, self.activate)
+        elif proc.started_at is None:
+          fresh.append(proc)
+        else:
+          tasks.append(asyncio.get_event_loop().create_task(self.handle_exit(proc)))
+
+    if len(fresh) > 0:
+      tasks.append(asyncio.get_event_loop().create_task(self.scheduler.run(fresh, lambda proc: proc.start())))
 
     await self.__run_routine(tasks)
-  
+
+  async def sample_procs(self):
+    """
+      Sample the resource usage of all running processes in one pass off the event loop, every
+      metrics.INTERVAL seconds
+
+      @return 
+        None
+    """
+    loop = asyncio.get_event_loop()
+
+    while True:
+      pids = {proc.name: proc.pid for proc in self.processes if proc.running == True and proc.pid > 0}
+      cgroups = {proc.name: proc.cgroup for proc in self.processes if proc.cgroup is not None}
+      if len(pids) > 0:
+        raw = await loop.run_in_executor(None, metrics.sample, pids, cgroups)
+        self.metrics.record(raw)
+        self.stop_idle(raw)
+        self.enforce_limits(raw)
+      await asyncio.sleep(metrics.INTERVAL)
+
+  def stop_idle(self, raw : dict):
+    """
+      Stop lazy processes that have used no CPU for their idle_timeout. They start again on the next
+      connection
+
+      @params
+        raw = Required : name -> raw counters of the latest sample
+      @return
+        None
+    """
+    now = time.monotonic()
+    for proc in self.processes:
+      if proc.lazy and proc.idle_timeout and proc.running == True and proc.name in raw:
+        if self.activation.idle_for(proc, raw[proc.name]['ticks'], now) >= proc.idle_timeout:
+          asyncio.get_event_loop().create_task(self.__stop_idle(proc))
+
+  async def __stop_idle(self, proc : Process):
+    """
+      Stop an idle lazy process and wait for its next connection. This is not a failure, so the restart
+      policy starts over
+
+      @params
+        proc = Required : process
+      @return
+        None
+    """
+    await proc.stop()
+    proc.policy.reset()
+    proc.running = False
+    proc.changed()
+    self.activation.arm(proc, self.activate)
+
+  def enforce_limits(self, raw : dict):
+    """
+      Restart processes whose latest samples exceed their limits for long enough
+
+      @params
+        raw = Required : name -> raw counters of the latest sample
+      @return
+        None
+    """
+    now = time.monotonic()
+    for proc in self.processes:
+      if proc.limits and proc.running == True and proc.name in raw and not proc.replacing and proc.name not in self.recycling:
+        key, breach = self.watchdog.check(proc, self.metrics.current(proc.name), now)
+        if breach is not None:
+          asyncio.get_event_loop().create_task(self.__recycle(proc, key, breach))
+
+  async def __recycle(self, proc : Process, key : str, breach : str):
+    """
+      Gracefully restart a process that exceeded a limit, recording why in the service output, its stderr
+      log and the procm_limit_restarts_total counter
+
+      @params
+        proc = Required : process
+        key = Required : limit exceeded
+        breach = Required : description
+      @return
+        None
+    """
+    print(f"{proc.name}: {breach}, restarting")
+    telemetry.LIMIT_RESTARTS.inc(limit=key)
+    if proc.log is not False:
+      proc.log_writer("stderr").feed(f"\n[procm: {breach}, restarting]\n".encode())
+
+    self.recycling.add(proc.name)
+    try:
+      await proc.restart()
+    finally:
+      self.recycling.discard(proc.name)
+      self.watchdog.forget(proc.name)
+
   async def manage_procs(self):
     """
-      Manages and monitors processes
+      Manages and monitors processes: sleeps until the next supervision deadline, then checks the
+      processes that are due (see supervisor module)
+
+      @return 
+        None
+    """
+    loop = asyncio.get_event_loop()
+
+    while True:
+      await self.supervisor.sleep()
+      due = [self.names[name] for name in self.supervisor.due() if name in self.names]
+      if len(due) > 0:
+        loop.create_task(self.check_procs(due))
+
+  async def check_procs(self, procs : list):
+    """
+      Check processes that are due: confirm or poll their state, restart stopped ones, then schedule
+      their next checks. Runs as a task, so a restart waiting out a backoff delay holds up no other checks
+
+      @params
+        procs = Required : processes
+      @return 
+        None
+    """
+    try:
+      start = time.perf_counter()
+      await self.poll_procs(procs)
+      telemetry.POLL_CYCLE.observe(time.perf_counter() - start)
+      await self.restart_stopped(procs)
+    finally:
+      for proc in procs:
+        if self.names.get(proc.name) is proc:
+          self.supervisor.schedule(proc.name, self.supervisor.interval(proc))
 
+  async def watch_loop(self, interval : float = 0.5):
+    """
+      Measure event loop lag: how late a sleep wakes up beyond its interval
+
+      @params
+        interval = Optional : seconds between measurements
       @return 
         None
     """
     while True:
-      await self.poll_procs()
-      await self.restart_stopped()
-      await asyncio.sleep(2)
+      start = time.perf_counter()
+      await asyncio.sleep(interval)
+      telemetry.LOOP_LAG.observe(max(time.perf_counter() - start - interval, 0))
+
+  async def serve_metrics(self, port : int):
+    """
+      Serve the self metrics over HTTP on the loopback interface, for Prometheus scrapes
+
+      @params
+        port = Required : TCP port
+      @return 
+        None
+    """
+    async def handle(r : asyncio.StreamReader, w : asyncio.StreamWriter):
+      try:
+        await r.readuntil(b"\r\n\r\n")
+        body = telemetry.registry.render().encode()
+        w.write(b"HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                + f"Content-Length: {len(body)}\r\n\r\n".encode() + body)
+        await w.drain()
+      except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+        pass
+      finally:
+        w.close()
+
+    server = await asyncio.start_server(handle, "127.0.0.1", port)
+    async with server:
+      await server.serve_forever()
+
+  def __states(self):
+    """
+      Number of processes by state, for the procm_processes gauge
+
+      @return 
+        (dict) label tuple -> count
+    """
+    counts = {}
+    for proc in self.processes:
+      state = {True: "running", False: "exited", "STOPPED": "stopped", "BACKOFF": "backoff", "FATAL": "fatal"}.get(proc.running, str(proc.running))
+      counts[(("state", state),)] = counts.get((("state", state),), 0) + 1
+    return counts
 
 if __name__ == "__main__":
   """